@@ -0,0 +1,71 @@
+#!/usr/bin/python
+###############################################################################
+# Computes reference values for validateThermo.py with the ViennaRNA Package
+# (Python bindings, RNA module; Turner 2004 parameters) in oligoscreen output
+# format: homodimer (RNAduplex of two copies, 0 if not stable), self-structure
+# (RNAfold), duplex with the complement and the costs of opening its two
+# terminal pairs at either end
+###############################################################################
+from __future__ import print_function
+import sys, random
+from argparse import ArgumentParser
+import RNA
+
+###############################################################################
+# Fetch arguments
+###############################################################################
+parser = ArgumentParser()
+parser.add_argument('-seq', dest='seq', required=False,
+                    help='file with one probe arm sequence per line',
+                    metavar='FILEPATH')
+parser.add_argument('-n', dest='n', type=int, default=1000,
+                    help='number of random 20-nt arms if -seq is not given ' + \
+                    '(default: %(default)s)', metavar='N')
+parser.add_argument('-seed', dest='seed', type=int, default=1,
+                    help='seed of the random arms (default: %(default)s)',
+                    metavar='N')
+parser.add_argument('-out', dest='out', required=True,
+                    help='prefix of the output files (.txt: sequences, ' + \
+                    '.vienna: values)', metavar='FILEPATH')
+parser.add_argument('-temperature', dest='temperature', type=float, default=310.15,
+                    help='temperature in K (default: %(default)s)', metavar='K')
+args = parser.parse_args()
+
+###############################################################################
+# Sequences
+###############################################################################
+if args.seq is not None:
+  with open(args.seq) as fh:
+    seqs = [line.strip().upper() for line in fh if line.strip() != '']
+  fh.close()
+else:
+  random.seed(args.seed)
+  seqs = [''.join([random.choice('ACGT') for i in range(20)])
+          for j in range(args.n)]
+
+###############################################################################
+# Reference values
+###############################################################################
+RNA.cvar.temperature = args.temperature - 273.15
+
+def revcomp(seq):
+  return ''.join(reversed([{ 'A' : 'U', 'C' : 'G', 'G' : 'C', 'U' : 'A' }[x]
+                           for x in seq]))
+
+def duplex(seq):
+  return RNA.duplexfold(seq, revcomp(seq)).energy
+
+with open(args.out + '.txt', 'w') as fh:
+  fh.write('\n'.join(seqs) + '\n')
+fh.close()
+with open(args.out + '.vienna', 'w') as fh:
+  fh.write("Sequence\tDG_bimolecular\tDG_unimolecular\tDG_duplex\t" +
+           "DG_2bpat5'\tDG_2bpat3'\n")
+  for x in seqs:
+    u = x.replace('T', 'U')
+    dup = duplex(u)
+    vals = [min(0.0, RNA.duplexfold(u, u).energy), RNA.fold(u)[1], dup,
+            duplex(u[2:]) - dup, duplex(u[:-2]) - dup]
+    fh.write(x + '\t' + '\t'.join(['%.2f' % (v + 0.0) for v in vals]) + '\n')
+fh.close()
+print('Wrote ' + str(len(seqs)) + ' sequences to ' + args.out + '.vienna')
@@ -0,0 +1,240 @@
+#!/usr/bin/python
+###############################################################################
+# Benchmark of the database build and probe design steps on a synthetic
+# genome, using the deterministic stand-ins of the external tools in
+# bench/stubs (no BLAST+ or RNAstructure installation required)
+###############################################################################
+import os, sys, time, json, random, shutil, platform
+from argparse import ArgumentParser
+# import modules in src/
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)) + '/src')
+from plishUtils import get_script_path, np, fetch_seq, fetch_exonLen, fetch_txIds
+from plishUtils import gccontent_batch, filter_probes, filter_defaults, pick_probes
+from plishUtils import write_probesCSV, write_probesFNA
+from plishDbUtils import write_exonFile, write_sequenceFile, write_indexFile
+from plishDbUtils import write_infoFile
+from plishHprobe import ProbeTable, assign_exons, calc_tm_hprobes
+from plishHprobe import fold_hprobes, blast_hprobes
+from plishMain import find_anchors
+from plishSession import write_session, read_session
+
+###############################################################################
+# Set environment vars
+###############################################################################
+os.environ['PLISH_TOOLS'] = get_script_path() + '/bench/stubs'
+
+###############################################################################
+# Fetch arguments
+###############################################################################
+parser = ArgumentParser()
+parser.add_argument('-chroms', dest='chroms', type=int, default=4,
+                    help='number of chromosomes (default: %(default)s)', metavar='N')
+parser.add_argument('-genes', dest='genes', type=int, default=50,
+                    help='number of genes per chromosome (default: %(default)s)',
+                    metavar='N')
+parser.add_argument('-isoforms', dest='isoforms', type=int, default=3,
+                    help='number of isoforms per gene (default: %(default)s)',
+                    metavar='N')
+parser.add_argument('-exons', dest='exons', type=int, default=8,
+                    help='number of exons per gene (default: %(default)s)', metavar='N')
+parser.add_argument('-tx', dest='tx', type=int, default=20,
+                    help='number of transcripts to design probes for ' + \
+                    '(default: %(default)s)', metavar='N')
+parser.add_argument('-repeat', dest='repeat', type=int, default=3,
+                    help='number of repetitions; the fastest is reported ' + \
+                    '(default: %(default)s)', metavar='N')
+parser.add_argument('-seed', dest='seed', type=int, default=1,
+                    help='random seed of the synthetic genome (default: %(default)s)',
+                    metavar='N')
+parser.add_argument('-out', dest='out',
+                    default=get_script_path() + '/results/benchmark.json',
+                    help='JSON result file (default: results/benchmark.json)',
+                    metavar='FILEPATH')
+parser.add_argument('-baseline', dest='baseline',
+                    help='JSON result file of a previous run to compare with; ' + \
+                    'exits with status 1 on a regression', metavar='FILEPATH')
+parser.add_argument('-threshold', dest='threshold', type=float, default=0.25,
+                    help='maximum tolerated slowdown relative to the baseline ' + \
+                    '(default: %(default)s, i.e. 25%%)', metavar='FRACTION')
+parser.add_argument('-stage-threshold', dest='stage_thresholds', action='append',
+                    default=[], help='threshold of a single stage, e.g. ' + \
+                    'fold=0.5 (repeatable)', metavar='STAGE=FRACTION')
+parser.add_argument('-mindelta', dest='mindelta', type=float, default=0.005,
+                    help='slowdowns below this many seconds are ignored ' + \
+                    '(default: %(default)s)', metavar='SECONDS')
+parser.add_argument('--keep', dest='keep', action='store_true',
+                    help='keep the synthetic genome and database')
+args = parser.parse_args()
+
+db = '_benchmark'
+work = get_script_path() + '/tmp/_benchmark'
+dbdir = get_script_path() + '/database/' + db
+gff_fn = work + '/genome.gff'
+fna_fn = work + '/genome.fna'
+exon_fn = dbdir + '/' + db + '.exons'
+txSeq_fn = dbdir + '/' + db + '.fna'
+index_fn = dbdir + '/' + db + '.index'
+info_fn = dbdir + '/' + db + '.info'
+
+###############################################################################
+# Synthetic genome: genes are placed one after another on random sequence;
+# the first isoform of a gene has all exons, the others a random subset
+###############################################################################
+def write_genome(gff_fn, fna_fn, rng):
+  with open(gff_fn, 'w') as fgff, open(fna_fn, 'w') as ffna:
+    fgff.write('##gff-version 3\n')
+    ntx = 0
+    for c in range(args.chroms):
+      chrom = 'chr' + str(c + 1)
+      pos = 1000
+      for g in range(args.genes):
+        gene = 'GENE' + str(c + 1) + '_' + str(g + 1)
+        strand = rng.choice('+-')
+        exons = list()
+        for e in range(args.exons):
+          elen = rng.randint(50, 400)
+          exons.append((pos, pos + elen - 1))
+          pos += elen + rng.randint(100, 2000)
+        fgff.write('\t'.join([chrom, 'bench', 'gene', str(exons[0][0]),
+                              str(exons[-1][1]), '.', strand, '.',
+                              'ID=gene-' + gene + ';gene=' + gene]) + '\n')
+        for i in range(args.isoforms):
+          ntx += 1
+          txid = 'NM_' + str(ntx).zfill(6) + '.1'
+          iexons = exons
+          if i > 0:
+            iexons = sorted(rng.sample(exons, rng.randint(1, len(exons))))
+          for a, b in iexons:
+            fgff.write('\t'.join([chrom, 'bench', 'exon', str(a), str(b), '.',
+                                  strand, '.', 'ID=exon-' + txid + ';Parent=rna-' +
+                                  txid + ';gene=' + gene + ';transcript_id=' +
+                                  txid]) + '\n')
+        pos += 5000
+      seq = ''.join([rng.choice('ACGT') for i in range(pos)])
+      ffna.write('>' + chrom + ' synthetic chromosome\n')
+      for i in range(0, len(seq), 80):
+        ffna.write(seq[i:i+80] + '\n')
+  fgff.close()
+  ffna.close()
+
+###############################################################################
+# Stages: the database build and, for each sampled transcript, the steps of
+# plishMain.main followed by filtering and writing the results
+###############################################################################
+def run_design(timings, txIds):
+  def timed(name, func, *fargs):
+    t0 = time.time()
+    res = func(*fargs)
+    timings[name] = timings.get(name, 0.0) + time.time() - t0
+    return res
+
+  for txId in txIds:
+    inputName, inputId, inputSeq = timed('fetch_seq', fetch_seq, txId, db)
+    elen = timed('fetch_exonLen', fetch_exonLen, inputId, db)
+    anc_index, anc_seq = timed('anchors', find_anchors, inputSeq)
+    anc_gc = timed('gccontent', gccontent_batch, anc_seq)
+    hprobes = timed('hprobes', ProbeTable, inputId, inputName, anc_index, anc_seq,
+                    anc_gc)
+    timed('assign_exons', assign_exons, hprobes, elen)
+    timed('tm', calc_tm_hprobes, hprobes, 0.05, None)
+    timed('fold', fold_hprobes, hprobes, 310.15)
+    timed('blast', blast_hprobes, hprobes, db)
+    timed('write_session', write_session, work + '/session.plish',
+          [(inputId, inputName, hprobes)], {})
+    timed('read_session', read_session, work + '/session.plish')
+    timed('pick_probes', pick_probes, hprobes, 10, 8)
+    hprobes = timed('filter_probes', lambda: filter_probes(hprobes, **filter_defaults))
+    timed('write_probesCSV', write_probesCSV, inputId, inputName, hprobes, None,
+          work + '/probes.csv')
+    timed('write_probesFNA', write_probesFNA, inputId, inputName, hprobes, None,
+          work + '/probes.fna')
+
+def run_once():
+  timings = {}
+  for name, func, fargs in [('write_exonFile', write_exonFile, (gff_fn, exon_fn)),
+                            ('write_sequenceFile', write_sequenceFile,
+                             (fna_fn, exon_fn, txSeq_fn)),
+                            ('write_indexFile', write_indexFile,
+                             (txSeq_fn, exon_fn, index_fn))]:
+    t0 = time.time()
+    func(*fargs)
+    timings[name] = time.time() - t0
+  txIds = fetch_txIds(db)
+  txIds = random.Random(args.seed).sample(txIds, min(args.tx, len(txIds)))
+  run_design(timings, txIds)
+  return timings
+
+###############################################################################
+# RUN
+###############################################################################
+for d in [work, dbdir]:
+  if not os.path.exists(d):
+    os.makedirs(d)
+best = {}
+stdout = sys.stdout
+try:
+  # the database is listed like any other one (see fetch_dbInfo) while it exists
+  write_infoFile(info_fn, db, 'Benchmark (synthetic genome)', 
+                 'temporary database of benchmark.py')
+  print 'Generating synthetic genome ...'
+  write_genome(gff_fn, fna_fn, random.Random(args.seed))
+  if os.path.exists(fna_fn + '.fai'):
+    os.remove(fna_fn + '.fai')
+  for r in range(args.repeat):
+    sys.stdout = open(os.devnull, 'w') #silence the step logs
+    try:
+      timings = run_once()
+    finally:
+      sys.stdout.close()
+      sys.stdout = stdout
+    for name in timings:
+      best[name] = min(best.get(name, timings[name]), timings[name])
+    print 'Repetition ' + str(r + 1) + '/' + str(args.repeat) + ': ' + \
+          str(round(sum(timings.values()), 3)) + ' s'
+finally:
+  if not args.keep: #also after a failed run
+    shutil.rmtree(work, ignore_errors=True)
+    shutil.rmtree(dbdir, ignore_errors=True)
+
+config = dict((x, getattr(args, x)) for x in ['chroms', 'genes', 'isoforms',
+                                               'exons', 'tx', 'repeat', 'seed'])
+result = { 'config' : config,
+           'python' : platform.python_version(),
+           'numpy' : np is not None,
+           'date' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+           'timings' : dict((x, round(best[x], 6)) for x in best) }
+with open(args.out, 'w') as fh:
+  json.dump(result, fh, indent=2, sort_keys=True)
+fh.close()
+print 'Results written to ' + args.out
+
+###############################################################################
+# Comparison with baseline
+###############################################################################
+if args.baseline is not None:
+  with open(args.baseline) as fh:
+    base = json.load(fh)
+  fh.close()
+  if base['config'] != config:
+    print 'WARNING: baseline was run with a different configuration: ' + \
+          str(base['config'])
+  thresholds = dict([(x.split('=')[0], float(x.split('=')[1]))
+                     for x in args.stage_thresholds])
+  regressions = list()
+  print '\t'.join(['Stage', 'Baseline', 'Current', 'Change', 'Status'])
+  for name in sorted(result['timings']):
+    cur = result['timings'][name]
+    if name not in base['timings']:
+      print '\t'.join([name, '-', str(round(cur, 4)), '-', 'new'])
+      continue
+    old = base['timings'][name]
+    change = (cur - old) / old if old > 0 else 0.0
+    status = 'ok'
+    if change > thresholds.get(name, args.threshold) and cur - old > args.mindelta:
+      status = 'REGRESSION'
+      regressions.append(name)
+    print '\t'.join([name, str(round(old, 4)), str(round(cur, 4)),
+                     str(round(100 * change, 1)) + '%', status])
+  if len(regressions) > 0:
+    print 'Regressions: ' + ', '.join(regressions)
+    sys.exit(1)
@@ -10,9 +10,12 @@ from argparse import ArgumentParser
 from subprocess import call
 # import modules in src/
 sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)) + '/src')
-from plishUtils import get_script_path
+from plishUtils import get_script_path, fetch_dbVersion
 from plishDbUtils import write_infoFile, write_exonFile, write_sequenceFile
-from plishDbUtils import generate_BLASTdb
+from plishDbUtils import write_indexFile, write_kmerIndex, generate_BLASTdb
+from plishDbUtils import write_manifest, update_sequenceFile
+from plishCache import invalidate_db
+from plishProfile import start_profile
 
 ###############################################################################
 # Set environment vars
@@ -24,9 +27,11 @@ os.environ['BLASTDB'] = get_script_path() + '/database/'
 ###############################################################################
 parser = ArgumentParser()
 parser.add_argument('-gff', dest='gff', required=True,
-                    help='annotation GFF file', metavar='FILEPATH')
+                    help='annotation GFF file (optionally gzip-compressed)',
+                    metavar='FILEPATH')
 parser.add_argument('-fna', dest='fna', required=True,
-                    help='genome sequence FASTA file', metavar='FILEPATH')
+                    help='genome sequence FASTA file (optionally gzip- or ' + \
+                    'bgzip-compressed)', metavar='FILEPATH')
 parser.add_argument('-db', dest='db', required=True,
                     help='identifier of database (e.g., mmu_refseq); ' + \
                     'please, avoid white-spaces and special characters.', metavar='ID')
@@ -35,7 +40,23 @@ parser.add_argument('-name', dest='name', required=True,
 parser.add_argument('-comment', dest='comment', required=False,
                     help='any comment to add to the info file (e.g., genome assembly)', 
                     metavar='COMMENT')
+parser.add_argument('-jobs', dest='jobs', type=int, default=1,
+                    help='number of worker processes for the sequence extraction; ' + \
+                    'with more than one job, the indexes are built while ' + \
+                    'makeblastdb is running (default: 1)', metavar='N')
+parser.add_argument('--update', dest='update', action='store_true',
+                    help='update an existing database: only new or changed ' + \
+                    'transcripts are extracted and the BLAST+ database is only ' + \
+                    'rebuilt if sequences changed')
+parser.add_argument('--profile', dest='profile', 
+                    help='write a JSON report with the time, calls, subprocesses ' + \
+                    'and bytes written per step', metavar='FILEPATH')
+parser.add_argument('--cprofile', dest='cprofile', 
+                    help='with --profile, also write cProfile statistics ' + \
+                    '(pstats format)', metavar='FILEPATH')
 args = parser.parse_args()
+if args.profile is not None:
+  start_profile(args.profile, args.cprofile)
 
 ###############################################################################
 # Input
@@ -53,14 +74,46 @@ if db_comment is None:
 ###############################################################################
 exon_fn = get_script_path() + '/database/' + db_id + '/' + db_id + '.exons'
 txSeq_fn = get_script_path() + '/database/' + db_id + '/' + db_id + '.fna'
+index_fn = get_script_path() + '/database/' + db_id + '/' + db_id + '.index'
 info_fn = get_script_path() + '/database/' + db_id + '/' + db_id + '.info'
+manifest_fn = get_script_path() + '/database/' + db_id + '/' + db_id + '.manifest'
+fai_fn = get_script_path() + '/database/' + db_id + '/' + db_id + '.genome.fai'
 blastdb = get_script_path() + '/database/' + db_id + '/' + db_id
 
 ###############################################################################
 # RUN
 ###############################################################################
+if args.update and not os.path.exists(manifest_fn):
+  print 'No manifest found for database "' + db_id + '"; running a full build.'
+elif args.update: #incremental update
+  db_version = fetch_dbVersion(db_id)
+  write_exonFile(gff_fn, exon_fn)
+  changed = update_sequenceFile(fna_fn, exon_fn, txSeq_fn, manifest_fn, jobs=args.jobs,
+                                fai_fn=fai_fn)
+  write_indexFile(txSeq_fn, exon_fn, index_fn)
+  if changed:
+    write_kmerIndex(txSeq_fn, blastdb)
+    generate_BLASTdb(blastdb, txSeq_fn)
+    write_infoFile(info_fn, db_id, db_name, db_comment)
+    invalidate_db(db_id, db_version) #drop BLAST results of old version
+  else:
+    print 'Sequences unchanged; keeping BLAST+ database.'
+    write_infoFile(info_fn, db_id, db_name, db_comment, db_version)
+  write_manifest(fna_fn, exon_fn, txSeq_fn, manifest_fn)
+  print 'Update of database "' + db_id + '" is finished.'
+  sys.exit(0)
+
 write_infoFile(info_fn, db_id, db_name, db_comment)
 write_exonFile(gff_fn, exon_fn)
-write_sequenceFile(fna_fn, exon_fn, txSeq_fn)
-generate_BLASTdb(blastdb, txSeq_fn)
+write_sequenceFile(fna_fn, exon_fn, txSeq_fn, jobs=args.jobs, fai_fn=fai_fn)
+if args.jobs > 1: #build indexes while makeblastdb is running
+  proc = generate_BLASTdb(blastdb, txSeq_fn, wait=False)
+  write_indexFile(txSeq_fn, exon_fn, index_fn)
+  write_kmerIndex(txSeq_fn, blastdb)
+  proc.wait()
+else:
+  write_indexFile(txSeq_fn, exon_fn, index_fn)
+  write_kmerIndex(txSeq_fn, blastdb)
+  generate_BLASTdb(blastdb, txSeq_fn)
+write_manifest(fna_fn, exon_fn, txSeq_fn, manifest_fn)
 print 'Generation of database "' + db_id + '" is finished.'
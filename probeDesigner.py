@@ -10,8 +10,10 @@ from Tkinter import Tk
 # import modules in src/
 sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)) + '/src')
 from plishGUI import GUI
-from plishUtils import get_script_path, fetch_dbInfo
-from plishMain import main
+from plishUtils import get_script_path, get_tool_path, fetch_dbInfo, fetch_txIds
+from plishUtils import filter_defaults
+from plishMain import run_batch, run_session
+from plishProfile import start_profile
 
 # Run tool in debug mode? For devel use only.
 _debug = False
@@ -20,7 +22,7 @@ _version = '0.4.0 (Jan 2019)'
 ###############################################################################
 # Set environment vars
 ###############################################################################
-os.environ['DATAPATH'] = get_script_path() + '/tools/RNAstructure/data_tables/'
+os.environ['DATAPATH'] = get_tool_path() + '/RNAstructure/data_tables/'
 os.environ['BLASTDB'] = get_script_path() + '/database/'
 
 ###############################################################################
@@ -35,15 +37,156 @@ if len(sys.argv) == 1: #run w/ GUI
   root = Tk()
   my_gui = GUI(root, dbnames, dbids, _debug, _version)
   root.mainloop()
+elif sys.argv[1] == '--serve': #run as local service
+  from plishServer import serve
+  parser = ArgumentParser(usage='%(prog)s --serve [options]')
+  parser.add_argument('--serve', dest='serve', action='store_true', required=True,
+                      help='run as local probe design service (HTTP API)')
+  parser.add_argument('--host', dest='host', default='127.0.0.1',
+                      help='address to listen on (default: %(default)s)')
+  parser.add_argument('--port', dest='port', type=int, default=8765,
+                      help='port to listen on (default: %(default)s)')
+  parser.add_argument('--max-jobs', dest='maxjobs', type=int, default=1,
+                      help='number of jobs run at the same time (default: 1)',
+                      metavar='N')
+  parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                      help='number of worker processes per job (default: 1)', 
+                      metavar='N')
+  parser.add_argument('--nocache', dest='nocache', action='store_true',
+                      help='do not use the feature cache (cache/features.sqlite)')
+  parser.add_argument('--no-kmer', dest='kmer', action='store_false',
+                      help='assess the specificity of all probes by BLAST instead ' + \
+                      'of resolving clear-cut probes by the k-mer index of the ' + \
+                      'database')
+  args = parser.parse_args()
+  serve(args.host, args.port, args.maxjobs, args.jobs, not args.nocache)
 else: #run via command line
   parser = ArgumentParser()
-  parser.add_argument('-db', '--database', dest='db', required=True,
+  parser.add_argument('-db', '--database', dest='db',
                       help='database to use: ' + str(dbids), metavar='ID')
-  parser.add_argument('-tx', '--transcript', dest='tx', required=True,
-                      help='transcript database id', metavar='ID')
+  txgroup = parser.add_mutually_exclusive_group(required=True)
+  txgroup.add_argument('-tx', '--transcript', dest='tx',
+                       help='transcript database id; as for all inputs, the ' + \
+                       'probes are filtered with the filter flags (use ' + \
+                       '--nofilter to write all candidates as before)', metavar='ID')
+  txgroup.add_argument('-txlist', '--transcript-list', dest='txlist',
+                       help='file with one transcript database id per line', 
+                       metavar='FILEPATH')
+  txgroup.add_argument('-gene', '--gene', dest='gene',
+                       help='design probes for all isoforms of a gene at once: ' + \
+                       'the features of candidates shared by isoforms are only ' + \
+                       'computed once', metavar='SYMBOL')
+  txgroup.add_argument('-genelist', '--gene-list', dest='genelist',
+                       help='file with one gene symbol per line (see -gene)', 
+                       metavar='FILEPATH')
+  txgroup.add_argument('--all', dest='all', action='store_true',
+                       help='design probes for all transcripts of the database')
+  txgroup.add_argument('-session', '--session', dest='session',
+                       help='filter and export the probes of a session file ' + \
+                       '(see --save-session) instead of designing probes',
+                       metavar='FILEPATH')
+  parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                      help='number of worker processes for the thermodynamics ' + \
+                      'and specificity calculation (default: 1)', metavar='N')
+  parser.add_argument('--thermo', dest='engine', default='oligoscreen',
+                      choices=['oligoscreen', 'nn'],
+                      help='thermodynamics engine: RNAstructure oligoscreen or ' + \
+                      'the built-in nearest-neighbor model (default: %(default)s)')
+  parser.add_argument('--nocache', dest='nocache', action='store_true',
+                      help='do not use the feature cache (cache/features.sqlite)')
+  parser.add_argument('--no-kmer', dest='kmer', action='store_false',
+                      help='assess the specificity of all probes by BLAST instead ' + \
+                      'of resolving clear-cut probes by the k-mer index of the ' + \
+                      'database')
+  parser.add_argument('-merge', '--merge', dest='merge', 
+                      help='write the probes of all transcripts into the merged ' + \
+                      'files results/NAME_hprobe.csv|fna', metavar='NAME')
+  parser.add_argument('--nofilter', dest='nofilter', action='store_true',
+                      help='write all candidate probes without filtering ' + \
+                      '(the filters are applied by default, also with -tx)')
+  parser.add_argument('--save-session', dest='save_session',
+                      help='save the features of all candidate probes as session ' + \
+                      'file, to be filtered again with -session', metavar='FILEPATH')
+  parser.add_argument('--prefilter', dest='prefilter', action='store_true',
+                      help='filter during the computation: thermodynamics are ' + \
+                      'only computed for probes passing the GC, Tm and exon ' + \
+                      'filters and BLAST only for probes passing all others')
+  parser.add_argument('--spec', dest='spec', default=filter_defaults['spec'],
+                      choices=['isoform', 'gene', 'none'],
+                      help='minimum specificity (default: %(default)s)')
+  parser.add_argument('--mingc', dest='mingc', type=float, 
+                      default=filter_defaults['mingc'],
+                      help='minimum GC content in %% (default: %(default)s)')
+  parser.add_argument('--mintm', dest='mintm', type=float, 
+                      default=filter_defaults['mintm'],
+                      help='minimum Tm in C (default: %(default)s)')
+  parser.add_argument('--maxtm', dest='maxtm', type=float, 
+                      default=filter_defaults['maxtm'],
+                      help='maximum Tm in C (default: %(default)s)')
+  parser.add_argument('--minfold', dest='minfold', type=float, 
+                      default=filter_defaults['minfold'],
+                      help='minimum fold free energy in kcal/mol (default: %(default)s)')
+  parser.add_argument('--mindimer', dest='mindimer', type=float, 
+                      default=filter_defaults['mindimer'],
+                      help='minimum homodimer free energy in kcal/mol (default: %(default)s)')
+  parser.add_argument('--maxduplex', dest='maxduplex', type=float, 
+                      default=filter_defaults['maxduplex'],
+                      help='maximum duplex free energy in kcal/mol (default: %(default)s)')
+  parser.add_argument('--multiexon', dest='multiexon', action='store_true',
+                      default=filter_defaults['multiexon'],
+                      help='keep only probes spanning an exon junction (default)')
+  parser.add_argument('--no-multiexon', dest='multiexon', action='store_false',
+                      help='keep also probes within a single exon')
+  parser.add_argument('--pick', dest='pick', action='store_true',
+                      help='keep only the best set of non-overlapping probes ' + \
+                      '(balanced Tm, GC close to 50%%, free energy margins)')
+  parser.add_argument('--spacing', dest='spacing', type=int, default=0,
+                      help='with --pick, minimum gap between probes in nt ' + \
+                      '(default: %(default)s)', metavar='N')
+  parser.add_argument('--maxprobes', dest='maxprobes', type=int,
+                      help='with --pick, maximum number of probes per ' + \
+                      'transcript', metavar='N')
+  parser.add_argument('--profile', dest='profile', 
+                      help='write a JSON report with the time, calls, subprocesses ' + \
+                      'and bytes written per stage', metavar='FILEPATH')
+  parser.add_argument('--cprofile', dest='cprofile', 
+                      help='with --profile, also write cProfile statistics ' + \
+                      '(pstats format)', metavar='FILEPATH')
   args = parser.parse_args()
-  db = args.db
-  inputId = args.tx
-  main(inputId, db, debug=_debug)
-  write_probesCSV(inputId, inputName, hprobes, None)
-  write_probesFNA(inputId, inputName, hprobes, None)
+  if args.db is None and args.session is None:
+    parser.error('argument -db/--database is required')
+  if args.spacing < 0 or (args.maxprobes is not None and args.maxprobes < 1):
+    parser.error('--spacing must be >= 0 and --maxprobes >= 1')
+  if args.prefilter and args.save_session is not None:
+    parser.error('--save-session cannot be combined with --prefilter')
+  if args.prefilter and args.nofilter:
+    parser.error('--prefilter cannot be combined with --nofilter')
+  if args.profile is not None:
+    start_profile(args.profile, args.cprofile)
+  filters = None
+  if not args.nofilter:
+    filters = dict((x, getattr(args, x)) for x in filter_defaults.keys())
+  pick = None
+  if args.pick:
+    pick = { 'spacing' : args.spacing, 'maxn' : args.maxprobes }
+  if args.session is not None:
+    run_session(args.session, filters, merge=args.merge, pick=pick)
+  else:
+    db = args.db
+    if args.tx is not None:
+      inputIds = [args.tx]
+    elif args.gene is not None:
+      inputIds = [args.gene]
+    elif args.txlist is not None or args.genelist is not None:
+      with open(args.txlist or args.genelist) as fh:
+        inputIds = [line.split()[0] for line in fh 
+                    if line.strip() != '' and not line.startswith('#')]
+      fh.close()
+    else:
+      inputIds = fetch_txIds(db)
+    run_batch(inputIds, db, filters, merge=args.merge, debug=_debug, jobs=args.jobs,
+              cache=not args.nocache, engine=args.engine, 
+              prefilter=args.prefilter, 
+              session=args.save_session, pick=pick, 
+              genes=args.gene is not None or args.genelist is not None,
+              kmer=args.kmer)
@@ -0,0 +1,172 @@
+#!/usr/bin/python
+###############################################################################
+# Persistent feature cache (oligoscreen and BLAST results)
+###############################################################################
+import os, sqlite3, time
+from plishUtils import get_script_path, fetch_dbVersion, select_probes
+from plishProfile import profiled
+from plishThermo import model_version
+
+# Default cache file and maximum number of entries
+_defaultCacheFile = get_script_path() + '/cache/features.sqlite'
+_defaultMaxEntries = 2000000
+
+###############################################################################
+# Public container for the content-addressed feature cache
+# Entries are keyed by (kind, sequence, parameters); for BLAST results the
+# parameters contain the database id and version. If the cache holds more
+# than maxentries entries, the least recently used ones are evicted.
+# Attributes
+# filepath:   SQLite file of the cache (str)
+# maxentries: maximum number of entries (int)
+# hits:       number of cache hits per kind (dict)
+# misses:     number of cache misses per kind (dict)
+###############################################################################
+class FeatureCache:
+  # Constructor
+  def __init__(self, filepath=_defaultCacheFile, maxentries=_defaultMaxEntries):
+    if not os.path.exists(os.path.dirname(filepath)):
+      os.makedirs(os.path.dirname(filepath))
+    self.filepath = filepath
+    self.maxentries = maxentries
+    self.hits = {}
+    self.misses = {}
+    self.con = sqlite3.connect(filepath, timeout=60)
+    self.con.text_factory = str
+    self.con.execute('CREATE TABLE IF NOT EXISTS features (' +
+                     'kind TEXT, seq TEXT, params TEXT, value TEXT, ' +
+                     'atime REAL, PRIMARY KEY (kind, seq, params))')
+    self.con.execute('CREATE INDEX IF NOT EXISTS features_atime ' +
+                     'ON features (atime)')
+    self.con.commit()
+
+  # Attributes
+  filepath = maxentries = hits = misses = con = None
+
+  # Methods
+  # Returns dict seq -> value of all cached seqs
+  def get(self, kind, seqs, params):
+    found = {}
+    seqs = list(set(seqs))
+    for c in range(0, len(seqs), 500): #SQLite variable limit
+      chunk = seqs[c:c+500]
+      sql = 'SELECT seq, value FROM features WHERE kind = ? AND params = ? ' + \
+            'AND seq IN (' + ','.join(['?'] * len(chunk)) + ')'
+      for seq, value in self.con.execute(sql, [kind, params] + chunk):
+        found[seq] = value
+    if len(found) > 0: #refresh access time
+      now = time.time()
+      self.con.executemany('UPDATE features SET atime = ? WHERE ' +
+                           'kind = ? AND seq = ? AND params = ?',
+                           [(now, kind, x, params) for x in found])
+      self.con.commit()
+    self.hits[kind] = self.hits.get(kind, 0) + len(found)
+    self.misses[kind] = self.misses.get(kind, 0) + len(seqs) - len(found)
+    return found
+
+  # Stores dict seq -> value
+  def put(self, kind, values, params):
+    now = time.time()
+    self.con.executemany('INSERT OR REPLACE INTO features VALUES (?,?,?,?,?)',
+                         [(kind, x, params, values[x], now) for x in values])
+    self.con.commit()
+    self.evict()
+
+  # Removes least recently used entries beyond maxentries
+  def evict(self):
+    n = self.con.execute('SELECT COUNT(*) FROM features').fetchone()[0]
+    if n > self.maxentries:
+      self.con.execute('DELETE FROM features WHERE rowid IN (SELECT rowid ' +
+                       'FROM features ORDER BY atime LIMIT ?)',
+                       (n - self.maxentries,))
+      self.con.commit()
+
+  # Removes all entries of kind with parameters starting with prefix
+  def invalidate(self, kind, prefix=''):
+    self.con.execute('DELETE FROM features WHERE kind = ? AND ' +
+                     'substr(params, 1, ?) = ?', (kind, len(prefix), prefix))
+    self.con.commit()
+
+  # Returns hit rate of kind as string
+  def report(self, kind):
+    h = self.hits.get(kind, 0)
+    n = h + self.misses.get(kind, 0)
+    rate = 100.0 * h / n if n > 0 else 0.0
+    return kind + ' cache hits: ' + str(h) + '/' + str(n) + \
+           ' (' + str(round(rate, 1)) + '%)'
+
+  def close(self):
+    self.con.close()
+
+###############################################################################
+# Returns cache parameters of fold results (with the model version for the
+# built-in engine, so that results of older versions are not reused)
+###############################################################################
+def _fold_params(temperature, engine):
+  if engine == 'oligoscreen':
+    return str(temperature)
+  if engine == 'nn':
+    engine += str(model_version)
+  return engine + '|' + str(temperature)
+
+###############################################################################
+# Assigns cached free energies to the probes; returns the probes for which
+# at least one arm is not cached (list or ProbeTable, as given)
+###############################################################################
+@profiled
+def load_fold(cache, hprobes, temperature, engine='oligoscreen'):
+  params = _fold_params(temperature, engine)
+  seqs = [x.larm.seq for x in hprobes] + [x.rarm.seq for x in hprobes]
+  found = cache.get('fold', seqs, params)
+  missing = list()
+  for x in hprobes:
+    hit = x.larm.seq in found and x.rarm.seq in found
+    if hit:
+      x.larm.set_dg(found[x.larm.seq])
+      x.rarm.set_dg(found[x.rarm.seq])
+    missing.append(not hit)
+  return select_probes(hprobes, missing)
+
+###############################################################################
+# Stores free energies of the probe arms
+###############################################################################
+@profiled
+def store_fold(cache, hprobes, temperature, engine='oligoscreen'):
+  values = {}
+  for x in hprobes:
+    for arm in [x.larm, x.rarm]:
+      values[arm.seq] = arm.get_dg()
+  cache.put('fold', values, _fold_params(temperature, engine))
+
+###############################################################################
+# Assigns cached BLAST hits to the probes; returns the uncached probes
+###############################################################################
+@profiled
+def load_blast(cache, hprobes, blastdb):
+  params = blastdb + '|' + fetch_dbVersion(blastdb)
+  found = cache.get('blast', [x.seq for x in hprobes], params)
+  missing = list()
+  for x in hprobes:
+    if x.seq in found:
+      bhits = found[x.seq].split('\n') if found[x.seq] != '' else list()
+      x.set_bhits(['\t' + h.rsplit(':', 1)[0] + '\t' + h.rsplit(':', 1)[1]
+                   for h in bhits])
+    missing.append(x.seq not in found)
+  return select_probes(hprobes, missing)
+
+###############################################################################
+# Stores BLAST hits of the probes
+###############################################################################
+@profiled
+def store_blast(cache, hprobes, blastdb):
+  values = dict((x.seq, '\n'.join(x.bhits)) for x in hprobes)
+  cache.put('blast', values, blastdb + '|' + fetch_dbVersion(blastdb))
+
+###############################################################################
+# Removes the cached BLAST hits of version db_version of database db
+###############################################################################
+def invalidate_db(db, db_version):
+  if os.path.exists(_defaultCacheFile):
+    cache = FeatureCache()
+    cache.invalidate('blast', db + '|' + db_version)
+    cache.close()
@@ -4,17 +4,24 @@
 # written by Daniel C. Ellwanger <dcellwanger.dev@gmail.com>
 # last modified Jul 18 2018
 ###############################################################################
-import os, sys, re
+import os, sys, time, mmap, errno, hashlib, zlib, struct, threading
+from Queue import Queue, Empty
+from bisect import bisect_right
 from argparse import ArgumentParser
-from subprocess import call
+from subprocess import call, Popen
+from multiprocessing import Pool
+from array import array
 # import modules in src/
 sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)) + '/src')
-from plishUtils import compl, get_script_path
+from plishUtils import compl, get_script_path, get_tool_path, file_stamp
+from plishKmer import np, kmers_canonical
+from plishProfile import profiled, count
 
 ###############################################################################
 # Generate info file
 ###############################################################################
-def write_infoFile(info_fn, db_id, db_name, db_comment):
+@profiled
+def write_infoFile(info_fn, db_id, db_name, db_comment, db_version=None):
   print 'Writing info file...'
   if not os.path.exists(os.path.dirname(info_fn)):
     try:
@@ -26,113 +33,408 @@ def write_infoFile(info_fn, db_id, db_name, db_comment):
     fh.write('#' + db_comment + '\n')
     fh.write('dbid=' + db_id + '\n')
     fh.write('dbname=' + db_name + '\n')
+    if db_version is None:
+      db_version = time.strftime('%Y%m%d%H%M%S')
+    fh.write('dbversion=' + db_version + '\n')
   fh.close()
 
 ###############################################################################
-# Generate exon coodinate file for each transcript
+# Returns compression of a file: None (uncompressed), 'gzip' or 'bgzf'
+# (blocked gzip as written by bgzip, allows random access)
 ###############################################################################
+def gzip_type(filepath):
+  with open(filepath, 'rb') as fh:
+    head = fh.read(16)
+  fh.close()
+  if head[:2] != '\x1f\x8b':
+    return None
+  if len(head) == 16 and ord(head[3]) & 4 and head[12:14] == 'BC':
+    return 'bgzf'
+  return 'gzip'
+
+###############################################################################
+# Private line reader of a gzip file; the file is decompressed in a separate 
+# thread (zlib releases the GIL) that runs ahead of the parsing by up to 
+# queuesize chunks. Multi-member files (e.g. bgzip) are supported. The 
+# throughput is reported on close.
+###############################################################################
+class _GzipReader:
+  # Constructor
+  def __init__(self, filepath, chunksize=4 << 20, queuesize=8):
+    self.filepath = filepath
+    self.cbytes = self.ubytes = 0
+    self.stop = False
+    self.t0 = time.time()
+    self.queue = Queue(maxsize=queuesize)
+    self.thread = threading.Thread(target=self._decompress, args=(chunksize,))
+    self.thread.daemon = True
+    self.thread.start()
+
+  # Attributes
+  filepath = cbytes = ubytes = stop = t0 = queue = thread = None
+
+  # Methods
+  # Decompresses file into the queue (None: end of file; exception: error)
+  def _decompress(self, chunksize):
+    try:
+      with open(self.filepath, 'rb') as fh:
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        while not self.stop:
+          data = fh.read(chunksize)
+          if data == '':
+            break
+          self.cbytes += len(data)
+          while data != '':
+            out = d.decompress(data)
+            data = d.unused_data
+            if data != '': #next gzip member
+              d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            if out != '':
+              self.ubytes += len(out)
+              self.queue.put(out)
+      fh.close()
+      self.queue.put(None)
+    except Exception as exc:
+      self.queue.put(exc)
+
+  def __iter__(self):
+    rest = ''
+    while True:
+      block = self.queue.get()
+      if block is None:
+        break
+      if isinstance(block, Exception):
+        raise block
+      lines = (rest + block).split('\n')
+      rest = lines.pop()
+      for line in lines:
+        yield line + '\n'
+    if rest != '':
+      yield rest
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def close(self):
+    if self.thread is None:
+      return
+    self.stop = True
+    while self.thread.is_alive(): #unblock the decompression thread
+      try:
+        self.queue.get(timeout=0.1)
+      except Empty:
+        pass
+    self.thread = None
+    t = max(time.time() - self.t0, 1e-6)
+    print 'Decompressed ' + str(round(self.cbytes / 1e6, 1)) + ' MB to ' + \
+          str(round(self.ubytes / 1e6, 1)) + ' MB in ' + str(round(t, 1)) + \
+          ' s (' + str(round(self.ubytes / 1e6 / t, 1)) + ' MB/s)'
+
+###############################################################################
+# Returns line iterable of a (possibly gzip-compressed) input file
+###############################################################################
+def open_input(filepath):
+  if gzip_type(filepath) is not None:
+    return _GzipReader(filepath)
+  return open(filepath, 'rb')
+
+###############################################################################
+# Returns block index of a BGZF file: lists of compressed and uncompressed 
+# offsets of its blocks. The index is cached in <file>.gzi (bgzip format) if 
+# possible; otherwise it is built from the block headers without decompression.
+###############################################################################
+@profiled
+def fetch_gzi(bgzf_fn):
+  gzi_fn = bgzf_fn + '.gzi'
+  coffsets = [0]
+  uoffsets = [0]
+  if os.path.exists(gzi_fn) and \
+     os.path.getmtime(gzi_fn) >= os.path.getmtime(bgzf_fn):
+    with open(gzi_fn, 'rb') as fh:
+      n = struct.unpack('<Q', fh.read(8))[0]
+      pairs = struct.unpack('<' + str(2 * n) + 'Q', fh.read(16 * n))
+    fh.close()
+    return coffsets + list(pairs[0::2]), uoffsets + list(pairs[1::2])
+  
+  print 'Indexing BGZF blocks ...'
+  with open(bgzf_fn, 'rb') as fh:
+    while True:
+      head = fh.read(12)
+      if len(head) < 12:
+        break
+      extra = fh.read(struct.unpack('<H', head[10:12])[0])
+      bsize = None
+      i = 0
+      while i + 4 <= len(extra):
+        slen = struct.unpack('<H', extra[i+2:i+4])[0]
+        if extra[i:i+2] == 'BC':
+          bsize = struct.unpack('<H', extra[i+4:i+6])[0] + 1
+        i += 4 + slen
+      if bsize is None:
+        raise ValueError(bgzf_fn + ' is not a BGZF file')
+      fh.seek(coffsets[-1] + bsize - 4)
+      isize = struct.unpack('<I', fh.read(4))[0]
+      coffsets.append(coffsets[-1] + bsize)
+      uoffsets.append(uoffsets[-1] + isize)
+  fh.close()
+  coffsets.pop() #offsets of the end of file
+  uoffsets.pop()
+  try:
+    with open(gzi_fn, 'wb') as fh:
+      fh.write(struct.pack('<Q', len(coffsets) - 1))
+      for i in range(1, len(coffsets)):
+        fh.write(struct.pack('<QQ', coffsets[i], uoffsets[i]))
+    fh.close()
+  except IOError: #e.g. read-only directory
+    pass
+  return coffsets, uoffsets
+
+###############################################################################
+# Private random access to the uncompressed content of a BGZF file by slicing
+# (buf[a:b]); only the blocks overlapping the slice are decompressed
+###############################################################################
+class _BgzfBuffer:
+  # Constructor
+  def __init__(self, fh, gzi):
+    self.fh = fh
+    self.coffsets, self.uoffsets = gzi
+    self.cend = os.fstat(fh.fileno()).st_size
+    self.blocks = {}
+
+  # Attributes
+  fh = coffsets = uoffsets = cend = blocks = None
+
+  # Methods
+  # Returns uncompressed data of block i
+  def _block(self, i):
+    if i not in self.blocks:
+      if len(self.blocks) >= 64:
+        self.blocks.clear()
+      self.fh.seek(self.coffsets[i])
+      end = self.coffsets[i+1] if i + 1 < len(self.coffsets) else self.cend
+      raw = self.fh.read(end - self.coffsets[i])
+      xlen = struct.unpack('<H', raw[10:12])[0]
+      self.blocks[i] = zlib.decompress(raw[12+xlen:-8], -zlib.MAX_WBITS)
+    return self.blocks[i]
+
+  def __getitem__(self, key):
+    start, stop = key.start, key.stop
+    i = bisect_right(self.uoffsets, start) - 1
+    base = self.uoffsets[i]
+    parts = list()
+    pos = base
+    while pos < stop and i < len(self.coffsets):
+      parts.append(self._block(i))
+      pos += len(parts[-1])
+      i += 1
+    return ''.join(parts)[start-base:stop-base]
+
+###############################################################################
+# Returns value of the last ';'-preceded attribute with one of keys in the 
+# (stripped) GFF line; None if there is none
+###############################################################################
+def _gff_attribute(line, keys):
+  start = -1
+  for k in keys:
+    i = line.rfind(';' + k + '=')
+    if i >= 0 and i + len(k) + 2 > start:
+      start = i + len(k) + 2
+  if start < 0:
+    return None
+  end = line.find(';', start)
+  value = line[start:end] if end >= 0 else line[start:]
+  return value if value != '' else None
+
+###############################################################################
+# Generate exon coodinate file for each transcript; the (possibly gzip-
+# compressed) GFF file is streamed and the exon coordinates are grouped per
+# transcript as they arrive
+###############################################################################
+@profiled
 def write_exonFile(gff_fn, out_fn):
   print "Extracting exon info..."
-  txs2elow = {}
-  txs2eup = {}
-  txs2strand = {}
-  txs2chrom = {}
-  txs2name = {}
+  txs = {} #tx_id -> [strand, chrom, name, elow (array), eup (array)]
   lcount = 0
-  pid = re.compile('.*;transcript_id=(.+?);') #transcript_id=(.+);?
-  pname = re.compile('.*;gene(?:_name)?=(.+?);')
-  pname2 = re.compile('.*;gene(?:_id)?=(.+?);')
-  #pname2 = re.compile('.*gene_id=(.+);?)
-  with open(gff_fn) as fh:
+  t0 = time.time()
+  with open_input(gff_fn) as fh:
     for line in fh:
       if line.startswith('#'):
         continue
       lcount = lcount + 1
-      ldata = line.split('\t')
-      line = line.strip() + ";"
+      ldata = line.split('\t', 3)
       if ldata[2] == 'exon':
-        tx_id = pid.match(line)
+        attrs = line.strip()
+        tx_id = _gff_attribute(attrs, ('transcript_id',))
         if tx_id is None:
           continue
-        tx_id = tx_id.group(1)
-        tx_name = pname.match(line).group(1)
-        if tx_name is None:
-          tx_name = pname2.match(line).group(1)
-        #tx_id = findall('transcript_id=(.+);?|$', line)[0]
-        #tx_name = findall('gene=(.+?);?|$', line)[0]
-        #if tx_name == '':
-        #tx_name = findall('gene_id=(.+?);?|$', line)[0]
-        chrom = ldata[0]
+        ldata = line.split('\t')
         elow = int(ldata[3])
         eup = int(ldata[4])
-        strand = ldata[6]
-        if tx_id in txs2name:
-          txs2elow[tx_id].append(elow)
-          txs2eup[tx_id].append(eup)
+        if tx_id in txs:
+          tx = txs[tx_id]
+          tx[3].append(elow)
+          tx[4].append(eup)
         else:
-          txs2elow[tx_id] = [elow]
-          txs2eup[tx_id] = [eup]
-          txs2strand[tx_id] = strand
-          txs2chrom[tx_id] = chrom
-          txs2name[tx_id] = tx_name
+          tx_name = _gff_attribute(attrs, ('gene', 'gene_name'))
+          if tx_name is None:
+            tx_name = _gff_attribute(attrs, ('gene_id',))
+          txs[tx_id] = [ldata[6], ldata[0], tx_name, 
+                        array('l', [elow]), array('l', [eup])]
       if lcount % 500000 == 0:
-        print "Processed " + str(lcount) + " lines ..."
+        print "Processed " + str(lcount) + " lines (" + \
+              str(int(lcount / (time.time() - t0))) + " lines/s) ..."
   fh.close()
-  
-  print "Calculating exon lengths ..."
-  txs2elen = {}
-  for tx_id in txs2name.keys():
-    strand = txs2strand[tx_id]
-    txs2elow[tx_id].sort(reverse=(strand == "-"))
-    txs2eup[tx_id].sort(reverse=(strand == "-"))
-    if strand == "-":
-      starts = txs2eup[tx_id]
-      ends = [-x for x in txs2elow[tx_id]]
-    else:
-      starts = [-x for x in txs2elow[tx_id]]
-      ends = txs2eup[tx_id]
-    txs2elen[tx_id] = [sum(x)+1 for x in zip(starts, ends)]
+  print "Processed " + str(lcount) + " lines in " + \
+        str(round(time.time() - t0, 1)) + " s"
   
   print "Writing exon file ..."
   with open(out_fn, "w") as fh:
-    for tx_id in txs2name.keys():
-      elow = txs2elow[tx_id]
-      elow = str(elow).replace('[', '').replace(']', '').replace(' ', '')
-      eup = txs2eup[tx_id]
-      eup = str(eup).replace('[', '').replace(']', '').replace(' ', '')
-      elen = txs2elen[tx_id]
-      elen = str(elen).replace('[', '').replace(']', '').replace(' ', '')
-      strand = txs2strand[tx_id]
-      chrom = txs2chrom[tx_id]
-      name = txs2name[tx_id]
+    for tx_id in txs.keys():
+      strand, chrom, name, elow, eup = txs[tx_id]
+      elow = sorted(elow, reverse=(strand == "-"))
+      eup = sorted(eup, reverse=(strand == "-"))
+      elen = [eup[i] - elow[i] + 1 for i in range(len(elow))]
       fh.write(tx_id + '\t' + '"' + name + '"' + '\t' + chrom + '\t' +
-               strand + '\t' + elow + '\t' + eup + '\t' + elen + '\n')
+               strand + '\t' + ','.join(map(str, elow)) + '\t' + 
+               ','.join(map(str, eup)) + '\t' + ','.join(map(str, elen)) + '\n')
   fh.close()
 
 ###############################################################################
-# Generate fasta sequence file for each transcript
+# Returns faidx-style index of a FASTA file: list of records [name, length, 
+# offset, linebases, linewidth, end] in file order (name as the first 
+# space-separated word of the header; end: offset of the next header). 
+# linebases is 0 for records with irregular line lengths. Only uncompressed 
+# and BGZF-compressed files can be indexed (offsets of the latter refer to the
+# uncompressed content, as in samtools). An up-to-date <fasta>.fai (e.g. of 
+# samtools faidx) is used; otherwise the index is cached in fai_fn (if given;
+# faidx format with the stamp of the FASTA file as header), so that the 
+# directory of the input file is never written to.
 ###############################################################################
-def write_sequenceFile(genomeSeq_fn, exon_fn, out_fn):
-  print 'Writing sequence file ...'
-  def einfo(eline, cseq):
-    eseq = ''
-    edat = eline.split("\t")
-    txid = edat[0]
-    txname = edat[1]
-    strand = edat[3]
-    elow = edat[4].split(",")
-    eup = edat[5].split(",")
-    for i in range(len(elow)):
-      s_from = int(elow[i])
-      s_to = int(eup[i])
-      if strand == '-': #minus strand
-        eseq = eseq + cseq[s_to-1:s_from-2:-1]
-      else: #plus strand
-        eseq = eseq + cseq[s_from-1:s_to:1]
-    if strand == '-':
-      eseq = compl(eseq)
-    return txid, txname, eseq
+@profiled
+def fetch_faidx(fasta_fn, fai_fn=None):
+  if gzip_type(fasta_fn) == 'gzip':
+    raise ValueError(fasta_fn + ' is gzip-compressed; only uncompressed ' + \
+                     'or BGZF-compressed files can be indexed')
+  stamp = '#genome=' + file_stamp(fasta_fn) + '\n'
+  records = None
+  if os.path.exists(fasta_fn + '.fai') and \
+     os.path.getmtime(fasta_fn + '.fai') >= os.path.getmtime(fasta_fn):
+    with open(fasta_fn + '.fai') as fh:
+      records = [line.rstrip('\n').split('\t')[:5] for line in fh]
+    fh.close()
+  elif fai_fn is not None and os.path.exists(fai_fn):
+    with open(fai_fn) as fh:
+      if fh.readline() == stamp:
+        records = [line.rstrip('\n').split('\t')[:5] for line in fh]
+    fh.close()
+  if records is not None:
+    return [[x[0]] + map(int, x[1:5]) + [None] for x in records]
+  
+  print 'Indexing genome sequence file ...'
+  records = list()
+  rec = None
+  with open_input(fasta_fn) as fh:
+    offset = 0
+    short = False #line shorter than linebases seen
+    for line in fh:
+      if line.startswith('>'):
+        if rec is not None:
+          rec[5] = offset
+        rec = [line.strip()[1:].split(' ')[0], 0, offset + len(line), -1, -1, None]
+        records.append(rec)
+        short = False
+      elif rec is not None:
+        lseq = line.strip()
+        lb = len(lseq)
+        rec[1] += lb
+        if rec[3] == 0: #irregular
+          pass
+        elif lseq != line.rstrip('\r\n') or (lb > 0 and short):
+          rec[3] = 0
+        elif lb == 0 or (rec[3] > 0 and lb < rec[3]): #last line
+          short = True
+        elif rec[3] == -1: #first line
+          rec[3] = lb
+          rec[4] = len(line)
+        elif lb > rec[3] or len(line) != rec[4]:
+          rec[3] = 0
+      offset += len(line)
+    if rec is not None:
+      rec[5] = offset
+  fh.close()
+  if fai_fn is not None and \
+     all([x[3] != 0 and '\t' not in x[0] for x in records]):
+    try:
+      with open(fai_fn, 'w') as fh:
+        fh.write(stamp)
+        for x in records:
+          fh.write('\t'.join(map(str, x[:5])) + '\n')
+      fh.close()
+    except IOError: #e.g. missing directory
+      pass
+  return records
+
+###############################################################################
+# Private sequence of a FASTA record, sliced from the (memory-mapped) file
+# or from a buffer holding the lines of the record
+###############################################################################
+class _FastaRecord:
+  # Constructor
+  def __init__(self, buf, rec):
+    self.name, self.length, self.offset, self.lb, self.lw = rec[:5]
+    self.buf = buf
+    self.seq = None
+    if self.length == 0:
+      self.seq = ''
+    elif self.lb == 0: #irregular lines: load sequence
+      lines = buf[self.offset:rec[5]].split('\n')
+      self.seq = ''.join([x.strip() for x in lines])
+  
+  def __len__(self):
+    return self.length
 
+  # Returns sequence [a, b) (0-based)
+  def fetch(self, a, b):
+    if b <= a:
+      return ''
+    if self.seq is not None:
+      return self.seq[a:b]
+    s = self.offset + (a // self.lb) * self.lw + a % self.lb
+    e = self.offset + ((b - 1) // self.lb) * self.lw + (b - 1) % self.lb + 1
+    return self.buf[s:e].replace('\n', '').replace('\r', '')
+
+###############################################################################
+# Returns transcript id, name and sequence of exon file line
+###############################################################################
+def _einfo(eline, cseq):
+  edat = eline.split("\t")
+  txid = edat[0]
+  txname = edat[1]
+  strand = edat[3]
+  elow = edat[4].split(",")
+  eup = edat[5].split(",")
+  parts = list()
+  for i in range(len(elow)):
+    s_from = int(elow[i])
+    s_to = int(eup[i])
+    if strand == '-': #minus strand; as cseq[s_to-1:s_from-2:-1]
+      start, stop, step = slice(s_to-1, s_from-2, -1).indices(len(cseq))
+      parts.append(cseq.fetch(stop+1, start+1)[::-1])
+    else: #plus strand; as cseq[s_from-1:s_to:1]
+      start, stop, step = slice(s_from-1, s_to, 1).indices(len(cseq))
+      parts.append(cseq.fetch(start, stop))
+  eseq = ''.join(parts)
+  if strand == '-':
+    eseq = compl(eseq)
+  return txid, txname, eseq
+
+###############################################################################
+# Returns dict genome record (chromosome) -> exon file lines
+###############################################################################
+def _exon_lines(exon_fn):
   chr2info = {}
   with open(exon_fn) as fh:
     for line in fh:
@@ -142,37 +444,327 @@ def write_sequenceFile(genomeSeq_fn, exon_fn, out_fn):
       else:
         chr2info[chrom] = [line]
   fh.close()
+  return chr2info
+
+###############################################################################
+# Returns extraction tasks (genome file, genome record, exon file lines, 
+# BGZF block index or None) in output order, i.e. by genome record (faidx
+# records) and then by exon file line
+###############################################################################
+def _sequence_tasks(genomeSeq_fn, exon_fn, records):
+  chr2info = _exon_lines(exon_fn)
+  gzi = None
+  if gzip_type(genomeSeq_fn) == 'bgzf':
+    gzi = fetch_gzi(genomeSeq_fn)
+  return [(genomeSeq_fn, rec, chr2info[rec[0]], gzi) for rec in records 
+          if rec[0] in chr2info]
+
+###############################################################################
+# Returns FASTA entries of the transcripts of one genome record (chromosome)
+###############################################################################
+def _extract_chrom(task):
+  genomeSeq_fn, rec, elines, gzi = task
+  out = list()
+  with open(genomeSeq_fn, 'rb') as fin:
+    buf = ''
+    if gzi is not None:
+      buf = _BgzfBuffer(fin, gzi)
+    elif os.path.getsize(genomeSeq_fn) > 0:
+      buf = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+    cseq = _FastaRecord(buf, rec)
+    for eline in elines:
+      txid, txname, eseq = _einfo(eline, cseq)
+      out.append('>' + txid + '|' + txname + '\n' + eseq + '\n')
+  fin.close()
+  return ''.join(out)
+
+###############################################################################
+# Writes FASTA entries of the transcripts to fout while streaming a gzip-
+# compressed genome file (no random access); only one genome record is held
+# in memory at a time. Returns the names of the genome records in file order.
+###############################################################################
+def _stream_extract(genomeSeq_fn, exon_fn, fout):
+  chr2info = _exon_lines(exon_fn)
+  
+  def extract(name, lines):
+    buf = ''.join(lines)
+    length = sum([len(x.strip()) for x in lines])
+    cseq = _FastaRecord(buf, [name, length, 0, 0, 0, len(buf)])
+    for eline in chr2info[name]:
+      txid, txname, eseq = _einfo(eline, cseq)
+      fout.write('>' + txid + '|' + txname + '\n' + eseq + '\n')
+  
+  names = list()
+  name = lines = None
+  with open_input(genomeSeq_fn) as fh:
+    for line in fh:
+      if line.startswith('>'):
+        if lines is not None:
+          extract(name, lines)
+        name = line.strip()[1:].split(' ')[0]
+        names.append(name)
+        lines = list() if name in chr2info else None
+      elif lines is not None:
+        lines.append(line)
+    if lines is not None:
+      extract(name, lines)
+  fh.close()
+  return names
+
+###############################################################################
+# Generate fasta sequence file for each transcript; exon sequences are sliced
+# from the memory-mapped (or BGZF-compressed) genome file using its faidx-
+# style index. With jobs > 1, chromosomes are extracted in a pool of worker 
+# processes and written in genome file order. Genome files compressed with 
+# plain gzip are streamed instead. fai_fn: cache of the faidx-style index (see
+# fetch_faidx). Returns the names of the genome records in file order.
+###############################################################################
+@profiled
+def write_sequenceFile(genomeSeq_fn, exon_fn, out_fn, jobs=1, fai_fn=None):
+  print 'Writing sequence file ...'
+  if gzip_type(genomeSeq_fn) == 'gzip':
+    with open(out_fn, 'w') as fout:
+      names = _stream_extract(genomeSeq_fn, exon_fn, fout)
+    fout.close()
+    return names
+  records = fetch_faidx(genomeSeq_fn, fai_fn)
+  tasks = _sequence_tasks(genomeSeq_fn, exon_fn, records)
+  with open(out_fn, 'w') as fout:
+    if jobs <= 1:
+      for task in tasks:
+        fout.write(_extract_chrom(task))
+    else:
+      pool = Pool(processes=jobs)
+      try:
+        for entries in pool.imap(_extract_chrom, tasks):
+          fout.write(entries)
+        pool.close()
+      except:
+        pool.terminate()
+        raise
+      finally:
+        pool.join()
+  fout.close()
+  return [x[0] for x in records]
+
+###############################################################################
+# Returns dict transcript id -> byte offset of its entry in a sequence file
+###############################################################################
+def _fasta_offsets(txSeq_fn):
+  tx2offset = {}
+  with open(txSeq_fn, 'rb') as fh:
+    offset = 0
+    for line in fh:
+      if line.startswith('>'):
+        txid = line[1:].split('|')[0]
+        if txid not in tx2offset:
+          tx2offset[txid] = offset
+      offset += len(line)
+  fh.close()
+  return tx2offset
 
-  chrom = None
-  cseq = ''
-  with open(out_fn, 'w') as fout, open(genomeSeq_fn) as fin:
+###############################################################################
+# Generate manifest of the database content: stamp of the genome file and 
+# per transcript the MD5 hashes of its exon file line and sequence file entry
+###############################################################################
+@profiled
+def write_manifest(genomeSeq_fn, exon_fn, txSeq_fn, out_fn):
+  print 'Writing manifest ...'
+  tx2entry = {}
+  with open(txSeq_fn, 'rb') as fh:
+    for line in fh:
+      if line.startswith('>'):
+        txid = line[1:].split('|')[0]
+        entry = line + fh.next()
+        if txid not in tx2entry:
+          tx2entry[txid] = hashlib.md5(entry).hexdigest()
+  fh.close()
+  with open(exon_fn, 'rb') as fin, open(out_fn, 'w') as fout:
+    fout.write('#genome=' + file_stamp(genomeSeq_fn) + '\n')
     for line in fin:
-      line = line.strip()
-      if line.startswith(">") and chrom is not None:
-        if chrom in chr2info:
-          for eline in chr2info[chrom]:
-            txid, txname, eseq = einfo(eline, cseq)
-            fout.write('>' + txid + '|' + txname + '\n' + eseq + '\n')
-        #reset
-        cseq = ''
-        chrom = line[1:].split(" ")[0]
-      elif line.startswith(">") and chrom is None:
-        chrom = line[1:].split(" ")[0]
-      else:
-        cseq += line.strip()
-    if chrom in chr2info: #last chr seq
-      for eline in chr2info[chrom]:
-        txid, txname, eseq = einfo(eline, cseq)
-        fout.write('>' + txid + '|' + txname + '\n' + eseq + '\n')
+      txid = line.split('\t')[0]
+      fout.write(txid + '\t' + hashlib.md5(line).hexdigest() + '\t' + 
+                 tx2entry.get(txid, '') + '\n')
   fin.close()
   fout.close()
 
+###############################################################################
+# Returns genome stamp and dict transcript id -> (exon hash, sequence hash) 
+# of a manifest
+###############################################################################
+def read_manifest(manifest_fn):
+  tx2hash = {}
+  with open(manifest_fn) as fh:
+    stamp = fh.readline().strip().split('=', 1)[1]
+    for line in fh:
+      mdat = line.rstrip('\n').split('\t')
+      tx2hash[mdat[0]] = (mdat[1], mdat[2])
+  fh.close()
+  return stamp, tx2hash
+
+###############################################################################
+# Update fasta sequence file: only transcripts with new or changed exon lines
+# (all, if the genome file changed) are extracted from the genome, all other 
+# entries are copied from the current sequence file; the entry order equals
+# the one of write_sequenceFile (the genome is read only once, also if it is
+# gzip-compressed). Returns True if the file content changed; otherwise the 
+# current file is kept as it is (stamp unchanged).
+###############################################################################
+@profiled
+def update_sequenceFile(genomeSeq_fn, exon_fn, txSeq_fn, manifest_fn, jobs=1,
+                        fai_fn=None):
+  print 'Updating sequence file ...'
+  stamp, tx2hash = read_manifest(manifest_fn)
+  genome_changed = stamp != file_stamp(genomeSeq_fn)
+  changed_fn = txSeq_fn + '.changed'
+  n_changed = 0
+  with open(exon_fn, 'rb') as fin, open(changed_fn + '.exons', 'w') as fout:
+    for line in fin:
+      txid = line.split('\t')[0]
+      if genome_changed or txid not in tx2hash or \
+         tx2hash[txid][0] != hashlib.md5(line).hexdigest():
+        fout.write(line)
+        n_changed += 1
+  fin.close()
+  fout.close()
+  print 'Extracting ' + str(n_changed) + ' new or changed transcripts ...'
+  names = write_sequenceFile(genomeSeq_fn, changed_fn + '.exons', changed_fn,
+                             jobs, fai_fn)
+  
+  tx2new = {}
+  with open(changed_fn) as fh:
+    for line in fh:
+      txid = line[1:].split('|')[0]
+      tx2new[txid] = line + fh.next()
+  fh.close()
+  tx2offset = _fasta_offsets(txSeq_fn)
+  content_changed = False
+  n_entries = 0
+  last = -1 #offset of the previous entry in the current file
+  chr2info = _exon_lines(exon_fn)
+  with open(txSeq_fn, 'rb') as fold, open(changed_fn, 'w') as fout:
+    for name in names:
+      for eline in chr2info.get(name, []):
+        txid = eline.split('\t')[0]
+        if txid in tx2new:
+          entry = tx2new[txid]
+        else:
+          fold.seek(tx2offset[txid])
+          entry = fold.readline() + fold.readline()
+        if tx2hash.get(txid, ('', ''))[1] != hashlib.md5(entry).hexdigest():
+          content_changed = True
+        if tx2offset.get(txid, -1) < last: #new or moved entry
+          content_changed = True
+        last = tx2offset.get(txid, -1)
+        fout.write(entry)
+        n_entries += 1
+  fold.close()
+  fout.close()
+  if n_entries != len([x for x in tx2hash.values() if x[1] != '']):
+    content_changed = True #removed transcripts
+  if content_changed:
+    os.rename(changed_fn, txSeq_fn)
+  else: #keep the file, so that the stamps of the indexes remain valid
+    os.remove(changed_fn)
+  os.remove(changed_fn + '.exons')
+  return content_changed
+
+###############################################################################
+# Generate index file with byte offsets of each (version-stripped) transcript 
+# id in the sequence and exon file; the header holds the stamps of both files
+###############################################################################
+@profiled
+def write_indexFile(txSeq_fn, exon_fn, out_fn):
+  print 'Writing index file ...'
+  tx2offset = {}
+  txids = list()
+  with open(txSeq_fn, 'rb') as fh:
+    offset = 0
+    for line in fh:
+      if line.startswith('>'):
+        txid = line[1:].split('|')[0].split('.')[0]
+        if txid not in tx2offset:
+          tx2offset[txid] = [offset, -1]
+          txids.append(txid)
+      offset += len(line)
+  fh.close()
+  with open(exon_fn, 'rb') as fh:
+    offset = 0
+    for line in fh:
+      txid = line.split('\t')[0].split('.')[0]
+      if txid not in tx2offset:
+        tx2offset[txid] = [-1, offset]
+        txids.append(txid)
+      elif tx2offset[txid][1] < 0:
+        tx2offset[txid][1] = offset
+      offset += len(line)
+  fh.close()
+  with open(out_fn, 'w') as fh:
+    fh.write('#fna=' + file_stamp(txSeq_fn) + '\t' + 
+             'exons=' + file_stamp(exon_fn) + '\n')
+    for txid in txids:
+      fh.write(txid + '\t' + str(tx2offset[txid][0]) + '\t' + 
+               str(tx2offset[txid][1]) + '\n')
+  fh.close()
+
+###############################################################################
+# Generate k-mer index of the transcript sequences (sorted canonical k-mers 
+# with transcript ordinals as memory-mappable .npy files; transcript headers 
+# and sequence file offsets in the .kmerids file)
+###############################################################################
+@profiled
+def write_kmerIndex(txSeq_fn, kmer_fn):
+  print 'Building k-mer index ...'
+  if np is None:
+    print 'NumPy is not available; skipping k-mer index.'
+    return
+  t0 = time.time()
+  kmers = list()
+  txs = list()
+  headers = list()
+  offsets = list()
+  with open(txSeq_fn, 'rb') as fh:
+    offset = 0
+    for line in fh:
+      if line.startswith('>'):
+        header = line[1:].split()[0]
+        hoffset = offset
+      else:
+        km = np.unique(kmers_canonical(line.strip()))
+        kmers.append(km)
+        txs.append(np.full(len(km), len(headers), dtype=np.uint32))
+        headers.append(header)
+        offsets.append(hoffset)
+      offset += len(line)
+  fh.close()
+  kmers = np.concatenate(kmers) if len(kmers) > 0 else np.zeros(0, dtype=np.uint64)
+  txs = np.concatenate(txs) if len(txs) > 0 else np.zeros(0, dtype=np.uint32)
+  order = np.argsort(kmers, kind='mergesort') #stable: ordinals stay sorted
+  np.save(kmer_fn + '.kmers.npy', kmers[order])
+  np.save(kmer_fn + '.kmertx.npy', txs[order])
+  with open(kmer_fn + '.kmerids', 'w') as fh:
+    fh.write('#' + file_stamp(txSeq_fn) + '\n')
+    for i in range(len(headers)):
+      fh.write(headers[i] + '\t' + str(offsets[i]) + '\n')
+  fh.close()
+  size = sum([os.path.getsize(kmer_fn + x) for x in 
+              ['.kmers.npy', '.kmertx.npy', '.kmerids']])
+  print 'K-mer index: ' + str(len(kmers)) + ' k-mers of ' + \
+        str(len(headers)) + ' transcripts, ' + \
+        str(round(size / 1048576.0, 1)) + ' MB, built in ' + \
+        str(round(time.time() - t0, 1)) + ' s'
+
 ###############################################################################
 # Generate BLAST+ database
+# (returns the running makeblastdb process if wait is False)
 ###############################################################################
-def generate_BLASTdb(blastdb, txSeq_fn):
+@profiled
+def generate_BLASTdb(blastdb, txSeq_fn, wait=True):
   print 'Generating BLAST+ database ...'
-  exe = get_script_path() + "/tools/ncbi-blast/bin/makeblastdb "
+  exe = get_tool_path() + "/ncbi-blast/bin/makeblastdb "
   cmd = exe + ' -in ' + txSeq_fn + ' -dbtype nucl ' + ' -out ' + blastdb
   devnull = open(os.devnull, 'w')
+  count('subprocesses')
+  if not wait:
+    return Popen([cmd], shell=True)
   call([cmd], shell=True)#, stdout=devnull, stderr=devnull)
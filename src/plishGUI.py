@@ -4,52 +4,149 @@
 # written by Daniel C. Ellwanger <dcellwanger.dev@gmail.com>
 # last modified Jul 3 2018
 ###############################################################################
-import os, tkMessageBox
-from plishMain import main
-from plishUtils import get_script_path, filter_probes, write_probesCSV, write_probesFNA
+import os, time, threading, tkMessageBox, tkFileDialog, tkSimpleDialog
+from Queue import Queue, Empty
+from plishMain import main, session_info, check_session, filter_and_pick
+from plishSession import write_session, read_session
+from plishUtils import get_script_path, filter_defaults
+from plishUtils import write_probesCSV, write_probesFNA, show_log, show_txt
+from plishUtils import Cancelled, cancel_run, reset_cancel
 from Tkinter import Label, Listbox, Button, Entry, Text, StringVar, OptionMenu
 from Tkinter import mainloop, PhotoImage, IntVar, BooleanVar, DoubleVar
-from Tkinter import PanedWindow, LabelFrame, Checkbutton
-from Tkinter import DISABLED, NORMAL, END, W, N, E, LEFT, VERTICAL
+from Tkinter import PanedWindow, LabelFrame, Checkbutton, TclError
+from Tkinter import DISABLED, NORMAL, END, W, N, E, S, LEFT, VERTICAL
 
 # Version and default values
-_defaultGC = 45
-_defaultMultiExon = True
-_defaultMinTm = 55
-_defaultMaxTm = 65
-_defaultMinDimer = -10
-_defaultMinFold = -10
-_defaultMaxDuplex = -30
+_defaultGC = filter_defaults['mingc']
+_defaultSpec = filter_defaults['spec']
+_defaultMultiExon = filter_defaults['multiexon']
+_defaultMinTm = filter_defaults['mintm']
+_defaultMaxTm = filter_defaults['maxtm']
+_defaultMinDimer = filter_defaults['mindimer']
+_defaultMinFold = filter_defaults['minfold']
+_defaultMaxDuplex = filter_defaults['maxduplex']
+_defaultJobs = 1
+_defaultSpacing = 0
+_defaultMaxProbes = 0 #no limit
+_pollInterval = 100 #ms
 
 ###############################################################################
 # Container
 ###############################################################################
 class GUI:
+  # Returns the value of the variable name of an entry; raises ValueError with
+  # the label of the entry if its text is not a number
+  def _entry(self, name):
+    var = getattr(self, name)
+    try:
+      return var.get()
+    except (TclError, ValueError):
+      kind = 'an integer' if isinstance(var, IntVar) else 'a number'
+      raise ValueError(getattr(self, name + 'Lbl').cget('text') + ' must be ' + kind)
+
   def _run(self):
-    self.saveBtn.config(state=DISABLED)
     self.progressTxt.config(state=NORMAL)
     self.progressTxt.delete('1.0', END)
     self.progressTxt.update()
     self.progressTxt.config(state=DISABLED)
+    try:
+      jobs = max(1, self._entry('jobs'))
+    except ValueError as exc:
+      show_log('ERROR: ' + str(exc) + '.', self.progressTxt)
+      return
+    self.saveBtn.config(state=DISABLED)
     inputId = self.txEntry.get()
     item = map(int, self.dbLbox.curselection())
     db = self.dbids[item[0]]
     self.runBtn.config(state=DISABLED)
-    self.inputId, self.inputName, self.hprobes = main(inputId, db, debug=self.debug, txt=self.progressTxt)
-    self.runBtn.config(state=NORMAL)
-    if self.hprobes is not None:
-      self.saveBtn.config(state=NORMAL)
+    self.cancelBtn.config(state=NORMAL)
+    self.sessionSaveBtn.config(state=DISABLED)
+    self.sessionOpenBtn.config(state=DISABLED)
+    self.db = db
+    self.hprobes = None
+    reset_cancel()
+    self.queue = Queue()
+    self.stageStart = time.time()
+    self.worker = threading.Thread(target=self._work, 
+                                   args=(inputId, db, jobs, self.kmer.get()))
+    self.worker.daemon = True
+    self.worker.start()
+    self.master.after(_pollInterval, self._poll)
+  
+  # Runs the pipeline in the worker thread; the events (log lines, progress,
+  # result) are sent to the Tk main loop through the queue
+  def _work(self, inputId, db, jobs, kmer):
+    try:
+      result = main(inputId, db, debug=self.debug, txt=self.queue, jobs=jobs,
+                    kmer=kmer)
+      self.queue.put(('done', result))
+    except Cancelled:
+      self.queue.put(('cancelled',))
+    except Exception as exc:
+      self.queue.put(('error', str(exc)))
+  
+  # Processes the events of the worker thread
+  def _poll(self):
+    while True:
+      try:
+        event = self.queue.get_nowait()
+      except Empty:
+        break
+      if event[0] == 'log':
+        if event[1].startswith('Step'):
+          self.stageStart = time.time()
+          self.statusLbl.config(text='')
+        show_txt(event[1], self.progressTxt)
+      elif event[0] == 'progress':
+        done, total = event[1:]
+        eta = (time.time() - self.stageStart) * (total - done) / done
+        self.statusLbl.config(text=str(done) + '/' + str(total) + '\nETA ' + 
+                              time.strftime('%M:%S', time.gmtime(eta)))
+      else:
+        if event[0] == 'done':
+          self.inputId, self.inputName, self.hprobes = event[1]
+          self.sessionInfo = session_info(self.db)
+        elif event[0] == 'cancelled':
+          show_log('Cancelled.', self.progressTxt)
+        else:
+          show_log('ERROR: ' + event[1], self.progressTxt)
+        self.statusLbl.config(text='')
+        self.runBtn.config(state=NORMAL)
+        self.cancelBtn.config(state=DISABLED)
+        self.sessionOpenBtn.config(state=NORMAL)
+        if self.hprobes is not None:
+          self.saveBtn.config(state=NORMAL)
+          self.sessionSaveBtn.config(state=NORMAL)
+        self.worker = None
+        return
+    self.master.after(_pollInterval, self._poll)
+  
+  def _cancel(self):
+    self.cancelBtn.config(state=DISABLED)
+    show_log('Cancelling ...', self.progressTxt)
+    cancel_run()
     
   def _quitGUI(self):
     #rpath = self.progressTxt.get('8.0','end-1c')
     #if rpath.startswith('Your results'):
     #  tkMessageBox.showinfo("Quit", self.progressTxt.get('8.0','end-1c'))
+    if self.worker is not None:
+      cancel_run()
+      self.worker.join()
     self.master.destroy()
     
   def _save(self):
-    hps = filter_probes(self.hprobes, self.spec.get(), self.mingc.get(), 
-                        self.multiexon.get(), self.mintm.get(), self.maxtm.get(),
-                        self.mindimer.get(), self.minfold.get(), self.maxduplex.get())
+    try:
+      filters = dict((x, self._entry(x)) for x in filter_defaults.keys())
+      pick = None
+      if self.pick.get():
+        maxn = self._entry('maxprobes')
+        pick = { 'spacing' : max(0, self._entry('spacing')), 
+                 'maxn' : maxn if maxn > 0 else None }
+    except ValueError as exc:
+      show_log('ERROR: ' + str(exc) + '.', self.progressTxt)
+      return
+    hps = filter_and_pick(self.hprobes, filters, pick, self.progressTxt)
     result_csv = write_probesCSV(self.inputId, self.inputName, hps, self.progressTxt)
     result_fna = write_probesFNA(self.inputId, self.inputName, hps, self.progressTxt)
     tkMessageBox.showinfo('Result file', 
@@ -60,9 +157,69 @@ class GUI:
                           ' hybridization probe(s) were exported to ' + \
                           result_fna)
                           
+  # Saves the features of all candidates of the current transcript
+  def _saveSession(self):
+    fn = tkFileDialog.asksaveasfilename(initialdir=get_script_path() + '/results',
+                                        initialfile=self.inputName.replace('"', '') + 
+                                        '-' + self.inputId + '.plish',
+                                        defaultextension='.plish',
+                                        filetypes=[('Session', '*.plish')])
+    if not fn:
+      return
+    write_session(fn, [(self.inputId, self.inputName, self.hprobes)], 
+                  self.sessionInfo)
+    show_log('Your session is available at: \n' + fn, self.progressTxt)
+
+  # Loads a session; its probes are filtered and exported with Save
+  def _openSession(self):
+    fn = tkFileDialog.askopenfilename(initialdir=get_script_path() + '/results',
+                                      filetypes=[('Session', '*.plish'), 
+                                                 ('All files', '*')])
+    if not fn:
+      return
+    try:
+      info, records = read_session(fn)
+    except (IOError, ValueError) as exc:
+      tkMessageBox.showerror('Session', str(exc))
+      return
+    if len(records) == 0:
+      tkMessageBox.showerror('Session', fn + ' contains no transcript.')
+      return
+    record = records[0]
+    if len(records) > 1: #ask for the transcript, default: the entered one
+      ids = [x[0] for x in records]
+      entered = self.txEntry.get().strip().split('.')[0]
+      default = [x for x in ids if x.split('.')[0] == entered] + ids
+      shown = ', '.join(ids[:20]) + (', ...' if len(ids) > 20 else '')
+      txId = tkSimpleDialog.askstring('Session', 'The session contains ' + 
+                                      str(len(ids)) + ' transcripts:\n' + shown + 
+                                      '\n\nTranscript ID to open:', 
+                                      initialvalue=default[0])
+      if txId is None:
+        return
+      match = [x for x in records 
+               if x[0].split('.')[0] == txId.strip().split('.')[0]]
+      if len(match) == 0:
+        tkMessageBox.showerror('Session', 'Transcript ' + txId + 
+                               ' is not in ' + fn + '.')
+        return
+      record = match[0]
+    check_session(info, records, self.progressTxt)
+    self.inputId, self.inputName, self.hprobes = record
+    self.sessionInfo = info
+    show_log('Target: ' + self.inputId + ' (' + self.inputName + '), ' + 
+             str(len(self.hprobes)) + ' candidates', self.progressTxt)
+    if len(records) > 1:
+      show_log('Opened 1 of ' + str(len(records)) + ' transcripts of the ' + 
+               'session; open it again for another one.', self.progressTxt)
+    self.saveBtn.config(state=NORMAL)
+    self.sessionSaveBtn.config(state=NORMAL)
+
   def __init__(self, master, dbnames, dbids, debug, version):
     self.dbids = dbids
     self.debug = debug
+    self.worker = None
+    self.db = self.sessionInfo = None
     
     self.master = master
     master.title('Plish Probe Designer')
@@ -89,17 +246,42 @@ class GUI:
   
     self.runBtn = Button(master, text='Run', command=self._run, width=15)
     self.runBtn.grid(row=2, column=2)
+    
+    self.jobs = IntVar()
+    self.jobs.set(_defaultJobs)
+    self.jobsLbl = Label(master, text='Jobs')
+    self.jobsLbl.grid(row=3, sticky=W+N)
+    self.jobsEntry = Entry(master, width=5, text=self.jobs)
+    self.jobsEntry.grid(row=3, column=1, sticky=W+N)
+    self.kmer = BooleanVar()
+    self.kmer.set(True)
+    self.kmerCb = Checkbutton(master, text='K-mer prefilter', variable=self.kmer,
+                              onvalue=True, offvalue=False)
+    self.kmerCb.grid(row=3, column=1, sticky=E+N)
+    
+    self.cancelBtn = Button(master, text='Cancel', command=self._cancel, 
+                            state=DISABLED, width=15)
+    self.cancelBtn.grid(row=3, column=2)
   
     self.progressLbl = Label(master, text='Progress')
     self.progressLbl.grid(row=4, sticky=W+N)
+    self.statusLbl = Label(master, text='', justify=LEFT)
+    self.statusLbl.grid(row=4, sticky=W+S)
     self.progressTxt = Text(bg="#263238", fg="#ffffff", state=DISABLED, width=51, height=16)
     self.progressTxt.grid(row=4, column=1)
   
     self.saveBtn = Button(master, text='Save', command=self._save, state=DISABLED, width=15)
     self.saveBtn.grid(row=5, column=2, sticky=N)
   
+    self.sessionSaveBtn = Button(master, text='Save session', 
+                                 command=self._saveSession, state=DISABLED, width=15)
+    self.sessionSaveBtn.grid(row=6, column=2, sticky=N)
+    self.sessionOpenBtn = Button(master, text='Open session', 
+                                 command=self._openSession, width=15)
+    self.sessionOpenBtn.grid(row=7, column=2, sticky=N)
+  
     self.quitBtn = Button(master, text='Quit', command=self._quitGUI, width=15)
-    self.quitBtn.grid(row=6, column=2, sticky=N)
+    self.quitBtn.grid(row=8, column=2, sticky=N)
     
     self.aboutLF = LabelFrame(master, text='About', width=300)
     self.aboutLF.grid(row=5, column=0, rowspan=2, columnspan=2, sticky=N+W)
@@ -123,7 +305,7 @@ class GUI:
     self.mingcLbl2.grid(row=0, column=2, sticky=N+W)
 
     self.spec = StringVar(master)
-    self.spec.set("isoform")
+    self.spec.set(_defaultSpec)
     self.specLbl = Label(self.filterLF, text='Specificity')
     self.specLbl.grid(row=1, column=0, sticky=N+W)
     self.specOm = OptionMenu(self.filterLF, self.spec, "isoform", "gene", "none")
@@ -180,3 +362,27 @@ class GUI:
                                    variable=self.multiexon, 
                                    onvalue=True, offvalue=False)
     self.multiexonCb.grid(row=7, column=0, sticky=N+W)
+
+    self.pick = BooleanVar()
+    self.pick.set(False)
+    self.pickCb = Checkbutton(self.filterLF, text='Non-overlapping', 
+                              variable=self.pick, onvalue=True, offvalue=False)
+    self.pickCb.grid(row=8, column=0, columnspan=2, sticky=N+W)
+
+    self.spacing = IntVar()
+    self.spacing.set(_defaultSpacing)
+    self.spacingLbl = Label(self.filterLF, text='Spacing')
+    self.spacingLbl.grid(row=9, column=0, sticky=N+W)
+    self.spacingEntry = Entry(self.filterLF, width=5, text=self.spacing)
+    self.spacingEntry.grid(row=9, column=1, sticky=N+W)
+    self.spacingLbl2 = Label(self.filterLF, text='nt')
+    self.spacingLbl2.grid(row=9, column=2, sticky=N+W)
+
+    self.maxprobes = IntVar()
+    self.maxprobes.set(_defaultMaxProbes)
+    self.maxprobesLbl = Label(self.filterLF, text='Max. probes')
+    self.maxprobesLbl.grid(row=10, column=0, sticky=N+W)
+    self.maxprobesEntry = Entry(self.filterLF, width=5, text=self.maxprobes)
+    self.maxprobesEntry.grid(row=10, column=1, sticky=N+W)
+    self.maxprobesLbl2 = Label(self.filterLF, text='(0: all)')
+    self.maxprobesLbl2.grid(row=10, column=2, sticky=N+W)
@@ -4,7 +4,13 @@
 # written by Daniel C. Ellwanger <dcellwanger.dev@gmail.com>
 # last modified Jun 28 2018
 ###############################################################################
-from plishUtils import revcompl, melttemp, get_script_path, fold, blast
+from bisect import bisect_left
+from array import array
+from itertools import compress, izip
+from plishUtils import revcompl, melttemp, melttemp_batch, fold, blast, np
+from plishUtils import specNames, array_view
+from plishThermo import nn_fold
+from plishProfile import profiled
 
 ###############################################################################
 # Public container for hybridization probe data
@@ -21,7 +27,7 @@ from plishUtils import revcompl, melttemp, get_script_path, fold, blast
 ###############################################################################
 class Hprobe:
   # Constructor
-  def __init__(self, seq, seq_id, seq_name, index):
+  def __init__(self, seq, seq_id, seq_name, index, gc=None):
     seq_rc = revcompl(seq)
     self.start = index - 19
     self.end = index + 21
@@ -31,7 +37,9 @@ class Hprobe:
     self.seq_id = seq_id.split('.')[0]
     self.seq_name = seq_name
     self.index = index
-    self.gc = (seq.count("G") + seq.count("C")) * 100.0 / len(seq) 
+    self.gc = gc
+    if gc is None:
+      self.gc = (seq.count("G") + seq.count("C")) * 100.0 / len(seq) 
 
   # Attributes
   start = end = rarm = larm = index = gc = exons = bhits = spec = None
@@ -44,53 +52,164 @@ class Hprobe:
     self.rarm.tm = round(melttemp(self.rarm.seq, c_salt, p_formamide), 1)
 
   # Calculate folding and duplices
-  def do_fold(self, temperature=310.15): #310.15 K = 37 C
-    infile = get_script_path() + "/tmp/" + str(id(self)) + ".seq"
-    with open(infile, "w") as f:
-      f.write(self.larm.seq + "\n" + self.rarm.seq) 
-    f.close()
-    dg = fold(infile, temperature)
-    larm_dg = dg[1].split("\t")
-    self.larm.dg_bimol = float(larm_dg[1])
-    self.larm.dg_uimol = float(larm_dg[2])
-    self.larm.dg_duplex = float(larm_dg[3])
-    self.larm.dg_2bpat5 = float(larm_dg[4])
-    self.larm.dg_2bpat3 = float(larm_dg[5])
-    rarm_dg = dg[2].split("\t")
-    self.rarm.dg_bimol = float(rarm_dg[1])
-    self.rarm.dg_uimol = float(rarm_dg[2])
-    self.rarm.dg_duplex = float(rarm_dg[3])
-    self.rarm.dg_2bpat5 = float(rarm_dg[4])
-    self.rarm.dg_2bpat3 = float(rarm_dg[5])
+  # engine: 'oligoscreen' (RNAstructure) or 'nn' (plishThermo)
+  def do_fold(self, temperature=310.15, engine='oligoscreen'): #310.15 K = 37 C
+    if engine == 'nn':
+      dg = nn_fold([self.larm.seq, self.rarm.seq], temperature)
+      self.larm.set_dg(dg[1])
+      self.rarm.set_dg(dg[2])
+      return
+    dg = fold([self.larm.seq, self.rarm.seq], temperature)
+    self.larm.set_dg(dg[1])
+    self.rarm.set_dg(dg[2])
   
   # Calculate blast hits
   def do_blast(self, blastdb):
-    infile = get_script_path() + "/tmp/" + str(id(self)) + ".seq"
-    with open(infile, "w") as f:
-      f.write(self.seq) 
-    f.close()
-    hits = blast(infile, blastdb)
-    self.spec = 'isoform'
+    hits = blast(">" + self.seq_id + "\n" + self.seq + "\n", blastdb)
+    self.set_bhits(hits)
+
+  # Assign blast hits (tabular BLAST output lines of this probe)
+  def set_bhits(self, hits):
     bhits = list()
-    if(len(hits) == 0):
-      self.spec = 'none'
-    else:
-      for h in hits:
-        hdat = h.split("\t")
-        acc = hdat[1]
-        ide = hdat[2]
-        
-        adat = acc.split('|')
-        txid = adat[0].split('.')[0]
-        symbol = adat[1]
-        bhits.append(txid + "|" + symbol + ":" + ide)
-        
-        if txid != self.seq_id:
-          self.spec = 'gene'
-        if symbol != self.seq_name:
-          self.spec = 'none'
+    for h in hits:
+      hdat = h.split("\t")
+      acc = hdat[1]
+      ide = hdat[2]
+      
+      adat = acc.split('|')
+      txid = adat[0].split('.')[0]
+      symbol = adat[1]
+      bhits.append(txid + "|" + symbol + ":" + ide)
+    self.spec = hit_spec(bhits, self.seq_id, self.seq_name)
     self.bhits = bhits  
 
+###############################################################################
+# Returns specificity of a probe for target seq_id (version-less) and 
+# seq_name from its blast hits <'acc|"name":identity'>, in the order of the 
+# BLAST output: isoform (hits only on the target), gene (also on other 
+# transcripts) or none (no hit or hits on other genes)
+###############################################################################
+def hit_spec(bhits, seq_id, seq_name):
+  if len(bhits) == 0:
+    return 'none'
+  spec = 'isoform'
+  for h in bhits:
+    txid, symbol = h.rsplit(':', 1)[0].split('|', 1)
+    if txid != seq_id:
+      spec = 'gene'
+    if symbol != seq_name:
+      spec = 'none'
+  return spec
+
+###############################################################################
+# Assign 1-based start and end exons to all probes; exons are resolved by 
+# binary search in the cumulative exon start offsets (a probe position at an 
+# exact exon end still belongs to that exon; -1 if no exon is found)
+###############################################################################
+@profiled
+def assign_exons(hprobes, exon_lens):
+  estarts = list()
+  csum = 0
+  for x in exon_lens:
+    estarts.append(csum)
+    csum = csum + x
+  if isinstance(hprobes, ProbeTable): #columns
+    idx = hprobes.columns['index']
+    e5 = [bisect_left(estarts, x - 19) for x in idx]
+    e3 = [bisect_left(estarts, x + 21) for x in idx]
+    hprobes.columns['exon5'] = array('l', [x if x > 0 else -1 for x in e5])
+    hprobes.columns['exon3'] = array('l', [x if x > 0 else -1 for x in e3])
+    return
+  for x in hprobes:
+    hpStart_exon = bisect_left(estarts, x.start)
+    hpEnd_exon = bisect_left(estarts, x.end)
+    x.exons = [hpStart_exon if hpStart_exon > 0 else -1, 
+               hpEnd_exon if hpEnd_exon > 0 else -1]
+
+###############################################################################
+# Copies the columns names (e.g. l_tm, r_tm) from src, a table of unique 
+# probe sequences, to the probes with the same sequence in hprobes, a table 
+# of one transcript; with bhits, the specificity is derived for the target 
+# of hprobes (see hit_spec). Probes not in src remain unchanged.
+###############################################################################
+@profiled
+def copy_features(src, hprobes, names):
+  pos = dict(izip(src.columns['seq'], xrange(len(src))))
+  idx = [pos.get(x) for x in hprobes.columns['seq']]
+  for name in names:
+    scol = src.columns[name]
+    dcol = hprobes.columns[name]
+    for j in xrange(len(idx)):
+      if idx[j] is not None:
+        dcol[j] = scol[idx[j]]
+  if 'bhits' in names:
+    spec = hprobes.columns['spec']
+    bhits = hprobes.columns['bhits']
+    for j in xrange(len(idx)):
+      if idx[j] is not None and bhits[j] is not None:
+        spec[j] = specNames.index(hit_spec(bhits[j], hprobes.seq_id, 
+                                           hprobes.seq_name))
+
+###############################################################################
+# Calculate melting temperature of all probe arms in one batch
+###############################################################################
+@profiled
+def calc_tm_hprobes(hprobes, c_salt, p_formamide):
+  if isinstance(hprobes, ProbeTable): #columns
+    for p in ['l_', 'r_']:
+      tms = melttemp_batch(hprobes.columns[p + 'seq'], c_salt, p_formamide)
+      hprobes.columns[p + 'tm'] = array('d', [round(x, 1) for x in tms])
+    return
+  arms = [x.larm for x in hprobes] + [x.rarm for x in hprobes]
+  tms = melttemp_batch([x.seq for x in arms], c_salt, p_formamide)
+  for i in range(len(arms)):
+    arms[i].tm = round(tms[i], 1)
+
+###############################################################################
+# Calculate folding and duplices of all probes; the left and right arms are
+# written into one list file per chunk of probes, so that oligoscreen is only 
+# invoked (and its data tables loaded) once per chunk; engine 'nn' uses the 
+# in-process nearest-neighbor model instead
+###############################################################################
+@profiled
+def fold_hprobes(hprobes, temperature=310.15, engine='oligoscreen', chunksize=1000):
+  for c in range(0, len(hprobes), chunksize):
+    chunk = [hprobes[i] for i in range(c, min(c + chunksize, len(hprobes)))]
+    if engine == 'nn':
+      seqs = list()
+      for x in chunk:
+        seqs.extend([x.larm.seq, x.rarm.seq])
+      dg = nn_fold(seqs, temperature)
+      for i in range(len(chunk)):
+        chunk[i].larm.set_dg(dg[2*i+1])
+        chunk[i].rarm.set_dg(dg[2*i+2])
+      continue
+    seqs = list()
+    for x in chunk:
+      seqs.extend([x.larm.seq, x.rarm.seq])
+    dg = fold(seqs, temperature)
+    for i in range(len(chunk)):
+      chunk[i].larm.set_dg(dg[2*i+1])
+      chunk[i].rarm.set_dg(dg[2*i+2])
+
+###############################################################################
+# Calculate blast hits of all probes with a single BLAST run; the probes are
+# passed as one multi-FASTA query and the hits are assigned by query id
+###############################################################################
+@profiled
+def blast_hprobes(hprobes, blastdb):
+  if len(hprobes) == 0:
+    return
+  query = "".join([">hp" + str(i) + "\n" + hprobes[i].seq + "\n" 
+                   for i in range(len(hprobes))])
+  hits = blast(query, blastdb)
+  qhits = [list() for x in hprobes]
+  for h in hits:
+    qid = h.split("\t", 1)[0]
+    qhits[int(qid[2:])].append(h)
+  for i in range(len(hprobes)):
+    hprobes[i].set_bhits(qhits[i])
+
 ###############################################################################
 # Private container for hybridization probe arm
 # Attributes
@@ -114,5 +233,195 @@ class _HprobeArm:
   def __init__(self, seq):
     self.seq = seq
     
+  # Methods
+  # Assign free energies (oligoscreen output line of this arm)
+  def set_dg(self, line):
+    dg = line.split("\t")
+    self.dg_bimol = float(dg[1])
+    self.dg_uimol = float(dg[2])
+    self.dg_duplex = float(dg[3])
+    self.dg_2bpat5 = float(dg[4])
+    self.dg_2bpat3 = float(dg[5])
+  
+  # Returns free energies in oligoscreen output format
+  def get_dg(self):
+    return '\t'.join([self.seq, str(self.dg_bimol), str(self.dg_uimol), 
+                      str(self.dg_duplex), str(self.dg_2bpat5), 
+                      str(self.dg_2bpat3)])
+    
   #Attributes
   seq = tm = dg_bimol = dg_uimol = dg_duplex = dg_2bpat5 = dg_2bpat3 = None
+
+###############################################################################
+# Public columnar container for the hybridization probes of a transcript
+# Numbers are stored in typed arrays (array module), sequences and BLAST hits 
+# in lists; a probe is no object of its own, but iteration and indexing 
+# return Hprobe-compatible views that read and write the columns, so that
+# the functions written for lists of Hprobe also work on tables. Slices and
+# select() return new tables (copies); rows identifies each probe within the
+# table it was derived from (see update).
+# Attributes
+# seq_id:   target sequence id
+# seq_name: target sequence/gene name
+# columns:  column name -> array or list (dict); numbers that are not (yet) 
+#           computed are NaN, exons and spec are 0 and -1
+# Columns
+# row, index, gc, exon5, exon3, spec (index in specNames), seq, bhits and, per 
+# arm (prefix l_ or r_), seq, tm, dg_bimol, dg_uimol, dg_duplex, dg_2bpat5,
+# dg_2bpat3
+###############################################################################
+_armColumns = ['tm', 'dg_bimol', 'dg_uimol', 'dg_duplex', 'dg_2bpat5', 'dg_2bpat3']
+_tableColumns = [('row', 'l'), ('index', 'l'), ('gc', 'd'), ('exon5', 'l'), 
+                 ('exon3', 'l'), ('spec', 'b'), ('seq', None), ('bhits', None), 
+                 ('l_seq', None), ('r_seq', None)] + \
+                [(p + x, 'd') for p in ['l_', 'r_'] for x in _armColumns]
+
+class ProbeTable:
+  # Constructor: probes of the anchor positions and 40-nt sequences
+  def __init__(self, seq_id, seq_name, index=(), seqs=(), gc=None):
+    self.seq_id = seq_id.split('.')[0]
+    self.seq_name = seq_name
+    n = len(index)
+    if gc is None:
+      gc = [(x.count("G") + x.count("C")) * 100.0 / len(x) for x in seqs]
+    seqs_rc = [revcompl(x) for x in seqs]
+    values = { 'row' : range(n), 'index' : index, 'gc' : gc, 
+               'exon5' : [0] * n, 'exon3' : [0] * n, 'spec' : [-1] * n, 
+               'seq' : list(seqs), 'bhits' : [None] * n,
+               'l_seq' : [x[20:] for x in seqs_rc], 
+               'r_seq' : [x[:20] for x in seqs_rc] }
+    nan = [float('nan')] * n
+    self.columns = {}
+    for name, typecode in _tableColumns:
+      if typecode is None:
+        self.columns[name] = values[name]
+      else:
+        self.columns[name] = array(typecode, values.get(name, nan))
+
+  # Attributes
+  seq_id = seq_name = columns = None
+
+  # Methods
+  def __len__(self):
+    return len(self.columns['row'])
+
+  def __iter__(self):
+    for i in xrange(len(self)):
+      yield _HprobeView(self, i)
+
+  def __getitem__(self, key):
+    if isinstance(key, slice):
+      return self._derive(dict((x, self.columns[x][key]) for x in self.columns))
+    if key < 0:
+      key += len(self)
+    if not 0 <= key < len(self):
+      raise IndexError('probe index out of range')
+    return _HprobeView(self, key)
+
+  # Returns new table with the given columns
+  def _derive(self, columns):
+    table = ProbeTable(self.seq_id, self.seq_name)
+    table.columns = columns
+    return table
+
+  # Returns new table with the probes for which mask is true
+  def select(self, mask):
+    columns = {}
+    if np is not None: #typed columns are selected without Python loop
+      mask = np.asarray(mask, dtype=bool)
+      flags = mask.tolist()
+    else:
+      flags = list(mask)
+    for name, typecode in _tableColumns:
+      col = self.columns[name]
+      if typecode is None:
+        columns[name] = list(compress(col, flags))
+      elif np is not None and len(col) > 0:
+        columns[name] = array(typecode, array_view(col)[mask].tobytes())
+      else:
+        columns[name] = array(typecode, compress(col, flags))
+    return self._derive(columns)
+
+  # Appends the probes of table
+  def extend(self, table):
+    for name in self.columns:
+      self.columns[name].extend(table.columns[name])
+
+  # Overwrites the probes with the (computed) probes of table derived from 
+  # this one or from the same table, matching them by row
+  def update(self, table):
+    if table is self or len(table) == 0:
+      return
+    pos = dict(izip(self.columns['row'], xrange(len(self))))
+    idx = [pos[x] for x in table.columns['row']]
+    for name in self.columns:
+      dst = self.columns[name]
+      src = table.columns[name]
+      for j in xrange(len(idx)):
+        dst[idx[j]] = src[j]
+
+###############################################################################
+# Private Hprobe-compatible views of a probe (and its arms) in a ProbeTable;
+# attributes are read from and written to the columns
+###############################################################################
+def _column(name, nullable=False):
+  def get(self):
+    x = self.table.columns[self.prefix + name][self.i]
+    if nullable and x != x: #NaN
+      return None
+    return x
+  def set(self, value):
+    self.table.columns[self.prefix + name][self.i] = value
+  return property(get, set)
+
+class _HprobeView(Hprobe, object):
+  # Constructor
+  def __init__(self, table, i):
+    self.table = table
+    self.i = i
+    self.larm = _HprobeArmView(table, i, 'l_')
+    self.rarm = _HprobeArmView(table, i, 'r_')
+
+  # Attributes
+  prefix = ''
+  seq = _column('seq')
+  gc = _column('gc')
+  index = _column('index')
+  bhits = _column('bhits')
+  start = property(lambda self: self.index - 19)
+  end = property(lambda self: self.index + 21)
+  seq_id = property(lambda self: self.table.seq_id)
+  seq_name = property(lambda self: self.table.seq_name)
+
+  def _get_exons(self):
+    e5 = self.table.columns['exon5'][self.i]
+    if e5 == 0:
+      return None
+    return [e5, self.table.columns['exon3'][self.i]]
+  def _set_exons(self, exons):
+    self.table.columns['exon5'][self.i] = exons[0]
+    self.table.columns['exon3'][self.i] = exons[1]
+  exons = property(_get_exons, _set_exons)
+
+  def _get_spec(self):
+    x = self.table.columns['spec'][self.i]
+    return specNames[x] if x >= 0 else None
+  def _set_spec(self, spec):
+    self.table.columns['spec'][self.i] = specNames.index(spec)
+  spec = property(_get_spec, _set_spec)
+
+class _HprobeArmView(_HprobeArm, object):
+  # Constructor
+  def __init__(self, table, i, prefix):
+    self.table = table
+    self.i = i
+    self.prefix = prefix
+
+  # Attributes
+  seq = _column('seq')
+  tm = _column('tm', True)
+  dg_bimol = _column('dg_bimol', True)
+  dg_uimol = _column('dg_uimol', True)
+  dg_duplex = _column('dg_duplex', True)
+  dg_2bpat5 = _column('dg_2bpat5', True)
+  dg_2bpat3 = _column('dg_2bpat3', True)
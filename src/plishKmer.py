@@ -0,0 +1,181 @@
+#!/usr/bin/python
+###############################################################################
+# Transcriptome k-mer index for the specificity prefilter
+###############################################################################
+import os
+from plishUtils import get_script_path, file_stamp, revcompl, select_probes
+from plishProfile import profiled
+try: #optional, the prefilter is skipped without numpy
+  import numpy as np
+except ImportError:
+  np = None
+
+# k-mer length (= megablast word size, i.e. a BLAST hit requires a shared k-mer)
+_k = 28
+# Level and window (triplets) of the DUST low-complexity filter of blastn
+_dustLevel = 20
+_dustWindow = 64
+
+###############################################################################
+# Returns canonical (min. of forward and reverse complement) 2-bit packed
+# k-mers of sequence; k-mers with non-ACGT characters are skipped
+###############################################################################
+def kmers_canonical(seq, k=_k):
+  code = np.full(256, 4, dtype=np.uint8)
+  for i in range(4):
+    code[ord('ACGT'[i])] = code[ord('acgt'[i])] = i
+  c = code[np.frombuffer(seq.encode('ascii'), dtype=np.uint8)]
+  n = len(c) - k + 1
+  if n <= 0:
+    return np.zeros(0, dtype=np.uint64)
+  bad = np.concatenate(([0], np.cumsum(c == 4)))
+  valid = bad[k:k+n] - bad[0:n] == 0
+  c = (c & 3).astype(np.uint64)
+  fw = np.zeros(n, dtype=np.uint64)
+  rv = np.zeros(n, dtype=np.uint64)
+  for j in range(k):
+    fw = (fw << np.uint64(2)) | c[j:j+n]
+    rv = rv | ((np.uint64(3) - c[j:j+n]) << np.uint64(2*j))
+  return np.minimum(fw, rv)[valid]
+
+###############################################################################
+# Returns number of (overlapping) occurrences of w in s, counting up to 2
+###############################################################################
+def _occurrences(s, w):
+  n = 0
+  i = s.find(w)
+  while i >= 0 and n < 2:
+    n += 1
+    i = s.find(w, i + 1)
+  return n
+
+###############################################################################
+# Returns True if seq has a low-complexity interval that the DUST filter of 
+# blastn masks (symmetric DUST: the triplet counts c of the interval score 
+# sum(c * (c - 1) / 2) > level / 10 * (number of triplets - 1)); BLAST does not
+# seed hits in masked intervals, so that such probes may have fewer hits
+###############################################################################
+def low_complexity(seq):
+  seq = seq.upper()
+  trip = [seq[i:i+3] for i in range(len(seq) - 2)]
+  for i in range(len(trip)):
+    counts = {}
+    r = 0
+    for j in range(i, min(len(trip), i + _dustWindow)):
+      r += counts.get(trip[j], 0)
+      counts[trip[j]] = counts.get(trip[j], 0) + 1
+      if r * 10 > _dustLevel * (j - i):
+        return True
+  return False
+
+###############################################################################
+# Public container for the memory-mapped k-mer index of a database
+# Attributes
+# db:      database id (str)
+# kmers:   sorted canonical k-mers (uint64 array)
+# txs:     transcript ordinal of each k-mer (uint32 array)
+# headers: sequence headers of the transcripts (list)
+# offsets: byte offsets of the transcripts in the sequence file (list)
+###############################################################################
+class KmerIndex:
+  # Constructor
+  def __init__(self, db):
+    dbpath = get_script_path() + '/database/' + db + '/' + db
+    self.db = db
+    self.headers = list()
+    self.offsets = list()
+    with open(dbpath + '.kmerids') as fh:
+      self.stamp = fh.readline().strip()[1:]
+      for line in fh:
+        kdat = line.rstrip('\n').split('\t')
+        self.headers.append(kdat[0])
+        self.offsets.append(int(kdat[1]))
+    fh.close()
+    self.kmers = np.load(dbpath + '.kmers.npy', mmap_mode='r')
+    self.txs = np.load(dbpath + '.kmertx.npy', mmap_mode='r')
+
+  # Attributes
+  db = kmers = txs = headers = offsets = stamp = None
+
+  # Methods
+  # Returns sequence of transcript ordinal (read from the sequence file)
+  def fetch_txSeq(self, tx):
+    filepath = get_script_path() + '/database/' + self.db + '/' + self.db + '.fna'
+    with open(filepath) as fh:
+      fh.seek(self.offsets[tx])
+      fh.readline()
+      seq = fh.readline().strip().upper()
+    fh.close()
+    return seq
+
+  # Returns tabular BLAST-like hit lines for seq if the case is clear-cut,
+  # i.e. seq is not masked by DUST, each transcript sharing a k-mer with seq
+  # contains seq exactly once and no other copy of any of its k-mers, and 
+  # the specificity does not depend on the order of the hits (see 
+  # plishHprobe.hit_spec: hits on one gene only, or on one transcript per 
+  # gene); otherwise None
+  def classify(self, seq, txseqs):
+    seq = seq.upper()
+    seq_rc = revcompl(seq)
+    q = kmers_canonical(seq)
+    if seq == seq_rc or len(q) != len(seq) - _k + 1 or low_complexity(seq):
+      return None
+    lo = np.searchsorted(self.kmers, q, side='left')
+    hi = np.searchsorted(self.kmers, q, side='right')
+    txs = set()
+    for i in range(len(q)):
+      txs.update(self.txs[lo[i]:hi[i]].tolist())
+    hits = list()
+    for tx in sorted(txs):
+      if tx not in txseqs:
+        txseqs[tx] = self.fetch_txSeq(tx)
+      s = txseqs[tx]
+      if _occurrences(s, seq) + _occurrences(s, seq_rc) != 1:
+        return None
+      for i in range(len(seq) - _k + 1):
+        w = seq[i:i+_k]
+        if _occurrences(s, w) + _occurrences(s, revcompl(w)) != 1:
+          return None
+      hits.append('\t' + self.headers[tx] + '\t100.000')
+    symbols = [x.split('|')[1] for x in hits]
+    if len(set(symbols)) > 1 and len(set(symbols)) < len(symbols):
+      return None
+    return hits
+
+###############################################################################
+# Returns k-mer index of db; None if numpy, the index or a current index
+# (matching the sequence file) is not available. The index is loaded again
+# when its files were rebuilt (e.g. by an update of the database).
+###############################################################################
+_kmerIndex = {}
+def fetch_kmerIndex(db):
+  dbpath = get_script_path() + '/database/' + db + '/' + db
+  if np is None or not os.path.exists(dbpath + '.kmerids'):
+    return None
+  stamp = file_stamp(dbpath + '.kmerids')
+  if db not in _kmerIndex or _kmerIndex[db][0] != stamp:
+    _kmerIndex[db] = (stamp, KmerIndex(db))
+  kidx = _kmerIndex[db][1]
+  if kidx.stamp != file_stamp(dbpath + '.fna'):
+    return None
+  return kidx
+
+###############################################################################
+# Assigns BLAST hits of clear-cut probes using the k-mer index of blastdb;
+# returns the ambiguous probes that still need to be BLASTed. The hits of a
+# clear-cut probe are its exact matches (identity 100.000) in transcript 
+# order, i.e. the hits megablast reports, but possibly in another order.
+###############################################################################
+@profiled
+def kmer_prefilter(hprobes, blastdb):
+  kidx = fetch_kmerIndex(blastdb)
+  if kidx is None:
+    return hprobes
+  ambiguous = list()
+  txseqs = {}
+  for x in hprobes:
+    hits = kidx.classify(x.seq, txseqs)
+    if hits is not None:
+      x.set_bhits(hits)
+    ambiguous.append(hits is None)
+  return select_probes(hprobes, ambiguous)
@@ -4,43 +4,194 @@
 # written by Daniel C. Ellwanger <dcellwanger.dev@gmail.com>
 # last modified Jun 28 2018
 ###############################################################################
-import os, sys
+import os, sys, time, signal
 from re import findall, finditer
-from itertools import compress
-from plishHprobe import Hprobe
+from itertools import compress, izip
+from multiprocessing import Pool, TimeoutError
+from plishHprobe import ProbeTable, assign_exons, calc_tm_hprobes, fold_hprobes
+from plishHprobe import blast_hprobes, copy_features
 from plishUtils import fetch_exonLen, fetch_seq, get_script_path, show_log
+from plishUtils import gccontent_batch, show_progress, check_cancel, cancel_run
+from plishUtils import get_scratch_dir, fetch_geneTxIds
+from plishUtils import filter_probes, filter_cheap, filter_fold, filter_spec
+from plishUtils import pick_probes
+from plishUtils import write_probesCSV, write_probesFNA, fetch_dbVersion
+from plishCache import FeatureCache, load_fold, store_fold, load_blast, store_blast
+from plishKmer import kmer_prefilter
+from plishProfile import profiled, stage, reset_profile, fetch_profile, merge_profile
+from plishSession import write_session, read_session
 
-def main(inputId, db, debug=False, txt=None):
+# Conditions of the feature computation
+_temperature = 310.15 #K = 37 C
+_cSalt = 0.05
+
+# Note shown when the thermodynamics are computed by the built-in model
+_nnNote = '  Built-in nearest-neighbor model: estimates of the oligoscreen ' + \
+          'values (see validateThermo.py)'
+
+# Columns of the fold results (see copy_features)
+_foldColumns = [p + x for p in ['l_', 'r_'] for x in ['dg_bimol', 'dg_uimol', 
+                'dg_duplex', 'dg_2bpat5', 'dg_2bpat3']]
+
+###############################################################################
+# Worker: runs a batch function on a chunk of probes and returns the chunk
+# and its profile
+###############################################################################
+def _do_chunk(task):
+  func, chunk, args = task
+  reset_profile()
+  func(chunk, *args)
+  return chunk, fetch_profile()
+
+###############################################################################
+# Worker initialization: a terminated worker kills its running commands and
+# exits (cleaning up its temporary files)
+###############################################################################
+def _init_worker():
+  signal.signal(signal.SIGTERM, _term_worker)
+
+def _term_worker(signum, frame):
+  cancel_run()
+  raise SystemExit(1)
+
+###############################################################################
+# Runs a batch function (fold_hprobes, blast_hprobes) on chunks of probes in a
+# pool of worker processes; chunks are collected in input order, so that the 
+# result equals the serial computation. With a GUI (txt), also a serial run
+# is chunked to report the progress. Raises Cancelled if the run is cancelled
+# (see cancel_run).
+###############################################################################
+def run_chunks(func, hprobes, args, jobs, txt, nchunks=4):
+  if len(hprobes) < 2 or (jobs <= 1 and txt is None):
+    func(hprobes, *args)
+    return hprobes
+  csize = -(-len(hprobes) // (max(1, jobs) * nchunks)) #ceil
+  tasks = [(func, hprobes[c:c+csize], args) for c in range(0, len(hprobes), csize)]
+  result = hprobes[0:0] #same type as hprobes
+  if jobs <= 1:
+    for task in tasks:
+      func(task[1], *args)
+      result.extend(task[1])
+      show_progress(len(result), len(hprobes), txt)
+      check_cancel()
+    return result
+  get_scratch_dir() #shared with the workers
+  pool = Pool(processes=jobs, initializer=_init_worker)
+  try:
+    it = pool.imap(_do_chunk, tasks)
+    while len(result) < len(hprobes):
+      try:
+        chunk, profile = it.next(timeout=0.2)
+      except TimeoutError:
+        check_cancel()
+        continue
+      merge_profile(profile)
+      result.extend(chunk)
+      show_progress(len(result), len(hprobes), txt)
+    pool.close()
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+  return result
+
+###############################################################################
+# Runs a batch function on the probes that are neither resolved by the 
+# (optional) prefilter nor in the cache and stores their features; returns 
+# all probes in input order. The prefilter runs first, so that the cache hit
+# rate refers to the probes that need the batch function.
+###############################################################################
+def run_cached(func, hprobes, args, jobs, txt, cache, load, store, prefilter=None):
+  check_cancel()
+  missing = hprobes
+  if prefilter is not None:
+    missing = prefilter(hprobes, *args)
+    if len(missing) < len(hprobes):
+      show_log('  Prefilter resolved ' + str(len(hprobes) - len(missing)) + '/' + 
+               str(len(hprobes)) + ' probes', txt)
+  loaded = missing #receives the cached features
+  if cache is not None:
+    missing = load(cache, missing, *args)
+  computed = run_chunks(func, missing, args, jobs, txt)
+  if cache is not None:
+    store(cache, computed, *args)
+  if isinstance(hprobes, ProbeTable): #subsets are copies: write back by row
+    hprobes.update(loaded)
+    hprobes.update(computed)
+    return hprobes
+  ids = set(id(x) for x in missing)
+  computed = iter(computed)
+  return [next(computed) if id(x) in ids else x for x in hprobes]
+
+###############################################################################
+# Applies a prefilter stage (filter_cheap, filter_fold, filter_spec) and logs
+# the number of removed probes
+###############################################################################
+def run_prefilter(func, hprobes, args, txt):
+  n = len(hprobes)
+  hprobes = func(hprobes, *args)
+  show_log('  Filtered out ' + str(n - len(hprobes)) + '/' + str(n) + 
+           ' probes', txt)
+  return hprobes
+
+###############################################################################
+# Returns positions and 40-nt target sequences of all candidate anchors (AG 
+# or TA ligation sites with 19 nt upstream and 19 nt downstream)
+###############################################################################
+@profiled
+def find_anchors(inputSeq):
+  l = len(inputSeq)
+  anc_index = [m.start() for m in finditer('(?:AG|TA)', inputSeq)]
+  f = [x > 18 and x+19 < l for x in anc_index]
+  anc_index = list(compress(anc_index, f))
+  anc_seq = [inputSeq[x-19:x+21] for x in anc_index]
+  return anc_index, anc_seq
+
+###############################################################################
+# Detects the H-probe candidates of a transcript and computes their features;
+# prefilters (dict of filter_probes arguments) removes probes as soon as the
+# features of a filter are known, i.e. folding and BLAST are only run on the 
+# remaining probes. Per default (None), all features of all candidates are 
+# computed, so that they can be filtered afterwards. With kmer, clear-cut 
+# probes are resolved by the k-mer index of the database instead of BLAST.
+###############################################################################
+@profiled
+def main(inputId, db, debug=False, txt=None, jobs=1, cache=True, engine='oligoscreen',
+         prefilters=None, kmer=True):
   if not os.path.exists(get_script_path() + '/database/' + db):
     show_log('ERROR: Database ' + db + ' does not exist.', txt)
     return None, None, None
   
   inputId = inputId.replace(' ', '')
-  inputName, inputId, inputSeq = fetch_seq(inputId, db)
+  inputName, txId, inputSeq = fetch_seq(inputId, db)
   
   if inputName is None:
     show_log('ERROR: Transcript ID ' + inputId + ' does not exist.', txt)
     return None, None, None
+  inputId = txId
   
   blastdb = db
+  if cache is True:
+    cache = FeatureCache()
+  elif cache is False:
+    cache = None
   
   show_log('Target: ' + inputId + " (" + inputName + ")", txt)
 
   ###############################################################################
   # 1. Find anchors 
   ###############################################################################
-  l = len(inputSeq)
-  anc_index = [m.start() for m in finditer('(?:AG|TA)', inputSeq)]
-  f = [x > 18 and x+19 < l for x in anc_index]
-  anc_index = list(compress(anc_index, f))
-  anc_seq = [inputSeq[x-19:x+21] for x in anc_index]
+  anc_index, anc_seq = find_anchors(inputSeq)
   
   show_log('#Candidates: ' + str(len(anc_index)), txt)
 
   ###############################################################################
   # 2. Init hybridization probes
   ###############################################################################
-  hprobes = [ Hprobe(anc_seq[i], inputId, inputName, anc_index[i]) for i in range(len(anc_index)) ]
+  anc_gc = gccontent_batch(anc_seq)
+  with stage('hprobes'):
+    hprobes = ProbeTable(inputId, inputName, anc_index, anc_seq, anc_gc)
   
   if debug:
     hprobes = hprobes[0:9]
@@ -52,17 +203,7 @@ def main(inputId, db, debug=False, txt=None):
   
   elen = fetch_exonLen(inputId, db)
   
-  for x in hprobes:
-    hpStart_exon = -1
-    hpEnd_exon = -1
-    csum = 0
-    for i in range(len(elen)):
-      if(x.start > csum):
-        hpStart_exon = i + 1
-      if(x.end > csum):
-        hpEnd_exon = i + 1
-      csum = csum + elen[i]
-    x.exons = [hpStart_exon, hpEnd_exon]
+  assign_exons(hprobes, elen)
   
   #f = [x.exons[0] != x.exons[1] for x in hprobes]
   #hprobes = list(compress(hprobes, f))
@@ -73,8 +214,7 @@ def main(inputId, db, debug=False, txt=None):
   ###############################################################################
   show_log('Step 2/4: Calculating melting temperature...', txt)
 
-  for x in hprobes:
-    x.calc_tm(c_salt=0.05, p_formamide=None) #1, 0.5
+  calc_tm_hprobes(hprobes, c_salt=_cSalt, p_formamide=None) #1, 0.5
   
   # Filter
   #fL = [x.larm.tm > 55.0 and x.larm.tm < 65.0 for x in hprobes] #45 - 65
@@ -83,24 +223,330 @@ def main(inputId, db, debug=False, txt=None):
   #hprobes = list(compress(hprobes, f))
   #print('#Filtered by melting temp.: ' + str(len(hprobes)))
   
+  if prefilters is not None:
+    p = prefilters
+    hprobes = run_prefilter(filter_cheap, hprobes, (p['mingc'], p['multiexon'], 
+                            p['mintm'], p['maxtm']), txt)
+  
   ###############################################################################
   # 5. Calculate thermodynamic features
   ###############################################################################
   show_log('Step 3/4: Calculating thermodynamics...', txt)
+  if engine == 'nn':
+    show_log(_nnNote, txt)
   
-  for x in hprobes:
-    x.do_fold(temperature=310.15) #310.15 K = 37 C
+  hprobes = run_cached(fold_hprobes, hprobes, (_temperature, engine), jobs, txt,
+                       cache, load_fold, store_fold)
+  if prefilters is not None:
+    p = prefilters
+    hprobes = run_prefilter(filter_fold, hprobes, (p['mindimer'], p['minfold'], 
+                            p['maxduplex']), txt)
   
   ###############################################################################
   # 6. BLAST
   ###############################################################################
   show_log('Step 4/4: Assessing specificity...', txt)
   
-  for x in hprobes:
-    x.do_blast(blastdb)
+  hprobes = run_cached(blast_hprobes, hprobes, (blastdb,), jobs, txt, 
+                       cache, load_blast, store_blast, 
+                       kmer_prefilter if kmer else None)
+  if prefilters is not None:
+    hprobes = run_prefilter(filter_spec, hprobes, (prefilters['spec'],), txt)
+  if cache is not None:
+    show_log(cache.report('fold') + ', ' + cache.report('blast'), txt)
     
   ###############################################################################
   # Return
   ###############################################################################
   show_log('------------------[ DONE ]------------------', txt)
   return inputId, inputName, hprobes
+
+###############################################################################
+# Returns the isoforms covered by each target sequence (dict: sequence -> 
+# transcript ids) in the (id, name, probes) of the isoforms of a gene
+###############################################################################
+def isoform_coverage(records):
+  coverage = {}
+  for inputId, inputName, hprobes in records:
+    for x in set(hprobes.columns['seq']):
+      coverage.setdefault(x, list()).append(inputId)
+  return coverage
+
+###############################################################################
+# Applies a prefilter stage to the probes of each isoform (see run_prefilter)
+###############################################################################
+def run_prefilter_isoforms(func, records, args, txt):
+  n = sum(len(x[2]) for x in records)
+  records = [(x[0], x[1], func(x[2], *args)) for x in records]
+  show_log('  Filtered out ' + str(n - sum(len(x[2]) for x in records)) + '/' + 
+           str(n) + ' probes', txt)
+  return records
+
+###############################################################################
+# Returns the probes of hprobes whose sequence is still a candidate of one of
+# the isoforms
+###############################################################################
+def _remaining(hprobes, records):
+  seqs = set()
+  for x in records:
+    seqs.update(x[2].columns['seq'])
+  return hprobes.select([x in seqs for x in hprobes.columns['seq']])
+
+###############################################################################
+# Gene-level design: detects the H-probe candidates of all isoforms of gene 
+# symbol, but computes Tm, folding and BLAST hits only once per unique 40-nt 
+# target sequence (isoforms share the candidates of their common exons). The
+# features are copied to the candidates of each isoform, which keep their own
+# positions, exons and specificity. Returns (id, name, probes) per isoform 
+# and the isoforms covered by each target sequence (see isoform_coverage); 
+# prefilters and kmer as in main.
+###############################################################################
+@profiled
+def main_gene(symbol, db, debug=False, txt=None, jobs=1, cache=True, 
+              engine='oligoscreen', prefilters=None, kmer=True):
+  if not os.path.exists(get_script_path() + '/database/' + db):
+    show_log('ERROR: Database ' + db + ' does not exist.', txt)
+    return list(), None
+  
+  symbol = symbol.strip()
+  txIds = fetch_geneTxIds(symbol, db)
+  if len(txIds) == 0:
+    show_log('ERROR: Gene ' + symbol + ' does not exist.', txt)
+    return list(), None
+  
+  blastdb = db
+  if cache is True:
+    cache = FeatureCache()
+  elif cache is False:
+    cache = None
+  
+  show_log('Target: gene ' + symbol + ' (' + str(len(txIds)) + ' isoforms: ' + 
+           ', '.join(txIds) + ')', txt)
+
+  ###############################################################################
+  # 1. Find anchors of all isoforms and the unique target sequences
+  ###############################################################################
+  records = list()
+  for txId in txIds:
+    inputName, inputId, inputSeq = fetch_seq(txId, db)
+    if inputName is None:
+      show_log('ERROR: Transcript ID ' + txId + ' does not exist.', txt)
+      continue
+    anc_index, anc_seq = find_anchors(inputSeq)
+    anc_gc = gccontent_batch(anc_seq)
+    with stage('hprobes'):
+      hprobes = ProbeTable(inputId, inputName, anc_index, anc_seq, anc_gc)
+    if debug:
+      hprobes = hprobes[0:9]
+    records.append((inputId, inputName, hprobes))
+  if len(records) == 0:
+    return list(), None
+  coverage = isoform_coverage(records)
+  
+  uindex = list()
+  useqs = list()
+  seen = set()
+  for inputId, inputName, hprobes in records:
+    for index, x in izip(hprobes.columns['index'], hprobes.columns['seq']):
+      if x not in seen:
+        seen.add(x)
+        uindex.append(index)
+        useqs.append(x)
+  with stage('hprobes'):
+    unique = ProbeTable(records[0][0], records[0][1], uindex, useqs)
+  
+  show_log('#Candidates: ' + str(sum(len(x[2]) for x in records)) + ' (' + 
+           str(len(unique)) + ' unique)', txt)
+  
+  ###############################################################################
+  # 2. Splice Junction Sites (per isoform)
+  ###############################################################################
+  show_log('Step 1/4: Analyzing splice junction sites...', txt)
+  
+  for inputId, inputName, hprobes in records:
+    assign_exons(hprobes, fetch_exonLen(inputId, db))
+  
+  ###############################################################################
+  # 3. Calculate melting temperature
+  ###############################################################################
+  show_log('Step 2/4: Calculating melting temperature...', txt)
+
+  calc_tm_hprobes(unique, c_salt=_cSalt, p_formamide=None)
+  for x in records:
+    copy_features(unique, x[2], ['l_tm', 'r_tm'])
+  
+  if prefilters is not None:
+    p = prefilters
+    records = run_prefilter_isoforms(filter_cheap, records, (p['mingc'], 
+                                     p['multiexon'], p['mintm'], p['maxtm']), txt)
+    unique = _remaining(unique, records)
+  
+  ###############################################################################
+  # 4. Calculate thermodynamic features
+  ###############################################################################
+  show_log('Step 3/4: Calculating thermodynamics...', txt)
+  if engine == 'nn':
+    show_log(_nnNote, txt)
+  
+  unique = run_cached(fold_hprobes, unique, (_temperature, engine), jobs, txt,
+                      cache, load_fold, store_fold)
+  for x in records:
+    copy_features(unique, x[2], _foldColumns)
+  if prefilters is not None:
+    p = prefilters
+    records = run_prefilter_isoforms(filter_fold, records, (p['mindimer'], 
+                                     p['minfold'], p['maxduplex']), txt)
+    unique = _remaining(unique, records)
+  
+  ###############################################################################
+  # 5. BLAST (the specificity is derived per isoform)
+  ###############################################################################
+  show_log('Step 4/4: Assessing specificity...', txt)
+  
+  unique = run_cached(blast_hprobes, unique, (blastdb,), jobs, txt, 
+                      cache, load_blast, store_blast, 
+                      kmer_prefilter if kmer else None)
+  for x in records:
+    copy_features(unique, x[2], ['bhits'])
+  if prefilters is not None:
+    records = run_prefilter_isoforms(filter_spec, records, (prefilters['spec'],), 
+                                     txt)
+  if cache is not None:
+    show_log(cache.report('fold') + ', ' + cache.report('blast'), txt)
+    
+  ###############################################################################
+  # Return
+  ###############################################################################
+  show_log('------------------[ DONE ]------------------', txt)
+  return records, coverage
+
+###############################################################################
+# Returns session info (see plishSession): database, its version and the
+# parameters of the feature computation
+###############################################################################
+def session_info(db, engine='oligoscreen', prefilters=None, genes=False):
+  return { 'db' : db, 'db_version' : fetch_dbVersion(db), 'engine' : engine, 
+           'temperature' : _temperature, 'c_salt' : _cSalt, 
+           'prefilters' : prefilters, 'genes' : genes,
+           'created' : time.strftime('%Y-%m-%dT%H:%M:%S') }
+
+###############################################################################
+# Filters the probes of a transcript (filters: dict of filter_probes arguments
+# or None; skipped if the probes were prefiltered) and picks the best set of
+# non-overlapping probes (pick: dict of pick_probes arguments or None)
+###############################################################################
+def filter_and_pick(hprobes, filters, pick, txt, prefiltered=False):
+  if filters is not None and not prefiltered:
+    hprobes = filter_probes(hprobes, **filters)
+  if pick is not None:
+    n = len(hprobes)
+    hprobes = pick_probes(hprobes, filters=filters, **pick)
+    show_log('Picked ' + str(len(hprobes)) + '/' + str(n) + 
+             ' non-overlapping probes', txt)
+  return hprobes
+
+###############################################################################
+# Returns the CSV and FASTA files of merged results (None: per transcript)
+###############################################################################
+def _result_fns(merge):
+  if merge is None:
+    return None, None
+  return (get_script_path() + '/results/' + merge + '_hprobe.csv',
+          get_script_path() + '/results/' + merge + '_hprobe.fna')
+
+###############################################################################
+# Batch design: runs main for each transcript id, filters the probes and 
+# writes them either per transcript or into one merged CSV/FASTA file pair 
+# (results/<merge>_hprobe.csv|fna); filters is a dict of filter_probes 
+# arguments or None to keep all candidates; with prefilter, the probes are 
+# filtered during the feature computation (see main). If results is a list,
+# the (id, name, filtered probes) of each transcript are appended to it. 
+# With session (file path), the unfiltered probes of all transcripts are 
+# saved as session file. With pick, only the best set of non-overlapping 
+# probes is kept (see filter_and_pick). With genes, inputIds are gene symbols
+# and all isoforms of each gene are designed at once (see main_gene); the 
+# isoforms covered by each probe are added to the CSV file. Without kmer, 
+# the specificity of all probes is assessed by BLAST (see kmer_prefilter).
+###############################################################################
+def run_batch(inputIds, db, filters, merge=None, debug=False, txt=None, jobs=1,
+              cache=True, engine='oligoscreen', prefilter=False, results=None,
+              session=None, pick=None, genes=False, kmer=True):
+  csv_fn, fna_fn = _result_fns(merge)
+  if cache is True: #share cache between transcripts
+    cache = FeatureCache()
+  append = False
+  n_done = 0
+  records = list()
+  prefilters = filters if prefilter else None
+  for i in range(len(inputIds)):
+    if genes:
+      show_log('[ Gene ' + str(i+1) + '/' + str(len(inputIds)) + ' ]', txt)
+      designed, isoforms = main_gene(inputIds[i], db, debug=debug, txt=txt, 
+                                     jobs=jobs, cache=cache, engine=engine, 
+                                     prefilters=prefilters, kmer=kmer)
+    else:
+      show_log('[ Transcript ' + str(i+1) + '/' + str(len(inputIds)) + ' ]', txt)
+      designed = [main(inputIds[i], db, debug=debug, txt=txt, jobs=jobs,
+                       cache=cache, engine=engine, prefilters=prefilters,
+                       kmer=kmer)]
+      isoforms = None
+    for inputId, inputName, hprobes in designed:
+      if hprobes is None:
+        continue
+      if session is not None:
+        records.append((inputId, inputName, hprobes))
+      hprobes = filter_and_pick(hprobes, filters, pick, txt, prefilter)
+      write_probesCSV(inputId, inputName, hprobes, txt, csv_fn, append, isoforms)
+      write_probesFNA(inputId, inputName, hprobes, txt, fna_fn, append)
+      if results is not None:
+        results.append((inputId, inputName, hprobes))
+      append = merge is not None
+      n_done += 1
+  if genes:
+    show_log('Designed probes for ' + str(n_done) + ' transcripts of ' + 
+             str(len(inputIds)) + ' genes.', txt)
+  else:
+    show_log('Designed probes for ' + str(n_done) + '/' + str(len(inputIds)) + 
+             ' transcripts.', txt)
+  if session is not None:
+    write_session(session, records, session_info(db, engine, prefilters, genes))
+    show_log('Your session is available at: \n' + session, txt)
+  return n_done
+
+###############################################################################
+# Logs content of a loaded session and warns if its database was changed 
+# since or if its probes were prefiltered
+###############################################################################
+def check_session(info, records, txt):
+  show_log('Session of ' + str(len(records)) + ' transcript(s), database ' + 
+           info['db'] + ', created ' + info['created'], txt)
+  if os.path.exists(get_script_path() + '/database/' + info['db']) and \
+     fetch_dbVersion(info['db']) != info['db_version']:
+    show_log('WARNING: Database ' + info['db'] + ' was changed since the ' + 
+             'session was saved.', txt)
+  if info['prefilters'] is not None:
+    show_log('WARNING: Probes of the session were prefiltered; filters less ' + 
+             'strict than ' + str(info['prefilters']) + ' have no effect.', txt)
+
+###############################################################################
+# Loads a session file and writes the probes of its transcripts as run_batch
+# does, filtered with the given filters and picked (no feature is 
+# recomputed); returns the session info
+###############################################################################
+def run_session(session, filters, merge=None, txt=None, pick=None):
+  info, records = read_session(session)
+  check_session(info, records, txt)
+  csv_fn, fna_fn = _result_fns(merge)
+  coverage = None
+  if info.get('genes', False): #isoforms of the same gene
+    coverage = {}
+    for name in set(x[1] for x in records):
+      coverage[name] = isoform_coverage([x for x in records if x[1] == name])
+  append = False
+  for inputId, inputName, hprobes in records:
+    hprobes = filter_and_pick(hprobes, filters, pick, txt)
+    isoforms = coverage[inputName] if coverage is not None else None
+    write_probesCSV(inputId, inputName, hprobes, txt, csv_fn, append, isoforms)
+    write_probesFNA(inputId, inputName, hprobes, txt, fna_fn, append)
+    append = merge is not None
+  return info
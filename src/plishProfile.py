@@ -0,0 +1,162 @@
+#!/usr/bin/python
+###############################################################################
+# Run instrumentation: per-stage timing, call, subprocess and I/O counts
+###############################################################################
+import os, sys, time, json, atexit
+from functools import wraps
+from contextlib import contextmanager
+
+###############################################################################
+# Private container of the measurements of a run (or of a worker chunk)
+# Attributes
+# t0:       start time (float)
+# times0:   os.times() at start (tuple)
+# stages:   name -> [calls, wall, cpu, child_cpu, bytes written] (dict)
+# order:    stage names in order of their first call (list)
+# counters: name -> count (dict)
+###############################################################################
+class _Profile:
+  # Constructor
+  def __init__(self):
+    self.t0 = time.time()
+    self.times0 = os.times()
+    self.stages = {}
+    self.order = list()
+    self.counters = {}
+
+  # Attributes
+  t0 = times0 = stages = order = counters = None
+
+  # Methods
+  def add_stage(self, name, values):
+    if name not in self.stages:
+      self.stages[name] = [0, 0.0, 0.0, 0.0, 0]
+      self.order.append(name)
+    s = self.stages[name]
+    for i in range(5):
+      s[i] += values[i]
+
+  def add_count(self, name, n):
+    self.counters[name] = self.counters.get(name, 0) + n
+
+_profile = None
+
+###############################################################################
+# Returns number of bytes written by this process (Linux); 0 if unknown
+###############################################################################
+def _wchar():
+  try:
+    with open('/proc/self/io') as fh:
+      for line in fh:
+        if line.startswith('wchar:'):
+          return int(line.split()[1])
+  except IOError:
+    pass
+  return 0
+
+###############################################################################
+# Measures a stage of the run: with stage('name'): ...
+###############################################################################
+@contextmanager
+def stage(name):
+  if _profile is None:
+    yield
+    return
+  prof = _profile
+  t0 = time.time()
+  c0 = os.times()
+  w0 = _wchar()
+  try:
+    yield
+  finally:
+    c1 = os.times()
+    prof.add_stage(name, [1, time.time() - t0, 
+                          max(0.0, c1[0] + c1[1] - c0[0] - c0[1]),
+                          max(0.0, c1[2] + c1[3] - c0[2] - c0[3]), _wchar() - w0])
+
+###############################################################################
+# Decorator: measures each call of a function as stage of its name
+###############################################################################
+def profiled(func):
+  @wraps(func)
+  def wrapper(*args, **kwargs):
+    if _profile is None:
+      return func(*args, **kwargs)
+    with stage(func.__name__):
+      return func(*args, **kwargs)
+  return wrapper
+
+###############################################################################
+# Increases counter name (e.g. subprocesses, tempfile_bytes) by n
+###############################################################################
+def count(name, n=1):
+  if _profile is not None:
+    _profile.add_count(name, n)
+
+###############################################################################
+# Worker processes: reset_profile starts the measurement of a chunk,
+# fetch_profile returns it and merge_profile adds it to the run
+###############################################################################
+def reset_profile():
+  global _profile
+  if _profile is not None:
+    _profile = _Profile()
+
+def fetch_profile():
+  if _profile is None:
+    return None
+  return [(x, _profile.stages[x]) for x in _profile.order], _profile.counters
+
+def merge_profile(data):
+  if _profile is None or data is None:
+    return
+  stages, counters = data
+  for name, values in stages:
+    _profile.add_stage(name, values)
+  for name in counters:
+    _profile.add_count(name, counters[name])
+
+###############################################################################
+# Starts the instrumentation of the run; at exit, a JSON report is written
+# to json_fn and (optionally) the cProfile statistics to cprofile_fn
+###############################################################################
+def start_profile(json_fn, cprofile_fn=None):
+  global _profile
+  _profile = _Profile()
+  cprof = None
+  if cprofile_fn is not None:
+    import cProfile
+    cprof = cProfile.Profile()
+    cprof.enable()
+  atexit.register(write_profile, json_fn, cprofile_fn, cprof)
+
+###############################################################################
+# Writes the JSON report of the run (and the cProfile statistics); times of
+# stages run in worker processes are summed over the workers
+###############################################################################
+def write_profile(json_fn, cprofile_fn=None, cprof=None):
+  if _profile is None:
+    return
+  if cprof is not None:
+    cprof.disable()
+    cprof.dump_stats(cprofile_fn)
+  t1 = os.times()
+  t0 = _profile.times0
+  report = { 'command' : ' '.join(sys.argv),
+             'started' : time.strftime('%Y-%m-%dT%H:%M:%S',
+                                       time.localtime(_profile.t0)),
+             'wall' : round(time.time() - _profile.t0, 4),
+             'cpu' : round(t1[0] + t1[1] - t0[0] - t0[1], 4),
+             'child_cpu' : round(t1[2] + t1[3] - t0[2] - t0[3], 4),
+             'stages' : [],
+             'counters' : _profile.counters }
+  for name in _profile.order:
+    s = _profile.stages[name]
+    report['stages'].append({ 'name' : name, 'calls' : s[0],
+                              'wall' : round(s[1], 4), 'cpu' : round(s[2], 4),
+                              'child_cpu' : round(s[3], 4),
+                              'bytes_written' : s[4] })
+  with open(json_fn, 'w') as fh:
+    json.dump(report, fh, indent=2, sort_keys=True)
+  fh.close()
+  print 'Profile written to ' + json_fn
@@ -0,0 +1,355 @@
+#!/usr/bin/python
+###############################################################################
+# Probe design service: local HTTP API with a job queue
+###############################################################################
+import os, sys, time, json, signal, threading
+from Queue import Queue
+from collections import deque
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from plishMain import run_batch
+from plishUtils import get_script_path, fetch_dbInfo, fetch_txIds, fetch_offset
+from plishUtils import filter_defaults, specNames, show_log, bind_run
+from plishUtils import cancel_run, Cancelled
+from plishUtils import get_scratch_dir
+from plishKmer import fetch_kmerIndex
+
+# Default port, number of finished jobs kept and thermodynamics engines
+_defaultPort = 8765
+_maxFinished = 200
+_engines = ['oligoscreen', 'nn']
+
+###############################################################################
+# Private log of a job: receives the log and progress events of the pipeline
+# (see show_log) and records them in the job
+###############################################################################
+class _JobLog(Queue):
+  # Constructor
+  def __init__(self, job):
+    Queue.__init__(self)
+    self.job = job
+
+  # Methods
+  def put(self, event, *args):
+    if event[0] == 'log':
+      self.job.log.append(event[1])
+    elif event[0] == 'progress':
+      self.job.progress = list(event[1:])
+
+###############################################################################
+# Public container for a design job
+# Attributes
+# id:       job id (str)
+# db:       database id (str)
+# txIds:    transcript ids (list)
+# filters:  filter_probes arguments or None (dict)
+# options:  further run_batch arguments (dict)
+# status:   queued, running, done, failed or cancelled (str)
+# log:      log lines (list)
+# progress: probes done and total of the current step (list)
+# results:  (id, name, filtered probes) per transcript (list)
+# control:  cancellation state of the running job
+###############################################################################
+class Job:
+  # Constructor
+  def __init__(self, jobId, db, txIds, filters, options):
+    self.id = jobId
+    self.db = db
+    self.txIds = txIds
+    self.filters = filters
+    self.options = options
+    self.status = 'queued'
+    self.log = list()
+    self.progress = None
+    self.results = list()
+    self.control = None
+    self.error = None
+    self.times = { 'submitted' : time.time() }
+
+  # Attributes
+  id = db = txIds = filters = options = status = log = progress = None
+  results = control = error = times = None
+
+  # Methods
+  # Returns result file of the job (ftype: 'csv' or 'fna')
+  def result_fn(self, ftype):
+    return get_script_path() + '/results/' + self.id + '_hprobe.' + ftype
+
+  # Returns status as dict
+  def info(self):
+    return { 'id' : self.id, 'db' : self.db, 'tx' : self.txIds,
+             'status' : self.status, 'progress' : self.progress,
+             'times' : self.times, 'error' : self.error,
+             'log' : self.log[-20:],
+             'transcripts' : [{ 'id' : x[0], 'name' : x[1], 'probes' : len(x[2]) }
+                              for x in self.results] }
+
+###############################################################################
+# Returns features of a probe as dict
+###############################################################################
+def probe_info(hp):
+  arms = {}
+  for side, arm in [('left', hp.larm), ('right', hp.rarm)]:
+    arms[side] = { 'seq' : arm.seq, 'tm' : arm.tm, 'bimol' : arm.dg_bimol,
+                   'unimol' : arm.dg_uimol, 'duplex' : arm.dg_duplex,
+                   '2bpat5' : arm.dg_2bpat5, '2bpat3' : arm.dg_2bpat3 }
+  return { 'start' : hp.start + 1, 'seq' : hp.seq, 'gc' : hp.gc,
+           'exons' : hp.exons, 'spec' : hp.spec, 'bhits' : hp.bhits,
+           'left' : arms['left'], 'right' : arms['right'] }
+
+###############################################################################
+# Returns value of filter name converted to the type of its default; raises
+# ValueError if the filter is unknown or the value does not fit
+###############################################################################
+def _filter_value(name, value):
+  if name not in filter_defaults:
+    raise ValueError('unknown filter ' + str(name))
+  if name == 'spec':
+    if value not in specNames:
+      raise ValueError('spec must be one of ' + ', '.join(specNames))
+    return str(value)
+  if isinstance(filter_defaults[name], bool):
+    if not isinstance(value, bool):
+      raise ValueError(name + ' must be true or false')
+    return value
+  if isinstance(value, bool) or not isinstance(value, (int, long, float)):
+    raise ValueError(name + ' must be a number')
+  return float(value)
+
+###############################################################################
+# Public job queue: jobs are run in order by maxjobs worker threads, each
+# with jobs worker processes for the feature computation
+###############################################################################
+class JobQueue:
+  # Constructor
+  def __init__(self, maxjobs=1, jobs=1, cache=True):
+    self.jobs = jobs
+    self.cache = cache
+    self.lock = threading.Lock()
+    self.queue = Queue()
+    self.all = {}
+    self.finished = deque()
+    self.count = 0
+    for i in range(maxjobs):
+      t = threading.Thread(target=self._work)
+      t.daemon = True
+      t.start()
+
+  # Attributes
+  jobs = cache = lock = queue = all = finished = count = None
+
+  # Methods
+  # Adds job; returns it
+  def submit(self, db, txIds, filters, options):
+    with self.lock:
+      self.count += 1
+      jobId = time.strftime('%Y%m%d%H%M%S') + '-' + str(self.count)
+      job = Job(jobId, db, txIds, filters, options)
+      self.all[jobId] = job
+    self.queue.put(job)
+    return job
+
+  def get(self, jobId):
+    return self.all.get(jobId)
+
+  # Cancels queued or running job
+  def cancel(self, job):
+    with self.lock:
+      if job.status == 'queued':
+        job.status = 'cancelled'
+      elif job.status == 'running':
+        cancel_run(job.control)
+
+  def _work(self):
+    while True:
+      job = self.queue.get()
+      with self.lock:
+        if job.status != 'queued': #cancelled while queued
+          self._finish(job)
+          continue
+        job.status = 'running'
+        job.control = bind_run()
+      job.times['started'] = time.time()
+      try:
+        run_batch(job.txIds, job.db, job.filters, merge=job.id,
+                  txt=_JobLog(job), jobs=self.jobs, cache=self.cache,
+                  results=job.results, **job.options)
+        job.status = 'done'
+      except Cancelled:
+        job.status = 'cancelled'
+      except Exception as exc:
+        job.status = 'failed'
+        job.error = str(exc)
+      job.times['finished'] = time.time()
+      show_log('Job ' + job.id + ' ' + job.status, None)
+      with self.lock:
+        self._finish(job)
+
+  # Keeps the last _maxFinished finished jobs
+  def _finish(self, job):
+    self.finished.append(job.id)
+    while len(self.finished) > _maxFinished:
+      self.all.pop(self.finished.popleft(), None)
+
+###############################################################################
+# Loads the indexes of db and reads its files once, so that they are in the
+# page cache of the operating system when the first job runs
+###############################################################################
+def warm_db(db):
+  txIds = fetch_txIds(db)
+  if len(txIds) > 0:
+    fetch_offset(txIds[0], db, 'fna')
+  fetch_kmerIndex(db)
+  dbdir = get_script_path() + '/database/' + db
+  for x in sorted(os.listdir(dbdir)):
+    with open(dbdir + '/' + x, 'rb') as fh:
+      while fh.read(1 << 20) != '':
+        pass
+    fh.close()
+
+###############################################################################
+# Private HTTP request handler
+# GET    /databases          databases (id and name)
+# GET    /jobs               status of all jobs
+# POST   /jobs               submit job; JSON body: db, tx (id or list of ids),
+#                            filters (dict, default: filter_defaults; null:
+#                            no filtering), engine, prefilter, pick (dict:
+#                            spacing, maxn; keeps the best non-overlapping
+#                            probes), genes (tx are gene symbols whose 
+#                            isoforms are designed at once), kmer (false: 
+#                            specificity of all probes by BLAST)
+# GET    /jobs/<id>          status of job
+# GET    /jobs/<id>/probes   filtered probes and their features (JSON)
+# GET    /jobs/<id>/csv|fna  result CSV or FASTA file
+# DELETE /jobs/<id>          cancel job
+###############################################################################
+class _Handler(BaseHTTPRequestHandler):
+  def _send(self, code, body, ctype='application/json'):
+    if ctype == 'application/json':
+      body = json.dumps(body, indent=2, sort_keys=True) + '\n'
+    self.send_response(code)
+    self.send_header('Content-Type', ctype)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def _job(self, parts):
+    job = self.server.jobs.get(parts[1]) if len(parts) > 1 else None
+    if job is None:
+      self._send(404, { 'error' : 'unknown job' })
+    return job
+
+  def do_GET(self):
+    parts = self.path.strip('/').split('/')
+    if parts == ['databases']:
+      self._send(200, [{ 'id' : x[1], 'name' : x[0] } for x in zip(*fetch_dbInfo())])
+    elif parts == ['jobs']:
+      with self.server.jobs.lock:
+        snapshot = sorted(self.server.jobs.all.items())
+      self._send(200, [job.info() for x, job in snapshot])
+    elif parts[0] == 'jobs' and len(parts) in [2, 3]:
+      job = self._job(parts)
+      if job is None:
+        return
+      if len(parts) == 2:
+        self._send(200, job.info())
+      elif parts[2] == 'probes':
+        self._send(200, [{ 'id' : x[0], 'name' : x[1],
+                           'probes' : [probe_info(hp) for hp in x[2]] }
+                         for x in job.results])
+      elif parts[2] in ['csv', 'fna'] and job.status == 'done':
+        fn = job.result_fn(parts[2])
+        body = ''
+        if os.path.exists(fn):
+          with open(fn) as fh:
+            body = fh.read()
+          fh.close()
+        self._send(200, body, 'text/plain')
+      else:
+        self._send(404, { 'error' : 'no such result (job ' + job.status + ')' })
+    else:
+      self._send(404, { 'error' : 'unknown path' })
+
+  def do_POST(self):
+    if self.path.strip('/') != 'jobs':
+      self._send(404, { 'error' : 'unknown path' })
+      return
+    try:
+      req = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+      db = str(req['db'])
+      txIds = req['tx'] if isinstance(req['tx'], list) else [req['tx']]
+      txIds = [str(x) for x in txIds]
+      filters = dict(filter_defaults)
+      if 'filters' in req and req['filters'] is None:
+        filters = None
+      elif 'filters' in req:
+        if not isinstance(req['filters'], dict):
+          raise ValueError('filters must be an object')
+        for x in req['filters']:
+          filters[x] = _filter_value(x, req['filters'][x])
+      options = { 'engine' : str(req.get('engine', 'oligoscreen')),
+                  'prefilter' : bool(req.get('prefilter', False)),
+                  'genes' : bool(req.get('genes', False)),
+                  'kmer' : bool(req.get('kmer', True)) }
+      if options['engine'] not in _engines:
+        raise ValueError('unknown engine ' + options['engine'])
+      if options['prefilter'] and filters is None:
+        raise ValueError('prefilter cannot be combined with filters null')
+      if req.get('pick') is not None:
+        pick = req['pick']
+        if not isinstance(pick, dict):
+          raise ValueError('pick must be an object')
+        options['pick'] = { 'spacing' : int(pick.get('spacing', 0)),
+                            'maxn' : None if pick.get('maxn') is None \
+                                     else int(pick['maxn']) }
+        if options['pick']['spacing'] < 0 or options['pick']['maxn'] is not None \
+           and options['pick']['maxn'] < 1:
+          raise ValueError('spacing must be >= 0 and maxn >= 1')
+    except (ValueError, KeyError, TypeError, AttributeError) as exc:
+      self._send(400, { 'error' : 'invalid request: ' + str(exc) })
+      return
+    if db not in fetch_dbInfo()[1]:
+      self._send(400, { 'error' : 'unknown database ' + db })
+      return
+    job = self.server.jobs.submit(db, txIds, filters, options)
+    self._send(202, job.info())
+
+  def do_DELETE(self):
+    parts = self.path.strip('/').split('/')
+    if parts[0] != 'jobs' or len(parts) != 2:
+      self._send(404, { 'error' : 'unknown path' })
+      return
+    job = self._job(parts)
+    if job is not None:
+      self.server.jobs.cancel(job)
+      self._send(200, job.info())
+
+  def log_message(self, format, *args): #requests are not logged
+    pass
+
+class _Server(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+###############################################################################
+# Runs the design service on host:port until interrupted (or terminated);
+# running jobs are cancelled at exit
+###############################################################################
+def serve(host='127.0.0.1', port=_defaultPort, maxjobs=1, jobs=1, cache=True):
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+  get_scratch_dir() #shared by all jobs
+  for db in fetch_dbInfo()[1]:
+    show_log('Loading database ' + db + ' ...', None)
+    warm_db(db)
+  server = _Server((host, port), _Handler)
+  server.jobs = JobQueue(maxjobs, jobs, cache)
+  show_log('Serving probe design on http://' + host + ':' + str(port) + '/', None)
+  try:
+    server.serve_forever()
+  except (KeyboardInterrupt, SystemExit):
+    pass
+  server.server_close()
+  with server.jobs.lock:
+    snapshot = server.jobs.all.values()
+  for job in snapshot:
+    server.jobs.cancel(job)
+  show_log('Service stopped.', None)
@@ -0,0 +1,102 @@
+#!/usr/bin/python
+###############################################################################
+# Binary session files: probe features of designed transcripts, to be
+# filtered and exported again without recomputation
+###############################################################################
+import sys, json, zlib, struct
+from array import array
+from plishHprobe import ProbeTable
+from plishProfile import profiled
+
+# File format: magic line, header length (uint64, little-endian), JSON header
+# (info and, per transcript, the stored columns and their byte lengths) and
+# the zlib-compressed column data. Numbers are stored little-endian with
+# fixed sizes (typecode 'l' as 'i'); strings are joined by newlines, the
+# BLAST hits of a probe by tabs ('\x00': not computed).
+_magic = 'PLISH-SESSION 1\n'
+_storedType = { 'l' : 'i', 'd' : 'd', 'b' : 'b' }
+
+###############################################################################
+# Returns column as bytes and its stored typecode (None for strings)
+###############################################################################
+def _pack(name, col):
+  if isinstance(col, array):
+    stored = _storedType[col.typecode]
+    if stored != col.typecode or sys.byteorder == 'big': #copy
+      col = array(stored, col)
+    if sys.byteorder == 'big':
+      col.byteswap()
+    return col.tostring(), stored
+  if name == 'bhits':
+    col = ['\x00' if x is None else '\t'.join(x) for x in col]
+  return '\n'.join(col), None
+
+###############################################################################
+# Returns column from bytes (see _pack); typecode: type of the table column
+###############################################################################
+def _unpack(name, data, stored, typecode, n):
+  if stored is None:
+    col = data.split('\n') if n > 0 else list()
+    if name == 'bhits':
+      col = [None if x == '\x00' else (x.split('\t') if x != '' else list())
+             for x in col]
+    return col
+  col = array(str(stored))
+  col.fromstring(data)
+  if sys.byteorder == 'big':
+    col.byteswap()
+  return array(typecode, col) if typecode != stored else col
+
+###############################################################################
+# Writes session file; records: (id, name, ProbeTable) per transcript, info:
+# dict of database and parameters
+###############################################################################
+@profiled
+def write_session(filepath, records, info):
+  header = { 'info' : info, 'records' : list() }
+  data = list()
+  for inputId, inputName, hprobes in records:
+    rec = { 'id' : inputId, 'name' : inputName, 'n' : len(hprobes),
+            'columns' : list() }
+    for name in sorted(hprobes.columns):
+      packed, stored = _pack(name, hprobes.columns[name])
+      rec['columns'].append([name, stored, len(packed)])
+      data.append(packed)
+    header['records'].append(rec)
+  header = json.dumps(header, sort_keys=True)
+  with open(filepath, 'wb') as fh:
+    fh.write(_magic)
+    fh.write(struct.pack('<Q', len(header)))
+    fh.write(header)
+    fh.write(zlib.compress(''.join(data), 6))
+  fh.close()
+  return filepath
+
+###############################################################################
+# Reads session file; returns info (dict) and records: (id, name, ProbeTable)
+# per transcript
+###############################################################################
+@profiled
+def read_session(filepath):
+  with open(filepath, 'rb') as fh:
+    if fh.read(len(_magic)) != _magic:
+      raise ValueError(filepath + ' is no session file')
+    size = struct.unpack('<Q', fh.read(8))[0]
+    header = json.loads(fh.read(size))
+    data = zlib.decompress(fh.read())
+  fh.close()
+  typecodes = dict((x, y.typecode) for x, y in ProbeTable('', '').columns.items()
+                   if isinstance(y, array))
+  records = list()
+  pos = 0
+  for rec in header['records']:
+    table = ProbeTable(str(rec['id']), str(rec['name']))
+    if sorted(table.columns) != sorted(x[0] for x in rec['columns']):
+      raise ValueError(filepath + ': columns do not match this version')
+    for name, stored, size in rec['columns']:
+      name = str(name)
+      table.columns[name] = _unpack(name, data[pos:pos+size], stored,
+                                    typecodes.get(name), rec['n'])
+      pos += size
+    records.append((str(rec['id']), str(rec['name']), table))
+  return header['info'], records
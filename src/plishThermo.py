@@ -0,0 +1,458 @@
+#!/usr/bin/python
+###############################################################################
+# Nearest-neighbor thermodynamics (in-process alternative to oligoscreen)
+###############################################################################
+import os, re, itertools
+from math import log
+try: #optional, used for batch computations
+  import numpy as np
+except ImportError:
+  np = None
+
+###############################################################################
+# RNA nearest-neighbor parameters: Turner 2004 set (Mathews et al., PNAS
+# 2004; the set used by RNAstructure) in the parameter file format of the
+# ViennaRNA Package, in dcal/mol; T is read as U. Bases are coded as in that
+# format (1-4: A, C, G, U; 0: other; 5: no base, i.e. end of the strand) and
+# base pairs by type (1-6: CG, GC, GU, UG, AU, UA; 0: no pair)
+###############################################################################
+_parFile = os.path.dirname(os.path.realpath(__file__)) + '/rna_turner2004.par'
+_pairTypes = { 'CG' : 1, 'GC' : 2, 'GU' : 3, 'UG' : 4, 'AU' : 5, 'UA' : 6 }
+_rtype = [0, 2, 1, 4, 3, 6, 5, 7] #type of the reversed pair
+_wc = [0, 5, 1, 2, 6] #type of the pair of a base with its complement
+_comp = [0, 4, 3, 2, 1] #complement of a base
+_maxLoop = 30 #max. number of unpaired bases of interior loops and bulges
+_inf = 1e7
+_T37 = 310.15
+# Version of the model; part of the cache parameters of its results
+model_version = 3
+
+###############################################################################
+# Private table of parameters indexed by tuples of types and bases; missing
+# entries are infinite
+###############################################################################
+class _Table(dict):
+  def __missing__(self, key):
+    return _inf
+
+###############################################################################
+# Returns sections of the parameter file as lists of tokens (read once)
+###############################################################################
+_raw = None
+def _read_params():
+  global _raw
+  if _raw is None:
+    raw = {}
+    name = None
+    with open(_parFile) as fh:
+      for line in fh:
+        line = re.sub(r'/\*.*?\*/', '', line).strip()
+        if line == '' or line.startswith('##'):
+          continue
+        if line.startswith('#'):
+          name = line[1:].strip()
+          raw[name] = list()
+        else:
+          raw[name].extend(line.split())
+    fh.close()
+    _raw = raw
+  return _raw
+
+###############################################################################
+# Returns value of a parameter file token (DEF: default of the format)
+###############################################################################
+def _value(x):
+  if x == 'INF':
+    return _inf
+  if x == 'DEF':
+    return -50.0
+  return float(x)
+
+###############################################################################
+# Returns free energy at temperature (given as multiple of 37 C in K) from
+# free energy at 37 C and enthalpy
+###############################################################################
+def _rescale(dg, dh, scale):
+  return dg if dg >= _inf else dh - (dh - dg) * scale
+
+###############################################################################
+# Returns free energies of section name of the parameter file at temperature
+###############################################################################
+def _section(raw, name, scale):
+  return [_rescale(_value(x), _value(y), scale)
+          for x, y in zip(raw[name], raw[name + '_enthalpies'])]
+
+###############################################################################
+# Returns table of values, which are listed in the parameter file for
+# indexes first to first + dims - 1 of each dimension
+###############################################################################
+def _table(values, dims, first):
+  keys = itertools.product(*[range(f, f + d) for f, d in zip(first, dims)])
+  return _Table(zip(keys, values))
+
+###############################################################################
+# Returns table as numpy array of the given shape
+###############################################################################
+def _dense(table, shape):
+  a = np.full(shape, _inf)
+  for key in table:
+    a[key] = table[key]
+  return a
+
+###############################################################################
+# Returns parameters at temperature (K); as numpy arrays if dense (for the
+# batch computations). The exterior loop table combines the terminal
+# mismatches or dangling ends of a helix end with its terminal AU/GU penalty
+###############################################################################
+_params_cache = {}
+def _params(temperature, dense=False):
+  if (temperature, dense) in _params_cache:
+    return _params_cache[(temperature, dense)]
+  raw = _read_params()
+  scale = temperature / _T37
+  P = {}
+  P['stack'] = _table(_section(raw, 'stack', scale), (7, 7), (1, 1))
+  for x, name in [('mmH', 'hairpin'), ('mmI', 'interior'),
+                  ('mm1n', 'interior_1n'), ('mm23', 'interior_23'),
+                  ('mmE', 'exterior')]:
+    P[x] = _table(_section(raw, 'mismatch_' + name, scale), (7, 5, 5), (1, 0, 0))
+  P['int11'] = _table(_section(raw, 'int11', scale), (7, 7, 5, 5), (1, 1, 0, 0))
+  P['int21'] = _table(_section(raw, 'int21', scale), (7, 7, 5, 5, 5),
+                      (1, 1, 0, 0, 0))
+  P['int22'] = _table(_section(raw, 'int22', scale), (6, 6, 4, 4, 4, 4),
+                      (1, 1, 1, 1, 1, 1))
+  for x in ['hairpin', 'bulge', 'interior']:
+    P[x] = _section(raw, x, scale)
+  misc = [_value(x) for x in raw['Misc']]
+  P['init'] = _rescale(misc[0], misc[1], scale)
+  P['au'] = [0.0] * 3 + [_rescale(misc[2], misc[3], scale)] * 5
+  P['lxc'] = misc[4] * scale
+  ninio = [_value(x) for x in raw['NINIO']]
+  P['ninio'] = _rescale(ninio[0], ninio[1], scale)
+  P['maxninio'] = ninio[2]
+  P['special'] = {} #tri-, tetra- and hexaloops with their closing pair
+  for x in ['Triloops', 'Tetraloops', 'Hexaloops']:
+    for i in range(0, len(raw[x]), 3):
+      P['special'][raw[x][i]] = _rescale(_value(raw[x][i+1]),
+                                         _value(raw[x][i+2]), scale)
+  d5 = _table(_section(raw, 'dangle5', scale), (7, 5), (1, 0))
+  d3 = _table(_section(raw, 'dangle3', scale), (7, 5), (1, 0))
+  P['ext'] = _Table()
+  for t in range(1, 8):
+    for si in range(6):
+      for sj in range(6):
+        if si < 5 and sj < 5:
+          e = P['mmE'][t, si, sj]
+        elif si < 5:
+          e = d5[t, si]
+        elif sj < 5:
+          e = d3[t, sj]
+        else:
+          e = 0.0
+        P['ext'][t, si, sj] = e + P['au'][t]
+  P['ptype'] = dict(((a, b), 0) for a in range(6) for b in range(6))
+  for x in _pairTypes:
+    P['ptype']['_ACGU'.index(x[0]), '_ACGU'.index(x[1])] = _pairTypes[x]
+  if dense:
+    shapes = { 'stack' : (8, 8), 'mmH' : (8, 6, 6), 'mmI' : (8, 6, 6),
+               'mm1n' : (8, 6, 6), 'mm23' : (8, 6, 6), 'mmE' : (8, 6, 6),
+               'int11' : (8, 8, 6, 6), 'int21' : (8, 8, 6, 6, 6),
+               'int22' : (8, 8, 6, 6, 6, 6), 'ext' : (8, 6, 6) }
+    for x in shapes:
+      P[x] = _dense(P[x], shapes[x])
+    P['ptype'] = _dense(P['ptype'], (6, 6)).astype(np.int64)
+    P['au'] = np.array(P['au'])
+    P['rtype'] = np.array(_rtype)
+    # special loops by length, indexed by the base codes as base 4 number
+    codes = {}
+    for x in P['special']:
+      a = codes.setdefault(len(x), np.full(4 ** len(x), _inf))
+      a[sum(['ACGU'.index(x[k]) * 4 ** (len(x) - 1 - k)
+             for k in range(len(x))])] = P['special'][x]
+    P['special'] = codes
+  _params_cache[(temperature, dense)] = P
+  return P
+
+###############################################################################
+# Returns base codes of seq (see above)
+###############################################################################
+def _bases(seq):
+  return [max(0, '_ACGU'.find(x)) for x in seq.upper().replace('T', 'U')]
+
+###############################################################################
+# Returns loop initiation dG of size from table name of P (longer loops:
+# extrapolated)
+###############################################################################
+def _loop(P, name, size):
+  if size <= 30:
+    return P[name][size]
+  return P[name][30] + P['lxc'] * log(size / 30.0)
+
+###############################################################################
+# Returns dG of the hairpin loop of size closed by a pair of type t with the
+# bases si, sj (first mismatch); without the special loops. The functions
+# below take single codes (tables of _params) or arrays of codes (tables of
+# _params with dense=True)
+###############################################################################
+def _hairpin_loop(P, size, t, si, sj):
+  if size == 3:
+    return _loop(P, 'hairpin', size) + P['au'][t]
+  return _loop(P, 'hairpin', size) + P['mmH'][t, si, sj]
+
+###############################################################################
+# Returns dG of the loop between the pair (i, j) of type t and the enclosed
+# pair (p, q) of reversed type t2, with n1 = p - i - 1 and n2 = j - q - 1
+# unpaired bases and the bases si = i + 1, sj = j - 1, sp = p - 1, sq = q + 1:
+# stack, bulge or interior loop
+###############################################################################
+def _interior(P, n1, n2, t, t2, si, sj, sp, sq):
+  nl, ns = max(n1, n2), min(n1, n2)
+  if nl == 0:
+    return P['stack'][t, t2]
+  if ns == 0:
+    if nl == 1:
+      return _loop(P, 'bulge', nl) + P['stack'][t, t2]
+    return _loop(P, 'bulge', nl) + P['au'][t] + P['au'][t2]
+  if nl == 1:
+    return P['int11'][t, t2, si, sj]
+  if nl == 2 and ns == 1:
+    if n1 == 1:
+      return P['int21'][t, t2, si, sq, sj]
+    return P['int21'][t2, t, sq, si, sp]
+  if nl == 2:
+    return P['int22'][t, t2, si, sp, sq, sj]
+  mm = 'mm1n' if ns == 1 else 'mm23' if ns == 2 and nl == 3 else 'mmI'
+  return _loop(P, 'interior', nl + ns) + min(P['maxninio'], (nl - ns) * P['ninio']) + \
+         P[mm][t, si, sj] + P[mm][t2, sq, sp]
+
+###############################################################################
+# Returns dG of the duplex of seq with its complement: most stable helix of
+# the pairs a to b of the two strands (the terminal pairs may stay open, if
+# their stack is weaker than the terminal mismatch of the shorter helix),
+# i.e. init + left[a] + stacks[a:b] + right[b], with the exterior loop terms
+# left and right of the helix ends
+###############################################################################
+def duplex(seq, temperature=_T37):
+  P = _params(temperature)
+  s = _bases(seq)
+  sx = [5] + s + [5]
+  cx = [5] + [_comp[x] for x in s] + [5]
+  t = [_wc[x] for x in s]
+  best = left = _inf
+  stacks = 0.0
+  for b in range(len(s)):
+    if b > 0:
+      stacks += P['stack'][t[b-1], _rtype[t[b]]]
+    left = min(left, P['ext'][t[b], sx[b], cx[b]] - stacks)
+    best = min(best, left + stacks + P['ext'][_rtype[t[b]], cx[b+2], sx[b+2]])
+  return (P['init'] + best) / 100.0
+
+###############################################################################
+# Returns sequences as matrix of base codes (A, C, G, T/U: 0-3; one row per
+# sequence) for the batch computations; None without numpy or if the
+# sequences differ in length or contain other characters
+###############################################################################
+def _codes(seqs):
+  if np is None or len(seqs) == 0 or len(set(map(len, seqs))) != 1:
+    return None
+  code = np.full(256, 4, dtype=np.int64)
+  for i in range(4):
+    code[ord('ACGT'[i])] = code[ord('acgt'[i])] = i
+  code[ord('U')] = code[ord('u')] = 3
+  m = code[np.frombuffer(''.join(seqs).encode('ascii'), dtype=np.uint8)]
+  if (m == 4).any():
+    return None
+  return m.reshape(len(seqs), -1)
+
+###############################################################################
+# Returns base codes (see above) of the matrix of _codes with a column of
+# 'no base' (5) on both sides, for the neighbors of the strand ends
+###############################################################################
+def _padded(b):
+  end = np.full((b.shape[0], 1), 5, dtype=b.dtype)
+  return np.concatenate([end, b, end], axis=1)
+
+###############################################################################
+# Returns dG of the duplexes of seqs with their complements (see duplex);
+# sequences of equal length are computed in one batch (numpy, falls back to
+# duplex), with cumulative sums of the stacks and running minima of the left
+# ends
+###############################################################################
+def duplex_batch(seqs, temperature=_T37):
+  m = _codes(seqs)
+  if m is None:
+    return [duplex(x, temperature) for x in seqs]
+  P = _params(temperature, True)
+  b = m + 1
+  bx = _padded(b)
+  cx = _padded(np.array(_comp)[b])
+  t = np.array(_wc)[b]
+  rt = P['rtype'][t]
+  n = b.shape[1]
+  stacks = np.zeros(t.shape)
+  stacks[:, 1:] = np.cumsum(P['stack'][t[:, :-1], rt[:, 1:]], axis=1)
+  left = np.minimum.accumulate(P['ext'][t, bx[:, :n], cx[:, :n]] - stacks, axis=1)
+  dg = (left + stacks + P['ext'][rt, cx[:, 2:], bx[:, 2:]]).min(axis=1)
+  return ((P['init'] + dg) / 100.0).tolist()
+
+###############################################################################
+# Returns dG of the homodimer of seq: most stable duplex of two copies of
+# seq (intermolecular pairs; stacks, bulges and interior loops, terminal
+# mismatches or dangling ends at the helix ends), as computed by RNAduplex of
+# the ViennaRNA Package; c[i, j] is the dG of the most stable duplex whose
+# last pair is base i of the first and base j of the second copy
+###############################################################################
+def homodimer(seq, temperature=_T37):
+  P = _params(temperature)
+  s = _bases(seq)
+  sx = [5] + s + [5]
+  n = len(s)
+  c = {}
+  best = 0.0
+  for i in range(n):
+    for j in range(n - 1, -1, -1):
+      t = P['ptype'][s[i], s[j]]
+      if t == 0:
+        continue
+      e = P['init'] + P['ext'][t, sx[i], sx[j+2]]
+      for n1 in range(min(_maxLoop, i - 1) + 1):
+        for n2 in range(min(_maxLoop - n1, n - j - 2) + 1):
+          k, l = i - n1 - 1, j + n2 + 1
+          if (k, l) in c:
+            e = min(e, c[k, l] + _interior(P, n1, n2, P['ptype'][s[k], s[l]],
+                    _rtype[t], s[k+1], s[l-1], s[i-1], s[j+1]))
+      c[i, j] = e
+      best = min(best, e + P['ext'][_rtype[t], sx[j], sx[i+2]])
+  return best / 100.0
+
+###############################################################################
+# Returns homodimer dG of seqs (see homodimer); sequences of equal length are
+# computed in one batch (numpy, falls back to homodimer): per base i of the
+# first copy, c[i] holds the values of all bases j of the second copy, and
+# each loop size (n1, n2) is evaluated for all j and sequences at once
+###############################################################################
+def homodimer_batch(seqs, temperature=_T37):
+  m = _codes(seqs)
+  if m is None:
+    return [homodimer(x, temperature) for x in seqs]
+  P = _params(temperature, True)
+  b = m + 1
+  bx = _padded(b)
+  N, n = b.shape
+  T = P['ptype'][b[:, :, None], b[:, None, :]]
+  c = np.full((n, N, n), _inf)
+  best = np.zeros(N)
+  for i in range(n):
+    t = T[:, i, :]
+    rt = P['rtype'][t]
+    e = P['init'] + P['ext'][t, bx[:, [i]], bx[:, 2:]]
+    for n1 in range(min(_maxLoop, i - 1) + 1):
+      k = i - n1 - 1
+      for n2 in range(min(_maxLoop - n1, n - 2) + 1):
+        J = np.arange(n - n2 - 1)
+        L = J + n2 + 1
+        dg = c[k][:, L] + _interior(P, n1, n2, T[:, k, L], rt[:, J], b[:, [k+1]],
+                                    b[:, L-1], b[:, [i-1]], b[:, J+1])
+        e[:, J] = np.minimum(e[:, J], dg)
+    c[i] = np.where(t > 0, e, _inf)
+    best = np.minimum(best, (c[i] + P['ext'][rt, bx[:, :n], bx[:, [i+2]]]).min(axis=1))
+  return (best / 100.0).tolist()
+
+###############################################################################
+# Returns dG of the unimolecular self-structure of seq: minimum free energy
+# structure of hairpins with stacks, bulges and interior loops, as computed by
+# RNAfold of the ViennaRNA Package (multiloops are not considered; they are
+# not stable in sequences of the length of probe arms); C[i, j] is the dG of
+# the most stable structure closed by the pair (i, j)
+###############################################################################
+def hairpin(seq, temperature=_T37):
+  P = _params(temperature)
+  seq = seq.upper().replace('T', 'U')
+  s = _bases(seq)
+  sx = [5] + s + [5]
+  n = len(s)
+  C = {}
+  for d in range(4, n):
+    for i in range(n - d):
+      j = i + d
+      t = P['ptype'][s[i], s[j]]
+      if t == 0:
+        continue
+      e = P['special'].get(seq[i:j+1], _hairpin_loop(P, d - 1, t, s[i+1], s[j-1]))
+      for n1 in range(min(_maxLoop, d - 6) + 1):
+        for n2 in range(min(_maxLoop - n1, d - 6 - n1) + 1):
+          p, q = i + n1 + 1, j - n2 - 1
+          if (p, q) in C:
+            e = min(e, C[p, q] + _interior(P, n1, n2, t, _rtype[P['ptype'][s[p], s[q]]],
+                    s[i+1], s[j-1], s[p-1], s[q+1]))
+      C[i, j] = e
+  F = [0.0] * (n + 1)
+  for i in range(n - 5, -1, -1):
+    F[i] = F[i+1]
+    for l in range(i + 4, n):
+      if (i, l) in C:
+        F[i] = min(F[i], C[i, l] + F[l+1] +
+                   P['ext'][P['ptype'][s[i], s[l]], sx[i], sx[l+2]])
+  return F[0] / 100.0
+
+###############################################################################
+# Returns hairpin dG of seqs (see hairpin); sequences of equal length are
+# computed in one batch (numpy, falls back to hairpin): per distance d of the
+# paired bases, C[d] holds the values of all pairs (i, i + d), and each loop
+# size (n1, n2) is evaluated for all i and sequences at once
+###############################################################################
+def hairpin_batch(seqs, temperature=_T37):
+  m = _codes(seqs)
+  if m is None:
+    return [hairpin(x, temperature) for x in seqs]
+  P = _params(temperature, True)
+  b = m + 1
+  bx = _padded(b)
+  N, n = b.shape
+  T = P['ptype'][b[:, :, None], b[:, None, :]]
+  C = {}
+  for d in range(4, n):
+    I = np.arange(n - d)
+    J = I + d
+    t = T[:, I, J]
+    e = _hairpin_loop(P, d - 1, t, b[:, I+1], b[:, J-1])
+    if d + 1 in P['special']:
+      code = sum([m[:, I+k] * 4 ** (d - k) for k in range(d + 1)])
+      special = P['special'][d + 1][code]
+      e = np.where(special < _inf, special, e)
+    for n1 in range(min(_maxLoop, d - 6) + 1):
+      for n2 in range(min(_maxLoop - n1, d - 6 - n1) + 1):
+        Q = J - n2 - 1
+        dg = C[d - n1 - n2 - 2][:, I + n1 + 1] + \
+             _interior(P, n1, n2, t, P['rtype'][T[:, I + n1 + 1, Q]], b[:, I+1],
+                       b[:, J-1], b[:, I + n1], b[:, Q+1])
+        e = np.minimum(e, dg)
+    C[d] = np.where(t > 0, e, _inf)
+  F = np.zeros((n + 1, N))
+  for i in range(n - 5, -1, -1):
+    F[i] = F[i+1]
+    for l in range(i + 4, n):
+      F[i] = np.minimum(F[i], C[l - i][:, i] + F[l+1] +
+                        P['ext'][T[:, i, l], bx[:, i], bx[:, l+2]])
+  return (F[0] / 100.0).tolist()
+
+###############################################################################
+# Returns free energies of many probe arms in oligoscreen output format
+# (header line, then per sequence: seq, bimol., unimol., duplex, 2bp at 5',
+# 2bp at 3'); the 2bp values are the costs of opening the two terminal pairs,
+# i.e. the dG of the duplex without them minus the duplex dG (positive, as 
+# reported by oligoscreen)
+###############################################################################
+def nn_fold(seqs, temperature=_T37):
+  dup = duplex_batch(seqs, temperature)
+  dup5 = duplex_batch([x[2:] for x in seqs], temperature)
+  dup3 = duplex_batch([x[:-2] for x in seqs], temperature)
+  bimol = homodimer_batch(seqs, temperature)
+  unimol = hairpin_batch(seqs, temperature)
+  dg = ["Sequence\tDG_bimolecular\tDG_unimolecular\tDG_duplex\t" +
+        "DG_2bpat5'\tDG_2bpat3'"]
+  for i in range(len(seqs)):
+    vals = [bimol[i], unimol[i], dup[i], dup5[i] - dup[i], dup3[i] - dup[i]]
+    vals = [round(x, 6) for x in vals] #batch and serial sums round alike
+    dg.append(seqs[i] + '\t' + '\t'.join([str(round(x, 1)) for x in vals]))
+  return dg
@@ -4,11 +4,19 @@
 # written by Daniel C. Ellwanger <dcellwanger.dev@gmail.com>
 # last modified Jul 18 2018
 ###############################################################################
-import os
+import os, signal, threading, tempfile, shutil, atexit
 from math import log10, log
-from subprocess import call
+from subprocess import Popen, PIPE
+from Queue import Queue
 from Tkinter import Text, DISABLED, NORMAL, END
-from itertools import compress
+from bisect import bisect_right
+from itertools import compress, izip
+from array import array
+from plishProfile import profiled, count
+try: #optional, used for batch computations
+  import numpy as np
+except ImportError:
+  np = None
 
 ###############################################################################
 # Get tool path
@@ -19,6 +27,12 @@ def get_script_path():
   return pth
   #return os.path.dirname(os.path.realpath(sys.argv[0]))
 
+###############################################################################
+# Get path of the external tools (tools/, or $PLISH_TOOLS if set)
+###############################################################################
+def get_tool_path():
+  return os.environ.get('PLISH_TOOLS', get_script_path() + '/tools')
+
 ###############################################################################
 # Calculate reverse complement
 ###############################################################################
@@ -61,33 +75,254 @@ def melttemp(seq, c_salt, p_formamide):
   return tm
   
 ###############################################################################
-# Returns free energy of RNA fold and duplices
+# Returns counts of A, T, G, C and lengths of sequences of equal length as 
+# columns of a matrix; sequences are encoded into one uint8 matrix
+###############################################################################
+def count_bases(seqs):
+  m = np.frombuffer(''.join(seqs).encode('ascii'), dtype=np.uint8)
+  m = m.reshape(len(seqs), -1)
+  counts = [(m == ord(b)).sum(axis=1) for b in 'ATGC']
+  counts.append(np.full(len(seqs), m.shape[1], dtype=int))
+  return counts
+
+###############################################################################
+# Returns sequence indices grouped by sequence length
+###############################################################################
+def _group_bylen(seqs):
+  len2idx = {}
+  for i in range(len(seqs)):
+    len2idx.setdefault(len(seqs[i]), list()).append(i)
+  return len2idx.values()
+
+###############################################################################
+# Calculate GC content (%) of many sequences; equals 
+# (seq.count('G') + seq.count('C')) * 100.0 / len(seq)
+###############################################################################
+@profiled
+def gccontent_batch(seqs):
+  if np is None:
+    return [(x.count('G') + x.count('C')) * 100.0 / len(x) for x in seqs]
+  gc = [None] * len(seqs)
+  for idx in _group_bylen(seqs):
+    wA, xT, yG, zC, l = count_bases([seqs[i] for i in idx])
+    res = ((yG + zC) * 100.0 / l).tolist()
+    for i in range(len(idx)):
+      gc[idx[i]] = res[i]
+  return gc
+
+###############################################################################
+# Calculate melt temperature of many sequences; same equations and results 
+# as melttemp
+###############################################################################
+@profiled
+def melttemp_batch(seqs, c_salt, p_formamide):
+  if np is None:
+    return [melttemp(x, c_salt, p_formamide) for x in seqs]
+  tms = [None] * len(seqs)
+  for idx in _group_bylen(seqs):
+    wA, xT, yG, zC, l = count_bases([seqs[i] for i in idx])
+    wA, xT, yG, zC = [x.astype(float) for x in [wA, xT, yG, zC]]
+    if c_salt == None and p_formamide == None:
+      tm = 64.9+41*(yG+zC-16.4)/(wA+xT+yG+zC)
+    elif p_formamide == None:
+      tm = 100.5+(41*(yG+zC)/(wA+xT+yG+zC))
+      tm = tm-(820/(wA+xT+yG+zC))+16.6*log10(c_salt)
+    else:
+      tm = 81+16.6*log(c_salt)+0.41*(yG/l+zC/l) 
+      tm = tm-500/l-0.61*p_formamide
+    res = tm.tolist()
+    for i in range(len(idx)):
+      tms[idx[i]] = res[i]
+  return tms
+  
+###############################################################################
+# Raised by the pipeline if the run was cancelled (see cancel_run)
+###############################################################################
+class Cancelled(Exception):
+  pass
+
+###############################################################################
+# Private cancellation state of a run: cancel flag and running commands. 
+# Threads use a shared default state unless they bind their own (bind_run), 
+# e.g. for concurrent runs in the design service.
+###############################################################################
+class _RunControl:
+  # Constructor
+  def __init__(self):
+    self.event = threading.Event()
+    self.procs = set()
+
+  # Attributes
+  event = procs = None
+
+_defaultControl = _RunControl()
+_local = threading.local()
+
+def _control():
+  return getattr(_local, 'control', _defaultControl)
+
+###############################################################################
+# Binds a new cancellation state to the calling thread and returns it (to be
+# passed to cancel_run from another thread)
 ###############################################################################
-def fold(infile, temperature):
+def bind_run():
+  _local.control = _RunControl()
+  return _local.control
+
+###############################################################################
+# Runs shell command cmd in its own process group, so that it can be killed 
+# by cancel_run; data is passed to its stdin, its stdout is returned
+###############################################################################
+def run_cmd(cmd, data=None):
+  check_cancel()
+  count('subprocesses')
   devnull = open(os.devnull, 'w')
-  exe = get_script_path() + "/tools/RNAstructure/exe/oligoscreen "
+  p = Popen(cmd, shell=True, stdin=PIPE if data is not None else devnull, 
+            stdout=PIPE, stderr=devnull, preexec_fn=os.setpgrp)
+  procs = _control().procs
+  procs.add(p)
+  try:
+    out = p.communicate(data)[0]
+  except: #e.g. KeyboardInterrupt
+    _kill(p)
+    raise
+  finally:
+    procs.discard(p)
+    devnull.close()
+  check_cancel()
+  count('pipe_bytes', len(out) + (len(data) if data is not None else 0))
+  return out
+
+def _kill(p):
+  try:
+    os.killpg(p.pid, signal.SIGTERM)
+  except OSError: #already finished
+    pass
+
+###############################################################################
+# Cancels a run (default: the one of the calling thread's state): kills the 
+# running commands; the pipeline raises Cancelled at the next check
+###############################################################################
+def cancel_run(control=None):
+  if control is None:
+    control = _control()
+  control.event.set()
+  for p in list(control.procs):
+    _kill(p)
+
+def reset_cancel():
+  _control().event.clear()
+
+def check_cancel():
+  if _control().event.is_set():
+    raise Cancelled()
+
+###############################################################################
+# Returns private scratch directory of this run for the files of the external
+# tools (in memory, /dev/shm, if available; otherwise in tmp/); it is removed 
+# at exit. Worker processes share the directory of their parent (file names 
+# are unique), so it has to be created before they are started.
+###############################################################################
+_scratch = None
+_scratchLock = threading.Lock()
+def get_scratch_dir():
+  global _scratch
+  with _scratchLock:
+    if _scratch is not None:
+      return _scratch
+    parent = get_script_path() + '/tmp'
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+      parent = '/dev/shm'
+    _scratch = tempfile.mkdtemp(prefix='plish_', dir=parent)
+    atexit.register(shutil.rmtree, _scratch, True)
+    return _scratch
+
+###############################################################################
+# Removes temporary files if they exist (counting their size)
+###############################################################################
+def _remove(*files):
+  for x in files:
+    if os.path.exists(x):
+      count('tempfile_bytes', os.path.getsize(x))
+      os.remove(x)
+
+###############################################################################
+# Returns free energy of RNA fold and duplices of sequences (oligoscreen 
+# output lines); oligoscreen reads and writes files, which are placed in the
+# scratch directory
+###############################################################################
+@profiled
+def fold(seqs, temperature):
+  exe = get_tool_path() + "/RNAstructure/exe/oligoscreen "
+  fd, infile = tempfile.mkstemp(suffix='.seq', dir=get_scratch_dir())
   outfile = infile + ".out"
+  with os.fdopen(fd, 'w') as f:
+    f.write("\n".join(seqs) + "\n")
+  f.close()
   t = "--temperature " + str(temperature)
   cmd = exe + infile + " " + outfile + " " + t
-  call([cmd], shell=True, stdout=devnull, stderr=devnull)
-  with open(outfile) as f:
-    content = f.readlines()
-  f.close()
+  try:
+    run_cmd(cmd)
+    with open(outfile) as f:
+      content = f.readlines()
+    f.close()
+  finally:
+    _remove(infile, outfile)
   dg = [x.strip() for x in content]
-  os.remove(infile)
-  os.remove(outfile)
-  devnull.close()
   return(dg)
 
+###############################################################################
+# Returns file stamp (size and modification time) used to detect stale indexes
+###############################################################################
+def file_stamp(filepath):
+  return str(os.path.getsize(filepath)) + ',' + str(int(os.path.getmtime(filepath)))
+
+###############################################################################
+# Returns byte offset of transcript id in the sequence ('fna') or exon 
+# ('exons') file of db; None if the index is missing, stale or has no entry
+###############################################################################
+_dbIndex = {}
+def fetch_offset(transcript_id, db, ftype):
+  dbpath = get_script_path() + '/database/' + db + '/' + db
+  filepath = dbpath + '.index'
+  if not os.path.exists(filepath):
+    return None
+  stamp = { 'fna' : file_stamp(dbpath + '.fna'), 
+            'exons' : file_stamp(dbpath + '.exons') }
+  if db not in _dbIndex or _dbIndex[db][0] != stamp:
+    tx2offset = {}
+    with open(filepath) as fh:
+      header = fh.readline().strip()[1:].split("\t")
+      if dict(x.split("=") for x in header) != stamp:
+        return None
+      for line in fh:
+        idat = line.split("\t")
+        tx2offset[idat[0]] = (int(idat[1]), int(idat[2]))
+    fh.close()
+    _dbIndex[db] = (stamp, tx2offset)
+  offsets = _dbIndex[db][1].get(transcript_id)
+  i = 1 if ftype == 'exons' else 0
+  if offsets is None or offsets[i] < 0:
+    return None
+  return offsets[i]
+
 ###############################################################################
 # Returns exon lengths for transcript id (considering strand)
 ############################################################################### 
+@profiled
 def fetch_exonLen(transcript_id, db):
   filepath = get_script_path() + '/database/' + db + '/' + db + '.exons'
   exon_lens = list()
   transcript_id = transcript_id.split('.')[0]
+  offset = fetch_offset(transcript_id, db, 'exons')
   
   with open(filepath) as fh:
+    if offset is not None: #seek to record
+      fh.seek(offset)
+      edat = fh.readline().split("\t")
+      if transcript_id == edat[0].split(".")[0]:
+        return list(map(int, edat[6].split(",")))
+      fh.seek(0)
     for line in fh:
       edat = line.split("\t")
       edat_id = edat[0].split(".")[0]
@@ -101,13 +336,24 @@ def fetch_exonLen(transcript_id, db):
 ###############################################################################
 # Returns sequence and gene name for transcript id (considering strand)
 ############################################################################### 
+@profiled
 def fetch_seq(transcript_id, db):
   filepath = get_script_path() + '/database/' + db + '/' + db + '.fna'
   exon_lens = list()
   transcript_id = transcript_id.split('.')[0]
   seq = name = sid = None
+  offset = fetch_offset(transcript_id, db, 'fna')
   
   with open(filepath) as fh:
+    if offset is not None: #seek to record
+      fh.seek(offset)
+      sdat = fh.readline().split("|")
+      if transcript_id == sdat[0][1:].split(".")[0]:
+        name = sdat[1].strip()
+        sid = sdat[0][1:]
+        seq = fh.readline().strip().upper()
+        return name, sid, seq
+      fh.seek(0)
     match = False
     for line in fh:
       if line.startswith(">"):
@@ -124,30 +370,51 @@ def fetch_seq(transcript_id, db):
   return name, sid, seq
   
 ###############################################################################
-# Returns BLAST results
+# Returns BLAST results of the query (FASTA text); query and results are 
+# passed through stdin and stdout of blastn
 ############################################################################### 
-def blast(infile, db):#, taxonid): #nr
+@profiled
+def blast(query, db):#, taxonid): #nr
   db = get_script_path() + "/database/" + db + "/" + db
-  devnull = open(os.devnull, 'w')
-  exe = get_script_path() + "/tools/ncbi-blast/bin/blastn "
-  outfile = infile + ".blast"
+  exe = get_tool_path() + "/ncbi-blast/bin/blastn "
   #org = '-entrez_query "txid' + str(taxonid) + ' [ORGN]" '
-  query = '-query ' + infile + ' '  
   task = '-task megablast '
   db = '-db ' + db + ' '
-  out = '-out ' + outfile + ' '
   outfmt = '-outfmt 6 '
   evalue = '-evalue 10 '
-  cmd = exe + query + task + db + out + outfmt + evalue #+ org + '-remote'
-  call([cmd], shell=True, stdout=devnull, stderr=devnull)
-  with open(outfile) as f:
-    content = f.readlines()
-  f.close()
-  res = [x.strip() for x in content]
-  os.remove(infile)
-  os.remove(outfile)
+  cmd = exe + '-query - ' + task + db + outfmt + evalue #+ org + '-remote'
+  content = run_cmd(cmd, query).splitlines()
+  res = [x.strip() for x in content if x.strip() != '']
   return(res)
 
+###############################################################################
+# Returns all transcript ids of db (in order of the exon file)
+############################################################################### 
+@profiled
+def fetch_txIds(db):
+  filepath = get_script_path() + '/database/' + db + '/' + db + '.exons'
+  with open(filepath) as fh:
+    txids = [line.split("\t", 1)[0] for line in fh]
+  fh.close()
+  return txids
+
+###############################################################################
+# Returns transcript ids of all isoforms of gene symbol in db (in order of the
+# exon file; quotes of the gene names are ignored)
+############################################################################### 
+@profiled
+def fetch_geneTxIds(symbol, db):
+  filepath = get_script_path() + '/database/' + db + '/' + db + '.exons'
+  symbol = symbol.replace('"', '')
+  txids = list()
+  with open(filepath) as fh:
+    for line in fh:
+      edat = line.split("\t", 2)
+      if edat[1].replace('"', '') == symbol:
+        txids.append(edat[0])
+  fh.close()
+  return txids
+
 ###############################################################################
 # Fetch database info
 ############################################################################### 
@@ -166,53 +433,250 @@ def fetch_dbInfo():
         dbids.append(line.split("=")[1])
   return dbnames, dbids
 
+###############################################################################
+# Returns version of database (time of creation); falls back to the stamp of
+# the sequence file for databases without version in the info file
+############################################################################### 
+def fetch_dbVersion(db):
+  dbpath = get_script_path() + '/database/' + db + '/' + db
+  with open(dbpath + '.info') as f:
+    content = f.read().splitlines()
+  for line in content:
+    if line.startswith("dbversion"):
+      return line.split("=")[1]
+  return file_stamp(dbpath + '.fna')
+
 ###############################################################################
 # Shows progress log
 ############################################################################### 
 def show_log(pr, txt):
     print pr
-    if txt is not None:
-      txt.config(state=NORMAL)
-      txt.insert(END, pr + "\n")
-      txt.see(END)
-      txt.config(state=DISABLED)
-      txt.update()
+    if isinstance(txt, Queue): #GUI worker thread
+      txt.put(('log', pr))
+    elif txt is not None:
+      show_txt(pr, txt)
+
+###############################################################################
+# Appends log line to the progress text widget of the GUI
+############################################################################### 
+def show_txt(pr, txt):
+    txt.config(state=NORMAL)
+    txt.insert(END, pr + "\n")
+    txt.see(END)
+    txt.config(state=DISABLED)
+    txt.update()
+
+###############################################################################
+# Show progress of a stage (done of total probes); a GUI queue additionally
+# receives a progress event
+###############################################################################
+def show_progress(done, total, txt):
+  show_log('  ' + str(done) + '/' + str(total) + ' probes', txt)
+  if isinstance(txt, Queue):
+    txt.put(('progress', done, total))
       
 ###############################################################################
-# Filter probes
+# Default filter settings
+###############################################################################
+filter_defaults = { 'spec' : 'isoform',
+                    'mingc' : 45, 
+                    'multiexon' : True, 
+                    'mintm' : 55, 
+                    'maxtm' : 65, 
+                    'mindimer' : -10, 
+                    'minfold' : -10, 
+                    'maxduplex' : -30 }
+
+###############################################################################
+# Returns the given columns of the probes (see plishHprobe.ProbeTable); for a
+# list of Hprobe, the columns are collected from the attributes
+###############################################################################
+specNames = ['none', 'gene', 'isoform']
+_specRank = dict((specNames[i], i) for i in range(len(specNames)))
+_getters = { 'index' : lambda x: x.index, 'seq' : lambda x: x.seq, 
+             'gc' : lambda x: x.gc, 'bhits' : lambda x: x.bhits,
+             'exon5' : lambda x: x.exons[0], 'exon3' : lambda x: x.exons[1],
+             'spec' : lambda x: _specRank[x.spec] }
+for _a in ['seq', 'tm', 'dg_bimol', 'dg_uimol', 'dg_duplex', 'dg_2bpat5', 
+           'dg_2bpat3']:
+  _getters['l_' + _a] = lambda x, a=_a: getattr(x.larm, a)
+  _getters['r_' + _a] = lambda x, a=_a: getattr(x.rarm, a)
+def probe_columns(hprobes, names):
+  if hasattr(hprobes, 'columns'):
+    return [hprobes.columns[x] for x in names]
+  return [[_getters[x](hp) for hp in hprobes] for x in names]
+
+###############################################################################
+# Returns the probes for which mask is true (list or ProbeTable, as given)
+###############################################################################
+def select_probes(hprobes, mask):
+  if hasattr(hprobes, 'select'):
+    return hprobes.select(mask)
+  return list(compress(hprobes, mask))
+
+###############################################################################
+# Returns numpy view (no copy) of a typed column (array); the dtype is derived
+# from the item size, since the size of typecode 'l' depends on the platform
+###############################################################################
+def array_view(col):
+  kind = 'f' if col.typecode in 'fd' else 'u' if col.typecode in 'BHIL' else 'i'
+  return np.frombuffer(col, np.dtype(kind + str(col.itemsize)))
+
+###############################################################################
+# Returns filter mask of the probes: test is evaluated on whole columns (with
+# numpy) or per probe; it may only combine comparisons with & and |
+###############################################################################
+def _probe_mask(hprobes, names, test):
+  cols = probe_columns(hprobes, names)
+  if len(hprobes) == 0:
+    return list()
+  if np is not None: #typed columns (arrays) are used without copy
+    cols = [array_view(x) if isinstance(x, array) else np.asarray(x) for x in cols]
+    return test(*cols)
+  return [test(*x) for x in izip(*cols)]
+
+###############################################################################
+# Filter masks: features known before folding and BLAST (GC content, melting
+# temperature, splice junction), free energies and specificity (isoform > 
+# gene > none)
+###############################################################################
+def _cheap_mask(hprobes, mingc, multiexon, mintm, maxtm):
+  return _probe_mask(hprobes, ['gc', 'exon5', 'exon3', 'l_tm', 'r_tm'],
+                     lambda gc, e5, e3, ltm, rtm: ((e5 != e3) | (not multiexon)) & 
+                     (gc > mingc) & (ltm > mintm) & (ltm < maxtm) & 
+                     (rtm > mintm) & (rtm < maxtm))
+
+def _fold_mask(hprobes, mindimer, minfold, maxduplex):
+  return _probe_mask(hprobes, ['l_dg_bimol', 'r_dg_bimol', 'l_dg_uimol', 
+                               'r_dg_uimol', 'l_dg_duplex', 'r_dg_duplex'],
+                     lambda lb, rb, lu, ru, ld, rd: (lb > mindimer) & 
+                     (rb > mindimer) & (lu > minfold) & (ru > minfold) & 
+                     (ld < maxduplex) & (rd < maxduplex))
+
+def _spec_mask(hprobes, spec):
+  minrank = _specRank[spec]
+  return _probe_mask(hprobes, ['spec'], lambda x: x >= minrank)
+
+###############################################################################
+# Filter probes by the features that are known before folding and BLAST
+###############################################################################
+@profiled
+def filter_cheap(hprobes, mingc, multiexon, mintm, maxtm):
+  return select_probes(hprobes, _cheap_mask(hprobes, mingc, multiexon, mintm, maxtm))
+
+###############################################################################
+# Filter probes by their free energies
+###############################################################################
+@profiled
+def filter_fold(hprobes, mindimer, minfold, maxduplex):
+  return select_probes(hprobes, _fold_mask(hprobes, mindimer, minfold, maxduplex))
+
+###############################################################################
+# Filter probes by their specificity
+###############################################################################
+@profiled
+def filter_spec(hprobes, spec):
+  return select_probes(hprobes, _spec_mask(hprobes, spec))
+
+###############################################################################
+# Filter probes (all masks are combined, so that the probes are selected once)
 ###############################################################################    
+@profiled
 def filter_probes(hprobes, spec, mingc, multiexon, mintm, maxtm, 
                   mindimer, minfold, maxduplex):     
-  if multiexon:
-    f = [x.exons[0] != x.exons[1] for x in hprobes]
-    hprobes = list(compress(hprobes, f))
-  
-  specCat = ['none','gene','isoform']  
-  d = dict([(y,x+1) for x,y in enumerate(set(specCat))])
-
-  f = [d[x.spec] >= d[spec] and
-       x.gc > mingc and
-       mintm < x.larm.tm < maxtm and
-       mintm < x.rarm.tm < maxtm and
-       x.larm.dg_bimol > mindimer and
-       x.rarm.dg_bimol > mindimer and
-       x.larm.dg_uimol > minfold and
-       x.rarm.dg_uimol > minfold and
-       x.larm.dg_duplex < maxduplex and
-       x.rarm.dg_duplex < maxduplex for x in hprobes]
-  return list(compress(hprobes, f))
+  f = [_cheap_mask(hprobes, mingc, multiexon, mintm, maxtm),
+       _fold_mask(hprobes, mindimer, minfold, maxduplex),
+       _spec_mask(hprobes, spec)]
+  if np is not None and len(hprobes) > 0:
+    f = f[0] & f[1] & f[2]
+  else:
+    f = [all(x) for x in izip(*f)]
+  return select_probes(hprobes, f)
       
 ###############################################################################
-# Write result CSV file
+# Returns score in [0, 1] per probe: mean of the balance of the arm melting
+# temperatures (1: equal, 0: 10 C or more apart), the GC content (1: 50%, 0:
+# 25% or more off) and the smallest free energy margin to the thresholds of
+# filters (dimer, fold and duplex; 1: 5 kcal/mol or more, 0: at threshold)
+###############################################################################
+@profiled
+def score_probes(hprobes, filters=None):
+  if filters is None:
+    filters = filter_defaults
+  mindimer = filters['mindimer']
+  minfold = filters['minfold']
+  maxduplex = filters['maxduplex']
+  cols = probe_columns(hprobes, ['gc', 'l_tm', 'r_tm', 'l_dg_bimol', 'r_dg_bimol',
+                                 'l_dg_uimol', 'r_dg_uimol', 'l_dg_duplex', 
+                                 'r_dg_duplex'])
+  scores = list()
+  for gc, ltm, rtm, lb, rb, lu, ru, ld, rd in izip(*cols):
+    margin = min(lb - mindimer, rb - mindimer, lu - minfold, ru - minfold,
+                 maxduplex - ld, maxduplex - rd)
+    scores.append((max(0.0, 1 - abs(ltm - rtm) / 10.0) + 
+                   max(0.0, 1 - abs(gc - 50) / 25.0) + 
+                   min(1.0, max(0.0, margin / 5.0))) / 3)
+  return scores
+
+###############################################################################
+# Selects the set of non-overlapping probes with the highest total score (see
+# score_probes) by weighted interval scheduling: neighbouring probes are at 
+# least spacing nt apart, and at most maxn probes are selected (None: no 
+# limit). Probes are sorted by position and the best set of the first j 
+# probes is best[j] = max(best[j-1], score[j] + best[p[j]]), where p[j] is the
+# number of probes ending before probe j starts (binary search); O(n log n),
+# O(n log n + maxn * n) with maxn. Returns the selected probes in input order.
+###############################################################################
+@profiled
+def pick_probes(hprobes, spacing=0, maxn=None, filters=None):
+  n = len(hprobes)
+  if n == 0 or maxn == 0:
+    return select_probes(hprobes, [False] * n)
+  score = score_probes(hprobes, filters)
+  index = probe_columns(hprobes, ['index'])[0]
+  order = sorted(range(n), key=lambda i: index[i])
+  starts = [index[i] - 19 for i in order]
+  ends = [index[i] + 21 + spacing for i in order] #probes have equal length
+  w = [score[i] for i in order]
+  p = [bisect_right(ends, starts[j]) for j in range(n)]
+  limit = maxn is not None and maxn < n
+  best = [[0.0] * (n + 1)] #best[k][j]: first j probes, at most k probes
+  for k in range(maxn if limit else 1):
+    prev = best[-1]
+    cur = [0.0] * (n + 1)
+    if not limit: #no limit: single recursion
+      prev = cur
+    for j in range(n):
+      cur[j + 1] = max(cur[j], w[j] + prev[p[j]])
+    best.append(cur)
+  picked = [False] * n
+  k = len(best) - 1
+  j = n
+  while j > 0 and k > 0:
+    if best[k][j] == best[k][j - 1]: #probe j-1 not needed
+      j -= 1
+      continue
+    picked[order[j - 1]] = True
+    j = p[j - 1]
+    if limit:
+      k -= 1
+  return select_probes(hprobes, picked)
+
+###############################################################################
+# Write result CSV file; isoforms (dict: probe sequence -> transcript ids) 
+# adds the isoforms covered by each probe as last column
 ###############################################################################
-def write_probesCSV(inputId, inputName, hprobes, txt):
+@profiled
+def write_probesCSV(inputId, inputName, hprobes, txt, result_fn=None, append=False,
+                    isoforms=None):
   inputName = inputName.replace('"', '')
-  result_fn = get_script_path() + "/results/" + inputName
-  result_fn += "-" + inputId + "_hprobe.csv"
+  if result_fn is None:
+    result_fn = get_script_path() + "/results/" + inputName
+    result_fn += "-" + inputId + "_hprobe.csv"
   
   n_probes = str(len(hprobes))
   show_log('Writing result file for ' + n_probes + ' filtered probes ...', txt)
-  with open(result_fn, "w") as fh:
+  with open(result_fn, "a" if append else "w") as fh:
     h = 'Hprobe: Id\t'
     h += 'Hprobe: Target sequence\t'
     h += 'Hprobe: %GC\t'
@@ -226,29 +690,28 @@ def write_probesCSV(inputId, inputName, hprobes, txt):
     h += 'Right: Seq\t' + 'Right: Tm\t'
     h += 'Right: Bimol.\t' + 'Right: Unimol.\t' + 'Right: Duplex\t'
     h += 'Right: Open5\t' + 'Right: Open3'
-    fh.write(h + '\n')
-    for hp in hprobes:
-      l = inputName + '-' + inputId + '-' + str(hp.start + 1) + '\t'
-      l += hp.seq + '\t'
-      l += str(round(hp.gc, 1)) + '\t'
-      l += str(hp.exons[0] != hp.exons[1]) + '\t'
-      l += str(hp.exons).replace('[', '').replace(']', '') + '\t'
-      l += hp.spec + '\t'
-      l += str(hp.bhits).replace('[', '').replace(']', '') + '\t'
-      l += hp.larm.seq + '\t'
-      l += str(hp.larm.tm) + '\t'
-      l += str(hp.larm.dg_bimol) + '\t'
-      l += str(hp.larm.dg_uimol) + '\t'
-      l += str(hp.larm.dg_duplex) + '\t'
-      l += str(hp.larm.dg_2bpat5) + '\t'
-      l += str(hp.larm.dg_2bpat3) + '\t'
-      l += hp.rarm.seq + '\t'
-      l += str(hp.rarm.tm) + '\t'
-      l += str(hp.rarm.dg_bimol) + '\t'
-      l += str(hp.rarm.dg_uimol) + '\t'
-      l += str(hp.rarm.dg_duplex) + '\t'
-      l += str(hp.rarm.dg_2bpat5) + '\t'
-      l += str(hp.rarm.dg_2bpat3) + '\t'
+    if isoforms is not None:
+      h += '\tHprobe: Isoforms'
+    if not append:
+      fh.write(h + '\n')
+    names = ['index', 'seq', 'gc', 'exon5', 'exon3', 'spec', 'bhits'] + \
+            [p + x for p in ['l_', 'r_'] for x in ['seq', 'tm', 'dg_bimol', 
+             'dg_uimol', 'dg_duplex', 'dg_2bpat5', 'dg_2bpat3']]
+    for row in izip(*probe_columns(hprobes, names)):
+      index, seq, gc, e5, e3, spec, bhits = row[:7]
+      l = inputName + '-' + inputId + '-' + str(index - 18) + '\t' #1-based start
+      l += seq + '\t'
+      l += str(round(gc, 1)) + '\t'
+      if e5 == 0: #not computed
+        l += 'None\tNone\t'
+      else:
+        l += str(e5 != e3) + '\t'
+        l += str(e5) + ', ' + str(e3) + '\t'
+      l += (specNames[spec] if spec >= 0 else 'None') + '\t'
+      l += str(bhits).replace('[', '').replace(']', '') + '\t'
+      l += '\t'.join([str(x) if x == x else 'None' for x in row[7:]]) + '\t' #NaN
+      if isoforms is not None:
+        l += ', '.join(isoforms.get(seq, [])) + '\t'
       fh.write(l + '\n')
   fh.close()
   show_log('Your probe information is available at: \n' + result_fn, txt)
@@ -257,10 +720,12 @@ def write_probesCSV(inputId, inputName, hprobes, txt):
 ###############################################################################
 # Write result FASTA file
 ###############################################################################
-def write_probesFNA(inputId, inputName, hprobes, txt):
+@profiled
+def write_probesFNA(inputId, inputName, hprobes, txt, result_fn=None, append=False):
   inputName = inputName.replace('"', '')
-  result_fn = get_script_path() + "/results/" + inputName
-  result_fn += "-" + inputId + "_hprobe.fna"
+  if result_fn is None:
+    result_fn = get_script_path() + "/results/" + inputName
+    result_fn += "-" + inputId + "_hprobe.fna"
   
   # connector and bridge sequences
   hl = { '2X' : 'TCGTACGTCTAACTTACGTCGTTATG',
@@ -275,14 +740,14 @@ def write_probesFNA(inputId, inputName, hprobes, txt):
          '6X' : 'TTATACGTCGAGTTGAATAGCCAGGTT'}
   
   hprobeId = inputName + '-' + inputId
-  with open(result_fn, "w") as fh:
-    for hp in hprobes:
-      probeName = hprobeId + '-' + str(hp.start + 1)
+  with open(result_fn, "a" if append else "w") as fh:
+    for index, larm, rarm in izip(*probe_columns(hprobes, ['index', 'l_seq', 'r_seq'])):
+      probeName = hprobeId + '-' + str(index - 18) #1-based start
       for x in sorted(hl.keys()):
         lhead = '>' + 'HL' + x + '-' + probeName
-        lseq = hl[x] + hp.larm.seq
+        lseq = hl[x] + larm
         rhead = '>' + 'HR' + x + '-' + probeName
-        rseq = hp.rarm.seq + hr[x]
+        rseq = rarm + hr[x]
         fh.write(lhead + '\n' + lseq + '\n')
         fh.write(rhead + '\n' + rseq + '\n')
   fh.close()
@@ -0,0 +1,99 @@
+#!/usr/bin/python
+###############################################################################
+# Validation of the nearest-neighbor thermodynamics against oligoscreen
+###############################################################################
+import os, sys, random
+from argparse import ArgumentParser
+# import modules in src/
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)) + '/src')
+from plishUtils import get_tool_path, fold
+from plishThermo import nn_fold
+
+###############################################################################
+# Set environment vars
+###############################################################################
+os.environ['DATAPATH'] = get_tool_path() + '/RNAstructure/data_tables/'
+
+# Fixtures (sequences, reference values at 37 C): the probe arms of the 
+# example in README.md (TECTA, NM_204873.2) with their oligoscreen values
+# (doc/example_result.png), and 1000 random arms with the values of the 
+# ViennaRNA Package, which uses the parameters of oligoscreen
+# (bench/thermo/referenceVienna.py)
+bench = os.path.dirname(os.path.realpath(__file__)) + '/bench/thermo/'
+fixtures = [(bench + 'arms.txt', bench + 'arms.oligoscreen'),
+            (bench + 'random.txt', bench + 'random.vienna')]
+
+###############################################################################
+# Fetch arguments
+###############################################################################
+parser = ArgumentParser()
+parser.add_argument('-seq', dest='seq', required=False,
+                    help='file with one probe arm sequence per line ' + \
+                    '(default: the fixtures in bench/thermo)', metavar='FILEPATH')
+parser.add_argument('-ref', dest='ref', required=False,
+                    help='precomputed reference values for the sequences in ' + \
+                    'oligoscreen output format (default: run oligoscreen)',
+                    metavar='FILEPATH')
+parser.add_argument('-n', dest='n', type=int,
+                    help='use N random 20-nt arms instead of a fixture ' + \
+                    '(runs oligoscreen)', metavar='N')
+parser.add_argument('--details', dest='details', action='store_true',
+                    help='also print the values of each sequence')
+parser.add_argument('-temperature', dest='temperature', type=float, default=310.15,
+                    help='temperature in K (default: %(default)s)', metavar='K')
+args = parser.parse_args()
+
+###############################################################################
+# Sequences and reference files (None: run oligoscreen)
+###############################################################################
+if args.n is not None:
+  random.seed(1)
+  seqs = [''.join([random.choice('ACGT') for i in range(20)]) 
+          for j in range(args.n)]
+  comparisons = [(seqs, None)]
+elif args.seq is not None:
+  comparisons = [(args.seq, args.ref)]
+else:
+  comparisons = fixtures
+
+###############################################################################
+# Error distribution (nn - reference) per feature
+###############################################################################
+def quantile(x, q):
+  return x[min(len(x) - 1, int(q * len(x)))]
+
+def compare(seqs, ref):
+  if not isinstance(seqs, list):
+    with open(seqs) as fh:
+      seqs = [line.strip().upper() for line in fh if line.strip() != '']
+    fh.close()
+  if ref is not None:
+    print 'Reference: ' + os.path.basename(ref)
+    with open(ref) as fh:
+      ref = [line.strip() for line in fh]
+    fh.close()
+    if [x.split('\t')[0] for x in ref[1:len(seqs)+1]] != seqs:
+      sys.exit('ERROR: reference does not match the sequences')
+  else:
+    ref = fold(seqs, args.temperature)
+    print 'Reference: oligoscreen'
+  nn = nn_fold(seqs, args.temperature)
+  features = ['Bimol.', 'Unimol.', 'Duplex', 'Open5', 'Open3']
+  if args.details:
+    print '\t'.join(['Sequence'] + [x + ' (nn/ref)' for x in features])
+    for i in range(len(seqs)):
+      nv = nn[i+1].split('\t')
+      rv = ref[i+1].split('\t')
+      print '\t'.join([seqs[i]] + [nv[j] + '/' + rv[j] for j in range(1, 6)])
+  print 'Compared ' + str(len(seqs)) + ' sequences at ' + str(args.temperature) + ' K'
+  print '\t'.join(['Feature', 'Bias', 'MAE', 'Median', 'P95', 'Max'])
+  for j in range(len(features)):
+    err = [float(nn[i+1].split('\t')[j+1]) - float(ref[i+1].split('\t')[j+1]) 
+           for i in range(len(seqs))]
+    aerr = sorted([abs(x) for x in err])
+    stats = [sum(err) / len(err), sum(aerr) / len(aerr), quantile(aerr, 0.5), 
+             quantile(aerr, 0.95), aerr[-1]]
+    print '\t'.join([features[j]] + [str(round(x, 2)) for x in stats])
+
+for seqs, ref in comparisons:
+  compare(seqs, ref)